@@ -0,0 +1,1070 @@
+#coding:utf-8
+# Offline micro benchmarks for the _PyContextInfo wrapper layer.
+# The native context only exists inside the terminal, so every case feeds the
+# wrapper a small stand-in that returns synthetic payloads.
+#
+#   python _PyContextBench.py            run all cases
+#   python _PyContextBench.py snapshot   run selected cases
+#
+# The suite measures the accessors over a grid of stock counts, date ranges and field
+# counts: best wall time, peak traced allocation and the process's peak RSS per case,
+# saved to and checked against a JSON baseline.
+#
+#   python _PyContextBench.py --suite --save baseline.json
+#   python _PyContextBench.py --suite --baseline baseline.json [--threshold 0.25] [market_data ...]
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import _PyContextInfo as pci
+from _PyContextSim import patched
+
+PyContext = getattr(pci, '__PyContext')
+
+
+class BarContext(object):
+    def __init__(self):
+        self.barpos = 0
+
+
+def best_of(func, repeat=5, number=1):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        for j in range(number):
+            func()
+        cost = (time.perf_counter() - t0) / number
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def report(title, header, rows):
+    print(title)
+    print(''.join('%16s' % h for h in header))
+    for row in rows:
+        print(''.join('%16s' % (('%.1f' % v) if isinstance(v, float) else v) for v in row))
+    print('')
+
+
+def bench_snapshot():
+    # grid-strategy shaped state; each bar touches a few grids and appends one close,
+    # then the last bar is re-run ten times as in realtime mode
+    rows = []
+    for size in (100, 1000, 10000, 50000):
+        row = [size]
+        for mode in ('deepcopy', 'cow'):
+            native = BarContext()
+            ctx = PyContext(native)
+            ctx.set_snapshot_mode(mode)
+            prices = [round(20 + i * 0.01, 2) for i in range(size)]
+            ctx.grid_positions = OrderedDict((p, 0) for p in prices)
+            ctx.grid_shares = dict((p, 0) for p in prices)
+            ctx.grid_cost = {}
+            ctx.close_history = [20.0] * size
+            state = {'bar': 0}
+
+            def one_bar():
+                state['bar'] += 1
+                native.barpos = state['bar']
+                pci.resume_context_info(ctx)
+                for tick in range(10):
+                    pci.resume_context_info(ctx)
+                    p = prices[(state['bar'] * 7 + tick) % size]
+                    ctx.grid_positions[p] = 1
+                    ctx.grid_shares[p] = 100
+                    ctx.grid_cost[p] = p
+                    ctx.close_history.append(p)
+
+            row.append(best_of(one_bar, repeat=3, number=5) * 1e6)
+        rows.append(row)
+    report('snapshot: us per bar (1 checkpoint + 10 re-runs)', ['entries', 'deepcopy', 'cow'], rows)
+
+
+class MarketContext(object):
+    # get_market_data2 stand-in: {code: {field: array}} with a shared stime column
+    def __init__(self, bars):
+        import numpy as np
+        self.stime = np.array(['%08d' % (20200101 + i) for i in range(bars)])
+        self.values = np.random.RandomState(0).rand(bars) + 10
+
+    def get_market_data2(self, fields, stock_code, *args):
+        result = {}
+        for code in stock_code:
+            sdata = {'stime': self.stime}
+            for f in fields:
+                sdata[f] = self.values
+            result[code] = sdata
+        return result
+
+
+def bench_market_data_ex():
+    fields = ['open', 'high', 'low', 'close', 'volume']
+    rows = []
+    for stocks in (50, 500, 5000):
+        ctx = PyContext(MarketContext(60))
+        codes = ['%06d.SZ' % i for i in range(stocks)]
+        row = [stocks]
+        for result_type in ('', 'panel'):
+            row.append(best_of(lambda: ctx.get_market_data_ex(fields, codes, result_type=result_type), repeat=3) * 1e3)
+        rows.append(row)
+    report('get_market_data_ex: ms per call, 60 bars x 5 fields', ['stocks', 'frames', 'panel'], rows)
+
+
+class LegacyMarketContext(object):
+    # get_market_data stand-in: {code: {timenode: {field: value}}}
+    def __init__(self, bars, fields):
+        self.nodes = dict(('%08d' % (20200101 + i), dict((f, 10.0 + i) for f in fields)) for i in range(bars))
+
+    def get_market_data(self, fields, stock_code, *args):
+        return dict((code, self.nodes) for code in stock_code)
+
+
+def legacy_market_frames(oriData, fields, stock_code):
+    # the string-keyed rebuild get_market_data used before, minus the pd.Panel step
+    import pandas as pd
+    resultDict = {}
+    for code in oriData:
+        for timenode in oriData[code]:
+            resultDict[code + timenode] = [oriData[code][timenode][field] for field in fields]
+    values = {}
+    for code in stock_code:
+        times = []
+        value = []
+        for timenode in oriData[code]:
+            times.append(timenode)
+            value.append(resultDict[code + timenode])
+        values[code] = pd.DataFrame(value, index=times, columns=fields).sort_index()
+    return values
+
+
+def bench_market_data():
+    with patched(pci, hint_get_market_data=False):
+        fields = ['open', 'high', 'low', 'close', 'volume']
+        rows = []
+        for stocks in (1, 50, 500):
+            native = LegacyMarketContext(252, fields)
+            ctx = PyContext(native)
+            codes = ['%06d.SZ' % i for i in range(stocks)]
+            ori = native.get_market_data(fields, codes)
+            legacy = best_of(lambda: legacy_market_frames(ori, fields, codes), repeat=3)
+            current = best_of(lambda: ctx.get_market_data(fields, codes, count=252), repeat=3)
+            rows.append([stocks, legacy * 1e3, current * 1e3])
+        report('get_market_data: ms per call, 252 bars x 5 fields', ['stocks', 'legacy', 'current'], rows)
+
+
+def field_values_payload(fields, stocks, dates):
+    # get_financial_data(..., 'dict', False) / get_factor_datas stand-in
+    import random
+    rand = random.Random(0)
+    return {
+        'field': ['f%d' % i for i in range(fields)],
+        'stock': ['%06d.SZ' % i for i in range(stocks)],
+        'date': ['%08d' % (20200101 + i) for i in range(dates)],
+        'value': [[rand.random() for k in range(stocks * dates)] for j in range(fields)],
+    }
+
+
+class FinancialContext(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_financial_data(self, *args):
+        return self.payload
+
+
+def legacy_stock_frames(fields, stocks, dates, values):
+    # the triple loop get_financial_data / get_factor_data used before
+    import pandas as pd
+    panels = OrderedDict()
+    for i in range(len(stocks)):
+        dataDict = OrderedDict()
+        for j in range(len(values)):
+            dataList = []
+            value = values[j]
+            for k in range(i * len(dates), (i + 1) * len(dates)):
+                dataList.append(value[k])
+            dataDict[fields[j]] = pd.Series(dataList, index=dates)
+        panels[stocks[i]] = pd.DataFrame(dataDict)
+    return panels
+
+
+def bench_field_values():
+    rows = []
+    for stocks in (100, 1000, 5000):
+        payload = field_values_payload(5, stocks, 20)
+        ctx = PyContext(FinancialContext(payload))
+        args = (payload['field'], payload['stock'], '20200101', '20200131')
+        legacy = best_of(lambda: legacy_stock_frames(payload['field'], payload['stock'], payload['date'], payload['value']), repeat=2)
+        with patched(pci, get_factor_datas=lambda *args: payload):
+            factor = best_of(lambda: ctx.get_factor_data(*args), repeat=3)
+        financial = best_of(lambda: ctx.get_financial_data(*args), repeat=3)
+        rows.append([stocks, legacy * 1e3, factor * 1e3, financial * 1e3])
+    report('get_factor_data / get_financial_data: ms per call, 20 dates x 5 fields',
+           ['stocks', 'legacy', 'factor(dict)', 'financial(mi)'], rows)
+
+
+class LiveBarContext(object):
+    # a live chart sitting on one bar of 2024-06-03, for caches keyed on the trading date
+    barpos = 0
+
+    def get_bar_timetag(self, index):
+        return 1717376400000
+
+
+class OptionContext(LiveBarContext):
+    # get_instrumentdetail stand-in over a synthetic 上证期权 board; counts native calls
+    def __init__(self, contracts):
+        self.calls = 0
+        self.insts = {}
+        self.sectors = {'上证期权': [], '过期上证期权': []}
+        undls = ['510050', '510300', '510500', '588000']
+        expires = [20240626, 20240724, 20240925, 20241225]
+        for i in range(contracts):
+            code = '%08d.SHO' % (10000000 + i)
+            self.insts[code] = {
+                'ExtendInfo': {'optType': 'CALL' if i % 2 else 'PUT', 'OptUndlCode': undls[i % 4], 'OptUndlMarket': 'SH'},
+                'ExpireDate': expires[(i // 8) % 4], 'OpenDate': 20240101, 'CreateDate': 20240101, 'ProductID': 'P',
+            }
+            self.sectors['上证期权'].append(code)
+
+    def get_instrumentdetail(self, code):
+        self.calls += 1
+        return self.insts.get(code, {})
+
+    def get_stock_list_in_sector(self, name):
+        return list(self.sectors.get(name, []))
+
+
+def bench_option_list():
+    rows = []
+    for contracts in (1000, 5000):
+        native = OptionContext(contracts)
+        ctx = PyContext(native)
+        with patched(pci, get_stock_list_in_sector=native.get_stock_list_in_sector,
+                     get_his_contracts_list=lambda market: []):
+            first = best_of(lambda: ctx.get_option_list('510050.SH', '202406', 'C'), repeat=1)
+            built = native.calls
+            steady = best_of(lambda: ctx.get_option_list('510050.SH', '202406', 'C'), repeat=5, number=100)
+            undl = best_of(lambda: ctx.get_option_undl_data('510050.SH'), repeat=5, number=100)
+        rows.append([contracts, first * 1e3, steady * 1e6, undl * 1e6, built, native.calls - built])
+    report('get_option_list / get_option_undl_data: first call ms, steady us, native calls',
+           ['contracts', 'first ms', 'list us', 'undl us', 'build calls', 'later calls'], rows)
+
+
+def bench_bsm():
+    import numpy as np
+    ctx = PyContext(None)
+    rows = []
+    for strikes in (50, 200, 1000):
+        grid = np.linspace(2.0, 4.0, strikes)
+        klist = grid.tolist()
+        loop = best_of(lambda: [ctx.bsm_price('C', 3.0, k, 0.03, 0.23, 30) for k in klist], repeat=3)
+        price = best_of(lambda: ctx.bsm_price('C', 3.0, grid, 0.03, 0.23, 30), repeat=3)
+        greeks = best_of(lambda: ctx.bsm_greeks('C', 3.0, grid, 0.03, 0.23, 30), repeat=3)
+        rows.append([strikes, loop * 1e6, price * 1e6, greeks * 1e6])
+    report('bsm: us per surface', ['strikes', 'scalar loop', 'array price', 'array greeks'], rows)
+
+
+def scalar_iv(optType, S, K, P, r, days, q):
+    # per-contract bisection on _bsm_price_scalar, standing in for the native
+    # calc_bsm_iv behind ContextInfo.bsm_iv outside the terminal
+    lo, hi = 1e-6, 10.0
+    if not (pci._bsm_price_scalar(optType, S, K, r, lo, days, q) < P < pci._bsm_price_scalar(optType, S, K, r, hi, days, q)):
+        return float('nan')
+    for i in range(100):
+        mid = (lo + hi) / 2
+        if pci._bsm_price_scalar(optType, S, K, r, mid, days, q) > P:
+            hi = mid
+        else:
+            lo = mid
+        if hi - lo < 1e-10:
+            break
+    return (lo + hi) / 2
+
+
+def bench_iv():
+    # 5000 contracts across strikes / expiries / both sides, priced from known vols
+    import numpy as np
+    rand = np.random.RandomState(0)
+    rows = []
+    for contracts in (500, 5000):
+        S = np.full(contracts, 3.0)
+        K = S * rand.uniform(0.7, 1.3, contracts)
+        sigma = rand.uniform(0.1, 0.8, contracts)
+        days = rand.choice([7, 35, 63, 154, 245], contracts).astype(float)
+        types = np.where(rand.rand(contracts) < 0.5, 'C', 'P')
+        prices = pci.bsm_greeks(types, S, K, 0.02, sigma, days)['price']
+        args = list(zip(types.tolist(), S.tolist(), K.tolist(), prices.tolist(), days.tolist()))
+        if hasattr(pci, 'calc_bsm_iv'):
+            solve = lambda t, s, k, p, d: PyContext(None).bsm_iv(t, s, k, p, 0.02, d)
+        else:
+            solve = lambda t, s, k, p, d: scalar_iv(t, s, k, p, 0.02, d, 0)
+        scalar = np.array([solve(*a) for a in args])
+        loop = best_of(lambda: [solve(*a) for a in args], repeat=1)
+        batch = best_of(lambda: pci.bsm_iv_batch(types, S, K, prices, 0.02, days), repeat=3)
+        iv = pci.bsm_iv_batch(types, S, K, prices, 0.02, days)
+        # deep in/out of the money short-dated quotes carry no vol information; compare the rest
+        iv[pci.bsm_greeks(types, S, K, 0.02, sigma, days)['vega'] < 1e-3] = np.nan
+        surface = best_of(lambda: pci.IVSurface(K / S, days, iv), repeat=3)
+        rows.append([contracts, loop * 1e3, batch * 1e3, surface * 1e3,
+                     '%.1e' % np.nanmax(np.abs(iv - sigma)), '%.1e' % np.nanmax(np.abs(iv - scalar))])
+    report('bsm_iv_batch: ms per chain, max abs error vs true vol / scalar solver',
+           ['contracts', 'scalar loop', 'batch', 'surface', 'err true', 'err scalar'], rows)
+
+
+class InstrumentContext(LiveBarContext):
+    # futures board stand-in; counts get_instrumentdetail round-trips
+    def __init__(self, codes):
+        self.calls = 0
+        self.universe = []
+        self.insts = dict((code, {'PriceTick': 0.2, 'VolumeMultiple': 300, 'UpStopPrice': 4000.0, 'ExpireDate': 99999999})
+                          for code in codes)
+
+    def get_instrumentdetail(self, code):
+        self.calls += 1
+        return dict(self.insts.get(code, {}))
+
+    def get_universe(self):
+        return self.universe
+
+    def set_universe(self, universe):
+        self.universe = universe
+
+
+def bench_instrument():
+    # a grid strategy rounding every order price to PriceTick and sizing by VolumeMultiple
+    rows = []
+    for codes in (10, 100):
+        universe = ['IF%04d.IF' % (2400 + i) for i in range(codes)]
+        for mode in ('direct', 'cached'):
+            native = InstrumentContext(universe)
+            ctx = PyContext(native)
+            if mode == 'cached':
+                ctx.set_universe(universe)
+            else:
+                # every lookup goes to the terminal, as before the cache
+                ctx.z8sglma_instruments.get = lambda context, code: context.get_instrumentdetail(code)
+
+            def orders():
+                for i in range(1000):
+                    inst = ctx.get_instrumentdetail(universe[i % codes])
+                    round(3999.7 / inst['PriceTick']) * inst['PriceTick'] * inst['VolumeMultiple']
+
+            cost = best_of(orders, repeat=3)
+            rows.append([codes, mode, cost * 1e3, native.calls])
+    report('get_instrumentdetail: ms per 1000 orders, native calls in total',
+           ['codes', 'mode', 'ms', 'native calls'], rows)
+
+
+class QuoteContext(object):
+    # subscribe_quote stand-in: keeps the wrapped callbacks so the bench can push to them
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe_quote(self, stock_code, period, dividend_type, callback):
+        self.callbacks.append(callback)
+        return len(self.callbacks)
+
+
+def bench_subscribe_quote():
+    # 300 codes, one-row tick pushes carrying the forming bar
+    import numpy as np
+    fields = ['open', 'high', 'low', 'close', 'volume', 'amount']
+    codes = ['%06d.SZ' % i for i in range(300)]
+    rows = []
+    for result_type in ('', 'ring'):
+        native = QuoteContext()
+        ctx = PyContext(native)
+        seen = []
+        for code in codes:
+            ctx.subscribe_quote(code, '1m', 'none', result_type, lambda data: seen.append(data))
+        state = {'tick': 0}
+
+        def one_round():
+            state['tick'] += 1
+            t = 1700000000000 + (state['tick'] // 20) * 60000
+            for callback in native.callbacks:
+                datas = dict((f, np.array([10.0 + state['tick'] * 0.01])) for f in fields)
+                datas['time'] = np.array([t])
+                datas['stime'] = np.array(['%d' % t])
+                callback(datas)
+            del seen[:]
+
+        rows.append([result_type or 'frame', best_of(one_round, repeat=3, number=20) * 1e3])
+    report('subscribe_quote: ms per tick across 300 codes', ['result_type', 'ms'], rows)
+
+
+class WholeQuoteContext(object):
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe_whole_quote(self, code_list, callback):
+        self.callbacks.append(callback)
+        return len(self.callbacks)
+
+
+def bench_whole_quote():
+    # an opening-auction burst: 200 pushes of 1000 codes drawn from a 5000-code market,
+    # the strategy doing a little work per code it receives
+    import random
+    rand = random.Random(0)
+    market = ['%06d.SZ' % i for i in range(5000)]
+    pushes = [dict((code, {'lastPrice': 10.0, 'volume': i}) for code in rand.sample(market, 1000)) for i in range(200)]
+    rows = []
+    for window in (0, 20, 100):
+        native = WholeQuoteContext()
+        ctx = PyContext(native)
+        handled = {'codes': 0}
+
+        def on_quote(datas):
+            for code, snapshot in datas.items():
+                handled['codes'] += 1
+                snapshot['lastPrice'] * snapshot['volume']
+
+        subID = ctx.subscribe_whole_quote(market, on_quote, window=window, maxsize=4000)
+
+        def burst():
+            for datas in pushes:
+                native.callbacks[0](datas)
+            ctx.flush_whole_quote(subID)
+
+        cost = best_of(burst, repeat=1)
+        stats = ctx.get_whole_quote_stats(subID)
+        rows.append([window, cost * 1e3, handled['codes'], stats.get('batches', len(pushes)),
+                     stats.get('coalesced', 0), stats.get('dropped', 0)])
+    report('subscribe_whole_quote: one burst, ms and codes handled by the strategy',
+           ['window ms', 'ms', 'codes handled', 'batches', 'coalesced', 'dropped'], rows)
+
+
+class TimelineContext(object):
+    # one year of 1m bars, 240 per weekday
+    def __init__(self):
+        self.bars = []
+        start = 1704072600000
+        for day in range(365):
+            if day % 7 < 5:
+                self.bars.extend(start + day * 86400000 + m * 60000 for m in range(240))
+        self.time_tick_size = len(self.bars)
+
+    def get_bar_timetag(self, index):
+        return self.bars[index]
+
+
+def bench_timeline():
+    # the factor scripts' per-bar date lookups: d - 1 and d, formatted '%Y%m%d'
+    native = TimelineContext()
+    bars = native.time_tick_size
+
+    def per_bar():
+        for d in range(1, bars):
+            pci.timetag_to_datetime(native.get_bar_timetag(d - 1), '%Y%m%d')
+            pci.timetag_to_datetime(native.get_bar_timetag(d), '%Y%m%d')
+
+    def timeline():
+        ctx = PyContext(native)
+        for d in range(1, bars):
+            line = ctx.get_bar_timeline()
+            line.date(d - 1)
+            line.date(d)
+
+    legacy = best_of(per_bar, repeat=1)
+    current = best_of(timeline, repeat=1)
+    vector = best_of(lambda: pci.timetag_to_datetime(native.bars, '%Y%m%d'), repeat=3)
+    report('bar dates over one year of 1m bars: ms per run',
+           ['bars', 'strftime/bar', 'timeline', 'vectorized'], [[bars, legacy * 1e3, current * 1e3, vector * 1e3]])
+
+
+class HistoryContext(object):
+    # get_history_data stand-in over a fixed daily history; counts native calls, each one
+    # spinning for `latency` seconds as the terminal round-trip
+    def __init__(self, stocks, bars, latency=0.0):
+        import random
+        rand = random.Random(0)
+        self.barpos = 0
+        self.calls = 0
+        self.latency = latency
+        self.history = dict((stock, [round(rand.uniform(9, 11), 2) for i in range(bars)]) for stock in stocks)
+
+    def is_last_bar(self):
+        return False
+
+    def get_history_data(self, count, period, field, dividend_type, skip_paused):
+        self.calls += 1
+        if self.latency:
+            end = time.perf_counter() + self.latency
+            while time.perf_counter() < end:
+                pass
+        start = max(self.barpos + 1 - count, 0)
+        return dict((stock, values[start:self.barpos + 1]) for stock, values in self.history.items())
+
+
+def bench_history():
+    # the Kimi grid strategy's per-bar reads: four 30-day fields in get_enhanced_history,
+    # a 40-day close for the EMA and 20 / 25-day closes for the MA and its slope. The cache
+    # saves native calls but spends Python time lining windows up, so it only pays once a
+    # call costs more than the break-even latency: measured against a free stand-in, then
+    # with an assumed 0.3 ms round-trip
+    with patched(pci, hint_get_history_data=False):
+        reads = [(30, 'high'), (30, 'low'), (30, 'close'), (30, 'volume'), (40, 'close'), (20, 'close'), (25, 'close')]
+        bars = 250
+        rows = []
+        even = []
+        for stocks in (1, 50, 500):
+            cost = {}
+            for latency in (0.0, 0.0003):
+                for cached in (False, True):
+                    last = {}
+
+                    def run():
+                        # a fresh context per run, so the cache starts cold each time
+                        native = last['native'] = HistoryContext(['%06d.SZ' % i for i in range(stocks)], 600, latency)
+                        ctx = PyContext(native)
+                        read = ctx.get_history_data if cached else (lambda n, p, f: native.get_history_data(n, p, f, 'none', True))
+                        for bar in range(300, 300 + bars):
+                            native.barpos = bar
+                            for count, field in reads:
+                                read(count, '1d', field)
+
+                    seconds = best_of(run, repeat=3)
+                    calls = last['native'].calls / float(bars)
+                    cost[latency, cached] = (seconds / bars, calls)
+                    rows.append([stocks, 'cache' if cached else 'direct', latency * 1e3, seconds * 1e6 / bars, calls])
+            (direct, direct_calls), (cache, cache_calls) = cost[0.0, False], cost[0.0, True]
+            even.append([stocks, max(cache - direct, 0) * 1e6 / (direct_calls - cache_calls)])
+        report('get_history_data: us and native calls per bar, over %d bars' % bars,
+               ['stocks', 'mode', 'latency ms', 'us/bar', 'calls/bar'], rows)
+        report('get_history_data: native latency per call at which the cache breaks even',
+               ['stocks', 'us/call'], even)
+
+
+def bench_indicators():
+    # the Kimi trend filter per bar: two MAs, an EMA and an MA slope, recomputed from
+    # get_history_data windows as the script did, against the streaming indicators;
+    # once with the script's windows and once with yearly ones
+    import numpy as np
+    with patched(pci, hint_get_history_data=False):
+
+        def moving_average(ctx, stock, window):
+            closes = ctx.get_history_data(window * 2, '1d', 'close').get(stock, [])[-window * 2:]
+            return np.mean(closes[-window:]) if len(closes) >= window else None
+
+        def exponential_ma(ctx, stock, window):
+            closes = ctx.get_history_data(window * 2, '1d', 'close').get(stock, [])[-window * 2:]
+            if len(closes) < window:
+                return None
+            weights = np.exp(np.linspace(-1., 0., window))
+            weights /= weights.sum()
+            return np.dot(closes[-window:], weights)
+
+        def recompute(ctx, stock, short, long, ema):
+            ma = moving_average(ctx, stock, long)
+            ma_next = moving_average(ctx, stock, long + 1)
+            return [moving_average(ctx, stock, short), ma, exponential_ma(ctx, stock, ema), (ma - ma_next) / ma]
+
+        def stream(ctx, stock, short, long, ema):
+            return [ctx.get_indicator('sma', stock, short), ctx.get_indicator('sma', stock, long),
+                    ctx.get_indicator('ema', stock, ema), ctx.get_indicator('slope', stock, long)]
+
+        rows = []
+        for windows in ((5, 20, 60), (20, 120, 250)):
+            results = {}
+            for name, read in (('recompute', recompute), ('stream', stream)):
+                native = HistoryContext(['000001.SZ'], 1200)
+                ctx = PyContext(native)
+                values = []
+
+                def run():
+                    del values[:]
+                    for bar in range(600, 1100):
+                        native.barpos = bar
+                        values.append(read(ctx, '000001.SZ', *windows))
+
+                cost = best_of(run, repeat=1)
+                results[name] = values
+                rows.append(['/'.join(map(str, windows)), name, cost * 1e6 / 500])
+            rows[-1].append(results['recompute'] == results['stream'])
+            rows[-2].append('')
+        report('trend indicators: 500 bars, us per bar', ['windows', 'mode', 'us', 'identical'], rows)
+
+
+
+class CloseContext(object):
+    barpos = 0
+
+    def get_last_close(self, stock):
+        return 10.0
+
+
+def bench_profiling():
+    # per-call cost of a thin forwarding method, never profiled, after profiling was
+    # switched off again, while profiled, and on another context while one is profiled
+    ctx = PyContext(CloseContext())
+    other = PyContext(CloseContext())
+    calls = 100000
+
+    def loop(target=ctx):
+        for i in range(calls):
+            target.get_last_close('600000.SH')
+
+    rows = [['never', best_of(loop, repeat=3) * 1e6 / calls]]
+    ctx.enable_profiling()
+    ctx.disable_profiling()
+    rows.append(['disabled', best_of(loop, repeat=3) * 1e6 / calls])
+    ctx.enable_profiling()
+    rows.append(['enabled', best_of(loop, repeat=3) * 1e6 / calls])
+    rows.append(['other context', best_of(lambda: loop(other), repeat=3) * 1e6 / calls])
+    ctx.disable_profiling()
+    report('method profiling: us per ContextInfo call', ['state', 'us'], rows)
+
+    # sizing a get_market_data_ex-shaped return on a profiled call: 5000 codes of 250 bars
+    import numpy as np
+    import pandas as pd
+    rows = []
+    for name, payload in (('lists', dict((i, [0.0] * 250) for i in range(5000))),
+                          ('frames', dict((i, pd.DataFrame(np.zeros((250, 5)))) for i in range(5000)))):
+        rows.append([name, best_of(lambda: pci._payload_bytes(payload), repeat=3) * 1e6])
+    report('profiled return size: us per 5000-code payload', ['values', 'us'], rows)
+
+
+class PaintContext(object):
+    # native stand-in for the draw_* calls; keeps the last line it was given
+    barpos = 0
+
+    def draw_text(self, condition, position, text, line, limit):
+        self.line = line
+
+
+class LegacyDrawContext(PyContext):
+    # draw_text as it read its caller line before the per-call-site cache
+    def draw_text(self, condition, position, text, limit=''):
+        import sys
+        line = sys._getframe().f_back.f_lineno
+        if 'noaxis' == limit.lower():
+            return self.context.draw_text(condition, position, text, line, 0)
+        else:
+            return self.context.draw_text(condition, position, text, line, 1)
+
+
+def bench_paint():
+    # draw_text from a strategy, with its caller line read from f_lineno on every call as
+    # before, and from the per-call-site cache
+    calls = 100000
+    rows = []
+    for name, ctx in (('f_lineno', LegacyDrawContext(PaintContext())), ('cached', PyContext(PaintContext()))):
+        def loop():
+            for i in range(calls):
+                ctx.draw_text(1, 0.5, 'B')
+
+        rows.append([name, best_of(loop, repeat=3) * 1e6 / calls])
+    report('draw_text: us per call', ['caller line', 'us'], rows)
+
+
+class FactorContext(object):
+    # daily closes, volumes and float shares of `stocks` codes plus 000300.SH over `days`
+    # weekdays; the chart is the benchmark
+    def __init__(self, stocks, days):
+        import numpy as np
+        rng = np.random.RandomState(0)
+        start = 1577923200000
+        tags = [start + d * 86400000 for d in range(days * 7 // 5 + 7) if d % 7 < 5][:days]
+        self.timetags = tags
+        self.time_tick_size = days
+        self.barpos = days - 1
+        self.stime = pci.timetag_to_datetime(np.array(tags), '%Y%m%d')
+        self.codes = ['%06d.SZ' % i for i in range(stocks)] + ['000300.SH']
+        self.close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, (len(self.codes), days)), axis=1))
+        self.volume = rng.uniform(1e5, 1e6, (len(self.codes), days))
+        self.shares = np.repeat(rng.uniform(1e8, 1e9, (len(self.codes), 1)), days, axis=1)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+
+    def get_bar_timetag(self, index):
+        return self.timetags[index]
+
+    def get_risk_free_rate(self, index):
+        return 2.0
+
+    def _rows(self, start, end):
+        import numpy as np
+        return np.searchsorted(self.stime, start), np.searchsorted(self.stime, end, 'right')
+
+    def get_market_data2(self, fields, stock_code, period, start_time, end_time, *args):
+        begin, stop = self._rows(start_time, end_time)
+        result = {}
+        for code in stock_code:
+            i = self.index[code]
+            result[code] = {'stime': self.stime[begin:stop], 'close': self.close[i, begin:stop], 'volume': self.volume[i, begin:stop]}
+        return result
+
+    def get_financial_data(self, fieldList, stockList, startDate, endDate, *args):
+        begin, stop = self._rows(startDate, endDate)
+        if args[-1]:
+            # raw form: one report on the first day
+            return dict((code, {fieldList[0]: {self.stime[0]: self.shares[self.index[code], 0]} if begin == 0 else {}})
+                        for code in stockList)
+        values = self.shares[[self.index[code] for code in stockList], begin:stop].reshape(-1).tolist()
+        return {'field': ['circulating_capital'], 'stock': list(stockList), 'date': self.stime[begin:stop].tolist(), 'value': [values]}
+
+
+def bench_style_factors():
+    # all six style factors for a universe from scratch, for the last day (daily refresh) and
+    # a year, then one more day on a universe already held
+    rows = []
+    for stocks in (100, 1000, 5000):
+        native = FactorContext(stocks, 700)
+        ctx = PyContext(native)
+        codes = native.codes[:-1]
+        timeline = ctx.get_bar_timeline()
+        last = timeline.date(native.barpos)
+        before = timeline.date(native.barpos - 1)
+        year = timeline.date(native.barpos - 249)
+
+        def fresh(start):
+            ctx.z8sglma_factors.clear()
+            ctx.get_style_factors(codes, start, last)
+
+        next_day = None
+        for i in range(3):
+            ctx.z8sglma_factors.clear()
+            ctx.get_style_factors(codes, before, before)
+            t0 = time.perf_counter()
+            ctx.get_style_factors(codes, last, last)
+            cost = time.perf_counter() - t0
+            next_day = cost if next_day is None else min(next_day, cost)
+        rows.append([stocks, best_of(lambda: fresh(last), repeat=3) * 1e3, best_of(lambda: fresh(year), repeat=1) * 1e3,
+                     next_day * 1e3])
+    report('get_style_factors: ms per call, six factors', ['stocks', '1 day', '250 days', 'next day'], rows)
+
+
+def script_dastd(closes):
+    # DASTD.py's per-bar arithmetic over its 252 closes
+    stock_r = [closes[i + 1] / closes[i] for i in range(250)]
+    stock_mean_r = sum(stock_r) / len(stock_r)
+    stock_var = 0
+    half_lift = pow(0.5, 1 / float(252))
+    half_lift_list = [pow(half_lift, 250 - i) for i in range(250)]
+    for i in range(len(stock_r)):
+        stock_var += half_lift_list[i] * (stock_r[i] - stock_mean_r) ** 2
+    return stock_var ** 0.5
+
+
+def bench_ewma_volatility():
+    # DASTD per new bar: the script's recompute over 252 closes against one EWMAVolatility
+    # step, for one stock and for a universe advancing as one vector; the last column is the
+    # largest gap to the full recompute (check=True) over the run
+    import numpy as np
+    bars = 1000
+    rows = []
+    for stocks in (1, 100, 5000):
+        rng = np.random.RandomState(0)
+        close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, (bars + 252, stocks)), axis=0))
+        ret = close[1:] / close[:-1] - 1.0
+        lists = [close[:, j].tolist() for j in range(min(stocks, 100))]
+
+        def script():
+            for t in range(0, bars, 50):
+                for column in lists:
+                    script_dastd(column[t:t + 252])
+
+        def stream():
+            op = pci.EWMAVolatility(stocks)
+            for t in range(len(ret)):
+                op.update(ret[t])
+                op.value
+
+        checked = pci.EWMAVolatility(stocks, check=True)
+        for t in range(len(ret)):
+            checked.update(ret[t])
+            checked.value
+        script_us = best_of(script, repeat=1) * 1e6 / (bars // 50) * stocks / len(lists)
+        rows.append([stocks, script_us, best_of(stream, repeat=3) * 1e6 / len(ret), '%.1e' % checked.max_error])
+    report('DASTD: us per bar for the whole universe', ['stocks', 'script', 'stream', 'max error'], rows)
+
+
+def bench_rolling_wls():
+    # HSIGMA per new bar: a refit over the 252-bar window (numpy lstsq standing in for the
+    # script's sklearn fit) against one RollingWLS step, for one stock and a universe
+    import numpy as np
+    bars = 1000
+    rows = []
+    for stocks in (1, 100, 5000):
+        rng = np.random.RandomState(0)
+        x = rng.normal(0, 0.01, bars + 252)
+        y = 0.8 * x[:, None] + rng.normal(0, 0.01, (bars + 252, stocks))
+        op = pci.RollingWLS(stocks)
+        sqrt_w = np.sqrt(op.term_weights[0])
+        fitted = min(stocks, 100)
+
+        def refit():
+            for t in range(252, bars + 252, 50):
+                design = np.c_[np.ones(252), x[t - 252:t]] * sqrt_w[:, None]
+                for j in range(fitted):
+                    np.linalg.lstsq(design, y[t - 252:t, j] * sqrt_w, rcond=None)
+
+        def stream():
+            op.reset()
+            for t in range(bars + 252):
+                op.update(x[t], y[t])
+                op.value
+
+        refit_us = best_of(refit, repeat=1) * 1e6 / (bars // 50) * stocks / fitted
+        rows.append([stocks, refit_us, best_of(stream, repeat=3) * 1e6 / (bars + 252)])
+    report('HSIGMA: us per bar for the whole universe', ['stocks', 'refit', 'stream'], rows)
+
+
+BENCHES = OrderedDict([
+    ('snapshot', bench_snapshot),
+    ('market_data_ex', bench_market_data_ex),
+    ('market_data', bench_market_data),
+    ('field_values', bench_field_values),
+    ('option_list', bench_option_list),
+    ('bsm', bench_bsm),
+    ('iv', bench_iv),
+    ('instrument', bench_instrument),
+    ('subscribe_quote', bench_subscribe_quote),
+    ('whole_quote', bench_whole_quote),
+    ('timeline', bench_timeline),
+    ('history', bench_history),
+    ('indicators', bench_indicators),
+    ('profiling', bench_profiling),
+    ('paint', bench_paint),
+    ('style_factors', bench_style_factors),
+    ('ewma_volatility', bench_ewma_volatility),
+    ('rolling_wls', bench_rolling_wls),
+])
+
+
+
+def _rss_kb(reset=False):
+    # (current, peak) resident set in kB. On Linux `reset` first drops the peak to the
+    # current size, so the next peak covers only what runs in between; elsewhere both are
+    # the process high-water mark
+    try:
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        status = {}
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    status[key] = int(value.split()[0])
+        return status['VmRSS'], status['VmHWM']
+    except (IOError, OSError, KeyError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss // 1024 if sys.platform == 'darwin' else rss
+    return rss, rss
+
+
+def measure(func, repeat=3):
+    # one untimed call first (first-use imports and caches), then the best wall time, one
+    # traced run for the allocation peak and one plain run for the resident set it adds
+    # above where it started; a case that fits in heap pages freed earlier adds none. Off
+    # Linux that is only the growth of the process high-water mark
+    func()
+    seconds = best_of(func, repeat=repeat)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    start = _rss_kb(reset=True)[0]
+    func()
+    end = _rss_kb()[1]
+    rss = end - start if start is not None and end is not None else None
+    return OrderedDict([('seconds', seconds), ('alloc_kb', peak / 1024.0), ('rss_kb', rss)])
+
+
+def suite_market_data():
+    for stocks in (1, 50, 500):
+        for bars in (20, 252):
+            for fields in (1, 5):
+                names = ['open', 'high', 'low', 'close', 'volume'][:fields]
+                ctx = PyContext(LegacyMarketContext(bars, names))
+                codes = ['%06d.SZ' % i for i in range(stocks)]
+                yield ({'stocks': stocks, 'bars': bars, 'fields': fields}, lambda: ctx.get_market_data(names, codes, count=bars),
+                       {'hint_get_market_data': False})
+
+
+def suite_market_data_ex():
+    for stocks in (50, 500, 2000):
+        for bars in (20, 252):
+            for fields in (1, 5):
+                names = ['open', 'high', 'low', 'close', 'volume'][:fields]
+                ctx = PyContext(MarketContext(bars))
+                codes = ['%06d.SZ' % i for i in range(stocks)]
+                yield {'stocks': stocks, 'bars': bars, 'fields': fields}, lambda: ctx.get_market_data_ex(names, codes)
+
+
+def suite_financial_data():
+    for stocks in (100, 1000, 5000):
+        for dates in (4, 20):
+            for fields in (1, 5):
+                payload = field_values_payload(fields, stocks, dates)
+                ctx = PyContext(FinancialContext(payload))
+                args = (payload['field'], payload['stock'], '20200101', '20201231')
+                yield {'stocks': stocks, 'dates': dates, 'fields': fields}, lambda: ctx.get_financial_data(*args)
+
+
+def suite_factor_data():
+    for stocks in (100, 1000, 5000):
+        for dates in (4, 20):
+            for fields in (1, 5):
+                payload = field_values_payload(fields, stocks, dates)
+                ctx = PyContext(None)
+                args = (payload['field'], payload['stock'], '20200101', '20201231')
+                yield ({'stocks': stocks, 'dates': dates, 'fields': fields}, lambda: ctx.get_factor_data(*args),
+                       {'get_factor_datas': lambda *a: payload})
+
+
+class LonghubangContext(object):
+    # get_longhubang stand-in: per stock, columns 0-7 and two lists of booth tables
+    def __init__(self, stocks, days):
+        import random
+        rand = random.Random(0)
+
+        def booths():
+            return [dict([(0, ['booth%d' % k for k in range(5)])] + [(j, [rand.random() for k in range(5)]) for j in range(1, 8)])
+                    for r in range(days)]
+
+        self.data = {}
+        for i in range(stocks):
+            code = '%06d.SZ' % i
+            self.data[code] = {0: [code] * days, 1: ['name'] * days, 2: ['%08d' % (20240101 + r) for r in range(days)],
+                               3: ['reason'] * days, 4: [rand.random() for r in range(days)], 5: [1.0] * days,
+                               6: [100.0] * days, 7: [1e6] * days, 8: booths(), 9: booths()}
+
+    def get_longhubang(self, *args):
+        return self.data
+
+
+def suite_longhubang():
+    for stocks in (100, 1000):
+        for days in (1, 5):
+            ctx = PyContext(LonghubangContext(stocks, days))
+            for result_type in ('', 'table'):
+                yield ({'stocks': stocks, 'days': days, 'result_type': result_type or 'frame'},
+                       lambda ctx=ctx, result_type=result_type: ctx.get_longhubang([], '20240101', '20241231', result_type=result_type))
+
+
+def suite_option_list():
+    for contracts in (1000, 5000):
+        native = OptionContext(contracts)
+        ctx = PyContext(native)
+        patches = {'get_stock_list_in_sector': native.get_stock_list_in_sector,
+                   'get_his_contracts_list': lambda market: []}
+
+        def run(ctx=ctx):
+            for i in range(100):
+                ctx.get_option_list('510050.SH', '202406', 'C')
+
+        # the index is built on the first call; the case is the steady state
+        with patched(pci, **patches):
+            run()
+        yield {'contracts': contracts, 'calls': 100}, run, patches
+
+
+def suite_subscribe_quote():
+    import numpy as np
+    fields = ['open', 'high', 'low', 'close', 'volume', 'amount']
+    for codes in (100, 300):
+        for result_type in ('', 'ring'):
+            native = QuoteContext()
+            ctx = PyContext(native)
+            for i in range(codes):
+                ctx.subscribe_quote('%06d.SZ' % i, '1m', 'none', result_type, lambda data: None)
+            state = {'tick': 0}
+
+            def ticks(native=native, state=state):
+                for n in range(20):
+                    state['tick'] += 1
+                    t = 1700000000000 + (state['tick'] // 20) * 60000
+                    for callback in native.callbacks:
+                        datas = dict((f, np.array([10.0 + state['tick'] * 0.01])) for f in fields)
+                        datas['time'] = np.array([t])
+                        datas['stime'] = np.array(['%d' % t])
+                        callback(datas)
+
+            yield {'codes': codes, 'ticks': 20, 'result_type': result_type or 'frame'}, ticks
+
+
+SUITE = OrderedDict([
+    ('market_data', suite_market_data),
+    ('market_data_ex', suite_market_data_ex),
+    ('financial_data', suite_financial_data),
+    ('factor_data', suite_factor_data),
+    ('longhubang', suite_longhubang),
+    ('option_list', suite_option_list),
+    ('subscribe_quote', suite_subscribe_quote),
+])
+
+
+def case_name(accessor, params):
+    return accessor + '/' + '/'.join('%s=%s' % kv for kv in params.items())
+
+
+def run_suite(names=None, save=None, baseline=None, threshold=0.25, repeat=3):
+    # returns 1 when a case is slower, or allocates more, than the baseline by more than
+    # `threshold`; times within 0.1 ms of the baseline are taken as noise. A case is
+    # (params, func) or (params, func, {name: value}), the module globals it runs under
+    results = OrderedDict()
+    for accessor in names or list(SUITE):
+        for case in SUITE[accessor]():
+            with patched(pci, **(case[2] if len(case) > 2 else {})):
+                results[case_name(accessor, case[0])] = measure(case[1], repeat)
+    base = {}
+    if baseline:
+        with open(baseline) as f:
+            base = json.load(f)['cases']
+    rows = []
+    regressions = 0
+    for name, now in results.items():
+        old = base.get(name)
+        flag = ''
+        ratio = ''
+        if old:
+            ratio = '%.2f' % (now['seconds'] / old['seconds']) if old['seconds'] else ''
+            if now['seconds'] > old['seconds'] * (1 + threshold) and now['seconds'] - old['seconds'] > 1e-4:
+                flag = 'SLOWER'
+            elif now['alloc_kb'] > old['alloc_kb'] * (1 + threshold) and now['alloc_kb'] - old['alloc_kb'] > 64:
+                flag = 'ALLOC'
+            regressions += bool(flag)
+        rows.append([name, now['seconds'] * 1e3, now['alloc_kb'], now['rss_kb'], ratio, flag])
+    print(''.join('%16s' % h for h in ['ms', 'alloc kb', 'rss +kb', 'vs base', '']) + '  case')
+    for row in rows:
+        print(''.join('%16s' % (('%.2f' % v) if isinstance(v, float) else v) for v in row[1:]) + '  ' + row[0])
+    if save:
+        import numpy
+        import pandas
+        meta = OrderedDict([('python', platform.python_version()), ('numpy', numpy.__version__),
+                            ('pandas', pandas.__version__), ('platform', platform.platform()),
+                            ('created', time.strftime('%Y-%m-%d %H:%M:%S'))])
+        with open(save, 'w') as f:
+            json.dump(OrderedDict([('meta', meta), ('cases', results)]), f, indent=1)
+    if baseline:
+        print('\n%d of %d cases regressed beyond %d%%' % (regressions, len(results), threshold * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='offline benchmarks for the _PyContextInfo wrapper layer')
+    parser.add_argument('names', nargs='*', help='cases to run, all by default')
+    parser.add_argument('--suite', action='store_true', help='run the measured accessor suite')
+    parser.add_argument('--save', metavar='FILE', help='write the suite results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the suite against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if args.suite:
+        sys.exit(run_suite(args.names, args.save, args.baseline, args.threshold, args.repeat))
+    for name in args.names or list(BENCHES):
+        BENCHES[name]()
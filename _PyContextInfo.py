@@ -1,9 +1,14 @@
 #coding:utf-8
 from functools import wraps
 import copy
+import itertools
+import numbers
+import sys
+import threading
 import traceback
 import time
 import datetime as dt
+from collections import OrderedDict
 from typing import Callable, Union
 
 hint_get_history_data = True
@@ -15,6 +20,15 @@ class __PyContext(object):
         self.context = contextinfo
         self.z8sglma_last_version = None
         self.z8sglma_last_barpos = -1
+        self.z8sglma_cow = None
+        self.z8sglma_option_index = _OptionIndex()
+        self.z8sglma_instruments = _InstrumentCache()
+        self.z8sglma_whole_quote = {}
+        self.z8sglma_timeline = None
+        self.z8sglma_history = _HistoryCache()
+        self.z8sglma_indicators = _IndicatorEngine()
+        self.z8sglma_profiler = None
+        self.z8sglma_factors = _StyleFactorEngine()
         self.subMap = {}
 
     def set_account(self, acct):
@@ -22,6 +36,8 @@ class __PyContext(object):
 
     def set_universe(self, universe):
         last_universe = self.context.get_universe();
+        self.z8sglma_instruments.prefetch(self.context, universe)
+        self.z8sglma_history.clear()
         universe = list(set(universe).difference(set(last_universe)));
         self.context.set_universe(universe)
 
@@ -39,7 +55,57 @@ class __PyContext(object):
         if hint_get_history_data:
             print ("get_history_data接口版本较老，推荐使用get_market_data_ex替代，配合download_history_data补充昨日以前的历史数据")
             hint_get_history_data = False
-        return self.context.get_history_data(len, period, field, dividend_type, skip_paused)
+        if not isinstance(field, str):
+            return self.context.get_history_data(len, period, field, dividend_type, skip_paused)
+        return self.z8sglma_history.get(self.context, len, period, field, dividend_type, skip_paused)
+
+    def clear_history_cache(self, field = None, dividend_type = None):
+        # drop cached get_history_data windows, e.g. after an ex-dividend day for adjusted series;
+        # None matches every field / dividend_type
+        self.z8sglma_history.clear(field, dividend_type)
+
+    def get_history_cache_info(self):
+        return self.z8sglma_history.info()
+
+    def get_indicator(self, kind, stock, window, period='1d', dividend_type='none'):
+        # streaming 'sma' / 'ema' / 'slope' over close, or 'atr' (window is the ATR period,
+        # looking back twice as many bars), updated with only the bars added since the last
+        # call; None until enough bars are seen
+        return self.z8sglma_indicators.get(self.context, self.z8sglma_history, kind, stock, window, period, dividend_type)
+
+    def get_indicator_info(self):
+        return self.z8sglma_indicators.info()
+
+    def get_style_factors(self, stock_list, start_time='', end_time='', factors=None, risk_free=None,
+                          dividend_type='follow'):
+        # CMRA / DASTD / HSIGMA / STOM / STOQ / STOA as defined by the factor scripts, for every
+        # stock at once: {factor: DataFrame(dates x stocks)} over [start_time, end_time], both
+        # defaulting to the current bar's date. risk_free (annual %) replaces the terminal's rate
+        return self.z8sglma_factors.compute(self, stock_list, start_time, end_time, factors, risk_free, dividend_type)
+
+    def enable_profiling(self, path='', paint=False, every=0, window=250, namespace=None, top=5):
+        # time every public ContextInfo method, and the trading functions found in
+        # `namespace` (pass the strategy's globals()), until disable_profiling. A JSON summary
+        # line is appended to `path` every `every` bars (default: window); paint=True draws the
+        # `top` heaviest methods' ms per bar as 'prof:<method>' lines
+        # Only one ContextInfo per process can be profiled at a time
+        self.disable_profiling()
+        profiler = _MethodProfiler(path, paint, every, window, top)
+        profiler.install(_PyContextBase, self, namespace)
+        self.z8sglma_profiler = profiler
+
+    def disable_profiling(self):
+        profiler = self.z8sglma_profiler
+        if profiler is None:
+            return
+        profiler.uninstall()
+        if profiler.path:
+            profiler.export()
+        self.z8sglma_profiler = None
+
+    def get_profile_summary(self):
+        profiler = self.z8sglma_profiler
+        return profiler.summary() if profiler is not None else []
 
     def get_industry(self, industry_name, real_timetag = -1):
         return self.context.get_industry(industry_name, real_timetag)
@@ -72,8 +138,22 @@ class __PyContext(object):
         return self.context.get_largecap()
 
     def get_bar_timetag(self, index):
+        timeline = self.z8sglma_timeline
+        if timeline is not None and 0 <= index < len(timeline):
+            return timeline.timetag(index)
         return self.context.get_bar_timetag(index)
 
+    def get_bar_timeline(self):
+        # every bar's timetag is read from the terminal once per run; bars that appear
+        # later (realtime) are appended on the next call
+        timeline = self.z8sglma_timeline
+        if timeline is None:
+            timeline = self.z8sglma_timeline = BarTimeline([])
+        size = self.context.time_tick_size
+        if len(timeline) < size:
+            timeline.extend([self.context.get_bar_timetag(i) for i in range(len(timeline), size)])
+        return timeline
+
     def get_tick_timetag(self):
         return self.context.get_tick_timetag()
 
@@ -133,7 +213,7 @@ class __PyContext(object):
         return self.context.get_close_price(market, stockCode, realTimetag, period, dividType)
 
     def get_market_data_ex(self, fields=[], stock_code=[], period='follow', start_time='', end_time='', count=-1,
-                         dividend_type='follow', fill_data=True, subscribe=True):
+                         dividend_type='follow', fill_data=True, subscribe=True, result_type=''):
         ori_data = self.context.get_market_data2(
             fields
             , stock_code, period
@@ -141,7 +221,10 @@ class __PyContext(object):
             , dividend_type, fill_data
             , subscribe
         )
-        
+
+        if result_type.lower() == 'panel':
+            return _build_market_panel(ori_data, fields, stock_code)
+
         import pandas as pd
         result = {}
 
@@ -169,6 +252,33 @@ class __PyContext(object):
 
         return result
 
+    def get_history_bundle(self, stocks, fields, count, period='1d', dividend_type='follow', end_time=''):
+        # several fields of several stocks in one native request, up to the current bar by default;
+        # {stock: structured array} with an 'stime' field plus one float field per requested
+        # field, every stock on the same time axis (nan where a stock has no bar)
+        import numpy as np
+        if isinstance(stocks, str):
+            stocks = [stocks]
+        if isinstance(fields, str):
+            fields = [fields]
+        if not end_time:
+            end_time = timetag_to_datetime(self.get_bar_timetag(self.barpos), '%Y%m%d%H%M%S')
+        ori_data = self.context.get_market_data2(fields, stocks, period, '', end_time, count, dividend_type, True, True)
+        panel = _build_market_panel(ori_data, fields, stocks)
+        dtype = [('stime', panel.stime.dtype if panel.stime.size else '<U14')] + [(f, np.float64) for f in panel.fields]
+        result = OrderedDict()
+        for code in stocks:
+            i = panel.code_index.get(code)
+            if i is None:
+                result[code] = np.zeros(0, dtype=dtype)
+                continue
+            bundle = np.empty(len(panel.stime), dtype=dtype)
+            bundle['stime'] = panel.stime
+            for j, f in enumerate(panel.fields):
+                bundle[f] = panel.data[i, :, j]
+            result[code] = bundle
+        return result
+
     def get_market_data_ex_ori(self, fields=[], stock_code=[], period='follow', start_time='', end_time='', count=-1,
                          dividend_type='follow', fill_data=True, subscribe=True):
         oriData = self.context.get_market_data2(
@@ -188,33 +298,31 @@ class __PyContext(object):
             hint_get_market_data = False
         oriData = self.context.get_market_data(fields, stock_code, start_time, end_time, skip_paused, period,
                                                dividend_type, count)
-        resultDict = {}
-        for code in oriData:
-            for timenode in oriData[code]:
-                values = []
-                for field in fields:
-                    values.append(oriData[code][timenode][field])
-                key = code + timenode
-                resultDict[key] = values
+        from operator import itemgetter
+        if len(fields) == 1:
+            field = fields[0]
+            getter = lambda node: (node[field],)
+        else:
+            getter = itemgetter(*fields)
         if len(fields)==1 and len(stock_code)<=1 and ((start_time=='' and end_time=='') or start_time==end_time) and count==-1:
-            for key in resultDict:
-                return resultDict[key][0]
+            for code in oriData:
+                for timenode in oriData[code]:
+                    return oriData[code][timenode][fields[0]]
             return -1
         import numpy as np
         import pandas as pd
         if len(stock_code) <= 1 and start_time == '' and end_time == '' and count == -1:
-            for key in resultDict:
-                result = pd.Series(resultDict[key], index=fields)
-                return result.sort_index()
+            for code in oriData:
+                for timenode in oriData[code]:
+                    result = pd.Series(getter(oriData[code][timenode]), index=fields)
+                    return result.sort_index()
+            return
         if len(stock_code) > 1 and start_time == '' and end_time == '' and count == -1:
             values = []
             for code in stock_code:
-                if code in oriData:
-                    if not oriData[code]:
-                        values.append([np.nan])
-                    for timenode in oriData[code]:
-                        key = code + timenode
-                        values.append(resultDict[key])
+                nodes = oriData.get(code)
+                if nodes:
+                    values.extend(map(getter, nodes.values()))
                 else:
                     values.append([np.nan])
             result = pd.DataFrame(values, index=stock_code, columns=fields)
@@ -223,25 +331,29 @@ class __PyContext(object):
             values = []
             times = []
             for code in oriData:
-                for timenode in oriData[code]:
-                    key = code + timenode
-                    times.append(timenode)
-                    values.append(resultDict[key])
+                times.extend(oriData[code])
+                values.extend(map(getter, oriData[code].values()))
             result = pd.DataFrame(values, index=times, columns=fields)
             return result.sort_index()
         if len(stock_code) > 1 and ((start_time != '' or end_time != '') or count >= 0):
-            values = {}
-            for code in stock_code:
-                times = []
-                value = []
-                if code in oriData:
-                    for timenode in oriData[code]:
-                        key = code + timenode
-                        times.append(timenode)
-                        value.append(resultDict[key])
-                values[code]=pd.DataFrame(value,index=times,columns=fields).sort_index()
-            result = pd.Panel(values)
-            return result
+            # index = (stock, time), col = fields; result.values.reshape(stocks, times, fields) is the 3-D block
+            codes = sorted(set(stock_code))
+            times = sorted(set().union(*[oriData[code] for code in codes if code in oriData]))
+            tpos = {t: i for i, t in enumerate(times)}
+            block = None
+            for i, code in enumerate(codes):
+                nodes = oriData.get(code)
+                if not nodes:
+                    continue
+                rows = np.array(list(map(getter, nodes.values())))
+                if block is None:
+                    dtype = float if rows.dtype.kind in 'biuf' else object
+                    block = np.full((len(codes), len(times), len(fields)), np.nan, dtype=dtype)
+                block[i, [tpos[t] for t in nodes]] = rows
+            if block is None:
+                block = np.full((len(codes), len(times), len(fields)), np.nan)
+            index = pd.MultiIndex.from_product([codes, times], names=['stock', 'time'])
+            return pd.DataFrame(block.reshape(-1, len(fields)), index=index, columns=fields)
         return
 
     def get_full_tick(self, stock_code=[]):
@@ -256,9 +368,11 @@ class __PyContext(object):
         return self.context.load_stk_list(dirfile, namefile)
     def load_stk_vol_list(self, dirfile, namefile):
         return self.context.load_stk_vol_list(dirfile, namefile)
-    def get_longhubang(self, stock_list=[], startTime='', endTime='', count=-1):
+    def get_longhubang(self, stock_list=[], startTime='', endTime='', count=-1, result_type=''):
+        # result_type '' keeps the booth sub-frames nested in buyTraderBooth / sellTraderBooth;
+        # 'table' returns (records, booths), booths keyed back to records by 'record'
+        import numpy as np
         import pandas as pd
-        resultDf = pd.DataFrame()
         if isinstance(endTime, int):
             count = endTime
             endTime = startTime
@@ -270,31 +384,42 @@ class __PyContext(object):
                   'Turnover_Amount', "buyTraderBooth", "sellTraderBooth"]
         tradeBoothItemFiled = ["traderName", "buyAmount", "buyPercent", "sellAmount", "sellPercent", "totalAmount",
                                "rank", "direction"]
+        columns = [[] for i in range(8)]
+        index = []
+        booths = OrderedDict([('record', []), ('side', [])])
+        for name in tradeBoothItemFiled:
+            booths[name] = []
         for stock in resultDict:
             stockDict = resultDict[stock]
-            stockDf = pd.DataFrame()
             if len(stockDict.keys()) < 10:
                 continue
-            buyTradeBoothDict = stockDict[8]
-            sellTradeBoothDict = stockDict[9]
-            buyTradeBoothPdList = []
-            sellTradeBoothPdList = []
-            for TradeBoothIDict in buyTradeBoothDict:
-                buyTradeBoothPd = pd.DataFrame()
-                for tradeBoothKey in TradeBoothIDict.keys():
-                    buyTradeBoothPd[tradeBoothItemFiled[tradeBoothKey]] = TradeBoothIDict[tradeBoothKey]
-                buyTradeBoothPdList.append(buyTradeBoothPd)
-            for TradeBoothIDict in sellTradeBoothDict:
-                sellTradeBoothPd = pd.DataFrame()
-                for tradeBoothKey in TradeBoothIDict.keys():
-                    sellTradeBoothPd[tradeBoothItemFiled[tradeBoothKey]] = TradeBoothIDict[tradeBoothKey]
-                sellTradeBoothPdList.append(sellTradeBoothPd)
+            start = len(columns[0])
             for i in range(0, 8):
-                stockDf[fields[i]] = stockDict[i]
-            stockDf[fields[8]] = buyTradeBoothPdList
-            stockDf[fields[9]] = sellTradeBoothPdList
-            resultDf = resultDf.append(stockDf)
-        return resultDf
+                columns[i].extend(stockDict[i])
+            index.extend(range(len(columns[0]) - start))
+            for side, key in (('buy', 8), ('sell', 9)):
+                for row, TradeBoothIDict in enumerate(stockDict[key]):
+                    size = len(next(iter(TradeBoothIDict.values()), []))
+                    booths['record'].extend([start + row] * size)
+                    booths['side'].extend([side] * size)
+                    for k, name in enumerate(tradeBoothItemFiled):
+                        booths[name].extend(TradeBoothIDict.get(k, [None] * size))
+        records = pd.DataFrame(OrderedDict(zip(fields[:8], columns)))
+        booths = pd.DataFrame(booths)
+        if result_type == 'table':
+            return records, booths
+        # one split of the child table instead of a DataFrame build per booth list
+        cells = np.empty(2 * len(records), dtype=object)
+        keys = 2 * booths['record'].to_numpy() + (booths['side'].to_numpy() == 'sell')
+        for key, part in booths[tradeBoothItemFiled].groupby(keys, sort=False):
+            part.index = pd.RangeIndex(len(part))
+            cells[key] = part
+        for i in np.flatnonzero(pd.isnull(cells)):
+            cells[i] = pd.DataFrame()
+        records[fields[8]] = cells[0::2]
+        records[fields[9]] = cells[1::2]
+        records.index = index
+        return records
 
     def get_main_contract(self, codemarket):
         return self.context.get_main_contract(codemarket)
@@ -334,63 +459,15 @@ class __PyContext(object):
             return
         if type(fieldList) == str and type(stockList) == str:
             return self.context.get_financial_data(fieldList, stockList, startDate, endDate, report_type, pos)
-        import pandas as pd
-        from collections import OrderedDict
 
         pandasData = self.context.get_financial_data(fieldList, stockList, startDate, endDate, report_type,'dict',False)
         if not pandasData:
             return
-        fields = pandasData['field']
-        stocks = pandasData['stock']
-        dates = pandasData['date']
-        values = pandasData['value']
-
-        if len(stocks) == 1 and len(dates) == 1:    #series
-            series_list = []
-            for value in values:
-                if not value:
-                    return
-                for subValue in value:
-                    series_list.append(subValue)
-            return pd.Series(series_list, index = fields)
-        elif len(stocks) == 1 and len(dates) > 1:   #index = dates, col = fields
-            dataDict = OrderedDict()
-            for n in range(len(values)):
-                dataList = []
-                if not values[n]:
-                    return
-                for subValue in values[n]:
-                    dataList.append(subValue)
-                dataDict[fields[n]] = pd.Series(dataList, index = dates)
-            return pd.DataFrame(dataDict)
-        elif len(stocks) > 1 and len(dates) == 1:   #index = stocks col = fields
-            dataDict = OrderedDict()
-            for n in range(len(values)):
-                dataList = []
-                if not values[n]:
-                    return
-                for subValue in values[n]:
-                    dataList.append(subValue)
-                dataDict[fields[n]] = pd.Series(dataList, index = stocks)
-            return pd.DataFrame(dataDict)
-        else:                                       #item = stocks major = dates minor = fields
-            panels = OrderedDict()
-            for i in range(len(stocks)):
-                dataDict = OrderedDict()
-                for j in range(len(values)):
-                    dataList = []
-                    value = values[j]
-                    if not value:
-                        return
-                    for k in range(i * len(dates), (i + 1) * len(dates)):
-                        dataList.append(value[k])
-                    dataDict[fields[j]] = pd.Series(dataList, index = dates)
-                panels[stocks[i]] = pd.DataFrame(dataDict)
-            return pd.Panel(panels)
+        #item = stocks major = dates minor = fields -> index = (stock, date), col = fields
+        return _build_field_values(pandasData['field'], pandasData['stock'], pandasData['date'], pandasData['value'], 'frame')
 
     def get_top10_share_holder(self, stock_list, data_name,start_time,end_time, report_type='report_time'):
         import pandas as pd
-        resultPanelDict = {}
         resultDict ={}
         if (report_type != 'announce_time' and report_type != 'report_time'):
             return "input report_type = \'report_time\' or report_type = \'announce_time\'"
@@ -399,34 +476,36 @@ class __PyContext(object):
         else:
             return "input data_name = \'flow_holder\' or data_name = \'holder\'"
         fields = ["holdName","holderType","holdNum","changReason","holdRatio","stockType","rank","status","changNum","changeRatio"]
-        for stock in resultDict:
-            stockPdData = pd.DataFrame(columns = fields)
+        stocks = sorted(resultDict)
+        stockKeys = []
+        timeKeys = []
+        rows = []
+        for stock in stocks:
             stockDict = resultDict[stock]
-            for timeKey in list(stockDict.keys()):
-                timelist = stockDict[timeKey]
-                stockPdData.loc[timeKey] =  timelist
-            resultPanelDict[stock] = stockPdData
-        resultPanel = pd.Panel(resultPanelDict)
+            stockKeys.extend([stock] * len(stockDict))
+            timeKeys.extend(stockDict.keys())
+            rows.extend(stockDict.values())
+        frame = pd.DataFrame(rows, columns = fields)
+        frame.index = pd.MultiIndex.from_arrays([stockKeys, timeKeys], names = ['stock', 'time'])
+        times = sorted(set(timeKeys))
         stockNum = len(stock_list)
-        timeNum = len(resultPanel.major_axis)
+        timeNum = len(times)
         if(stockNum == 1 and timeNum == 1):
-            stock = resultPanel.items[0]
-            timetag = resultPanel.major_axis[0]
-            df = pd.DataFrame(resultPanel[stock])
-            result = pd.Series(df.ix[timetag],index = fields)
+            result = frame.iloc[0]
+            result.name = times[0]
             return result
         elif(stockNum > 1 and timeNum == 1):
-            timetag = resultPanel.major_axis[0]
-            result = pd.DataFrame(resultPanel.major_xs(timetag),index =  fields,columns = resultPanel.items);
-            result = result.T
-            return  result
+            result = frame.droplevel('time').reindex(stocks)
+            result.index.name = None
+            return result
         elif(stockNum == 1 and timeNum > 1):
-            stock = resultPanel.items[0]
-            result = pd.DataFrame(resultPanel[stock])
+            result = frame.loc[stocks[0]].reindex(times)
+            result.index.name = None
             return result
         elif(stockNum > 1 and timeNum > 1):
-            return resultPanel
-        return pd.Panel()
+            #item = stocks major = times minor = fields -> index = (stock, time), col = fields
+            return frame.reindex(pd.MultiIndex.from_product([stocks, times], names = ['stock', 'time']))
+        return pd.DataFrame(columns = fields)
 
     def get_product_asset_value(self, code, index=-1):
         return self.context.get_product_asset_value(code, index)
@@ -441,14 +520,19 @@ class __PyContext(object):
         fields = ["stockCode","timetag","holdNum","AHoldNum","BHoldNum","HHoldNum","uncirculatedHoldNum","circulatedHoldNum"];
         if (report_type != 'announce_time' and report_type != 'report_time'):
             return "input report_type = \'report_time\' or report_type = \'announce_time\'"
+        import numpy as np
         import pandas as pd
         resultDict = get_holder_number(stock_list, startTime, endTime, report_type)
-        result  =  pd.DataFrame()
+        columns = [[] for field in fields]
+        index = []
         for stock in resultDict:
-            df = pd.DataFrame(columns = fields)
-            for i in  resultDict[stock]:
-                df[fields[i]]=resultDict[stock][i]
-            result = result.append(df)
+            stockDict = resultDict[stock]
+            rows = len(next(iter(stockDict.values()), []))
+            for i in range(len(fields)):
+                columns[i].extend(stockDict.get(i, [np.nan] * rows))
+            index.extend(range(rows))
+        result = pd.DataFrame(OrderedDict(zip(fields, columns)))
+        result.index = index
         return result
 
     def paint(self, name, data, index, drawStyle, selectcolor='', limit=''):
@@ -499,40 +583,34 @@ class __PyContext(object):
         self.context.run_time(funcname, intervalday, time, exchange)
 
     def get_function_line(self):
-        import sys
-        return sys._getframe().f_back.f_lineno
+        return _call_site_line()
 
     def get_trading_dates(self, stockcode, start_date, end_date, count, period='1d'):
         return self.context.get_trading_dates(stockcode, start_date, end_date, count, period)
 
     def draw_text(self, condition, position, text, limit=''):
-        import sys
-        line = sys._getframe().f_back.f_lineno
+        line = _call_site_line()
         if 'noaxis' == limit.lower():
             return self.context.draw_text(condition, position, text, line, 0)
         else:
             return self.context.draw_text(condition, position, text, line, 1)
 
     def draw_vertline(self, condition, price1, price2, color='', limit=''):
-        import sys
-        line = sys._getframe().f_back.f_lineno
-
+        line = _call_site_line()
         if 'noaxis' == limit.lower():
             return self.context.draw_vertline(condition, price1, price2, color, line, 0)
         else:
             return self.context.draw_vertline(condition, price1, price2, color, line, 1)
 
     def draw_icon(self, condition, position, type, limit=''):
-        import sys
-        line = sys._getframe().f_back.f_lineno
+        line = _call_site_line()
         if (('noaxis' == limit.lower())):
             return self.context.draw_icon(condition, position, type, line, 0)
         else:
             return self.context.draw_icon(condition, position, type, line, 1)
 
     def draw_number(self, cond, price, number, precision, limit=''):
-        import sys
-        line = sys._getframe().f_back.f_lineno
+        line = _call_site_line()
         if (('noaxis' == limit.lower())):
             return self.context.draw_number(cond, price, number, precision, line, 0)
         else:
@@ -602,7 +680,7 @@ class __PyContext(object):
             , 'HSGTFlag'
         ]
 
-        inst = self.context.get_instrumentdetail(marketCode)
+        inst = self.z8sglma_instruments.get(self.context, marketCode)
 
         ret = {}
         for field in field_list:
@@ -612,7 +690,7 @@ class __PyContext(object):
 
     
     def get_option_undl(self, opt_code):
-        inst = self.context.get_instrumentdetail(opt_code)
+        inst = self.z8sglma_instruments.get(self.context, opt_code)
         if inst and 'ExtendInfo' in inst:
             ext_info = inst['ExtendInfo']
             undl_code_ref = str(ext_info['OptUndlCode']) + '.' + str(ext_info['OptUndlMarket'])
@@ -624,34 +702,24 @@ class __PyContext(object):
         return
 
     def get_option_undl_data(self, undl_code_ref = ''):
+        index = self.z8sglma_option_index
         if undl_code_ref:
-            opt_list = []
+            sector = ''
             if undl_code_ref.endswith('.SH'):
                 if undl_code_ref == "000016.SH" or undl_code_ref == "000300.SH" or undl_code_ref == "000852.SH" or undl_code_ref == "000905.SH":
-                    opt_list = get_stock_list_in_sector('中金所')
+                    sector = '中金所'
                 else:
-                    opt_list = self.get_stock_list_in_sector('上证期权')
+                    sector = '上证期权'
             if undl_code_ref.endswith('.SZ'):
-                opt_list = self.get_stock_list_in_sector('深证期权')
-            data = []
-            for opt_code in opt_list:
-                undl_code = self.get_option_undl(opt_code)
-                if undl_code == undl_code_ref:
-                    data.append(opt_code)
-            return data
+                sector = '深证期权'
+            if not sector:
+                return []
+            return list(index.underlyings(self, sector).get(undl_code_ref, []))
         else:
-            opt_list = []
-            opt_list += self.get_stock_list_in_sector('上证期权')
-            opt_list += self.get_stock_list_in_sector('深证期权')
-            opt_list += self.get_stock_list_in_sector('中金所')
             result = {}
-            for opt_code in opt_list:
-                undl_code = self.get_option_undl(opt_code)
-                if undl_code:
-                    if undl_code in result:
-                        result[undl_code].append(opt_code)
-                    else:
-                        result[undl_code] = [opt_code]
+            for sector in ('上证期权', '深证期权', '中金所'):
+                for undl_code, opt_list in index.underlyings(self, sector).items():
+                    result.setdefault(undl_code, []).extend(opt_list)
             return result
 
     def get_option_list(self,object,dedate,opttype = "",isavailavle = False):
@@ -664,89 +732,70 @@ class __PyContext(object):
             return [];
         undlCode = marketcodeList[0]
         undlMarket = marketcodeList[1];
-        market = ""
-        if(undlMarket == "SH"):
-            if undlCode == "000016" or undlCode == "000300" or undlCode == "000852" or undlCode == "000905":
-                market = 'IF'
-            else:
-                market = "SHO"
-        elif(undlMarket == "SZ"):
-            market = "SZO";
+        market = _option_market(undlCode, undlMarket)
         if(opttype.upper() == "C"):
             opttype = "CALL"
         elif(opttype.upper() == "P"):
             opttype = "PUT"
-        optList = []
-        if market == 'SHO':
-            optList += get_stock_list_in_sector('上证期权')
-            hisList = get_stock_list_in_sector('过期上证期权')
-            if len(hisList) <= 0:
-                hisList = self.get_his_contract_list(market)
-            optList += hisList
-        elif market == 'SZO':
-            optList += get_stock_list_in_sector('深证期权')
-            hisList = get_stock_list_in_sector('过期深证期权')
-            if len(hisList) <= 0:
-                hisList = self.get_his_contract_list(market)
-            optList += hisList
-        elif market == 'IF':
-            optList += get_stock_list_in_sector('中金所')
-            hisList = get_stock_list_in_sector('过期中金所')
-            if len(hisList) <= 0:
-                hisList = self.get_his_contract_list(market)
-            optList += hisList
-        for opt in optList:
-            if(opt.find(market) < 0):
-                continue
-            inst = self.context.get_instrumentdetail(opt);
-            if('ExtendInfo' not in inst):
-                continue;
-            if(opttype.upper()  != "" and  opttype.upper() != inst['ExtendInfo']["optType"]):
-                continue;
-            if( (len(dedate) == 6 and str(inst['ExpireDate']).find(dedate) < 0)  ):
-                continue
-            if( len(dedate) == 8): #option is trade,guosen demand
-                createDate = inst['CreateDate'];
-                openDate = inst['OpenDate'];
-                if(createDate >= 1):
-                    openDate = min(openDate,createDate);
-                if(openDate < 20150101 or str(openDate) > dedate):
-                    continue
-                endDate = inst['ExpireDate'];
-                if( isavailavle and  str(endDate) < dedate):
-                    continue;
-            if(inst['ProductID'].find(undlCode) > 0 or inst['ExtendInfo']['OptUndlCode'] == undlCode):
-                result.append(opt);
-        return result;
-
+        if market == "":
+            return result
+        chain = self.z8sglma_option_index.chain(self, market, undlCode)
+        return chain.select(opttype.upper(), dedate, isavailavle)
+
+    def get_option_chain(self, object):
+        # {expire month: {'CALL': [...], 'PUT': [...]}} of every listed and expired contract
+        marketcodeList = object.split('.')
+        if(len(marketcodeList) != 2):
+            return {}
+        market = _option_market(marketcodeList[0], marketcodeList[1])
+        if market == "":
+            return {}
+        return self.z8sglma_option_index.chain(self, market, marketcodeList[0]).tree()
+
+    def get_instrument_cache_info(self):
+        return self.z8sglma_instruments.info()
+
+    def refresh_instrument_cache(self):
+        # drop the trading date's instrument details, e.g. after an intraday contract change
+        self.z8sglma_instruments.invalidate()
+
+    def refresh_option_index(self, prefetch=False):
+        # re-read the option sector lists, e.g. after new contracts list intraday;
+        # only contracts not seen before are fetched again
+        self.z8sglma_option_index.invalidate()
+        if prefetch:
+            self.z8sglma_option_index.prefetch(self)
 
     def bsm_price(self,optType,targetPrice,strikePrice,riskFree,sigma,days,dividend = 0):
-        optionType = "";
-        if(optType.upper() == "C"):
-            optionType = "CALL"
-        if(optType.upper() == "P"):
-            optionType = "PUT"
+        if type(optType) == str and all(isinstance(a, numbers.Number) for a in (targetPrice,strikePrice,riskFree,sigma,days,dividend)):
+            return round(_bsm_price_scalar(optType,targetPrice,strikePrice,riskFree,sigma,days,dividend),4)
+        import numpy as np
+        bsmPrice = bsm_greeks(optType,targetPrice,strikePrice,riskFree,sigma,days,dividend)['price']
+        bsmPrice = np.round(bsmPrice,4)
         if(type(targetPrice) == list):
-            result = [];
-            for price in targetPrice:
-                bsmPrice= calc_bsm_price(optionType,strikePrice,float(price),riskFree,sigma,days,dividend)
-                bsmPrice = round(bsmPrice,4)
-                result.append(bsmPrice);
-            return result;
-        else:
-            bsmPrice = calc_bsm_price(optionType,strikePrice,targetPrice,riskFree,sigma,days,dividend)
-            result = round(bsmPrice,4)
-            return result;
+            return bsmPrice.tolist() if bsmPrice.ndim else [float(bsmPrice)]
+        if bsmPrice.ndim == 0:
+            return float(bsmPrice)
+        return bsmPrice
+
+    def bsm_greeks(self,optType,targetPrice,strikePrice,riskFree,sigma,days,dividend = 0):
+        return bsm_greeks(optType,targetPrice,strikePrice,riskFree,sigma,days,dividend)
 
     def bsm_iv(self,optType,targetPrice,strikePrice,optionPrice,riskFree,days,dividend = 0):
-        if(optType.upper() == "C"):
-            optionType = "CALL"
-        if(optType.upper() == "P"):
-            optionType = "PUT"
-        result = calc_bsm_iv(optionType,strikePrice,targetPrice,optionPrice,riskFree,days,dividend)
+        # the model bsm_price prices with, so bsm_iv(bsm_price(...)) returns sigma; nan when
+        # optionPrice is outside the no-arbitrage bounds
+        result = float(bsm_iv_batch(optType,targetPrice,strikePrice,optionPrice,riskFree,days,dividend))
         result = round(result,4)
         return result
 
+    def bsm_iv_batch(self,optType,targetPrice,strikePrice,optionPrice,riskFree,days,dividend = 0):
+        return bsm_iv_batch(optType,targetPrice,strikePrice,optionPrice,riskFree,days,dividend)
+
+    def bsm_iv_surface(self,optType,targetPrice,strikePrice,optionPrice,riskFree,days,dividend = 0):
+        import numpy as np
+        iv = bsm_iv_batch(optType,targetPrice,strikePrice,optionPrice,riskFree,days,dividend)
+        return IVSurface(np.asarray(strikePrice, dtype=float) / np.asarray(targetPrice, dtype=float), days, iv)
+
     def get_his_st_data(self,stockCode):
         #tradeDateList = ContextInfo.get_trading_dates(stockCode,'19900101','20380119',1,'1d')
         import json;
@@ -865,15 +914,38 @@ class __PyContext(object):
             # contextInfo variable is from c++, not copy
             if k == "context":
                 setattr(new_obj, k, v)
-            elif k == "z8sglma_last_version":
+            elif _is_internal_attr(k):
                 continue
             else:
                 setattr(new_obj, k, copy.deepcopy(v, memo))
         return new_obj
+
+    def set_snapshot_mode(self, mode='deepcopy'):
+        # 'deepcopy': snapshot the whole context every new bar (default)
+        # 'cow': journal changes to dict/list attributes and roll them back on re-run
+        if mode == 'cow':
+            if self.z8sglma_cow is None:
+                self.z8sglma_cow = _CowSnapshot()
+                self.__class__ = _CowPyContext
+                for k, v in list(self.__dict__.items()):
+                    if not _is_internal_attr(k):
+                        setattr(self, k, v)
+                self.z8sglma_last_barpos = -1
+            self.z8sglma_last_version = None
+        elif mode == 'deepcopy':
+            if self.z8sglma_cow is not None:
+                self.z8sglma_cow = None
+                self.__class__ = _PyContextBase
+                for k, v in list(self.__dict__.items()):
+                    if isinstance(v, _COW_TYPES):
+                        setattr(self, k, v._cow_plain(v))
+                # no snapshot of the current bar yet: the next run takes one
+                self.z8sglma_last_barpos = -1
+        else:
+            raise ValueError("mode must be 'deepcopy' or 'cow'")
+        return
         
     def get_factor_data(self, field_list, stock_list, start_date, end_date):
-        import pandas as pd
-        from collections import OrderedDict
         stocks = []
         if type(stock_list) == str:
             stocks.append(stock_list)
@@ -882,57 +954,20 @@ class __PyContext(object):
         pandasData = get_factor_datas(field_list, stocks, start_date, end_date)
         if not pandasData:
             return
-        fields = pandasData['field']
-        dates = pandasData['date']
-        values = pandasData['value']
-        
-        if len(stocks) == 1 and len(dates) == 1:    #series
-            series_list = []
-            for value in values:
-                if not value:
-                    return
-                for subValue in value:
-                    series_list.append(subValue)
-            return pd.Series(series_list, index = fields)
-        elif len(stocks) == 1 and len(dates) > 1:   #index = dates, col = fields
-            dataDict = OrderedDict()
-            for n in range(len(values)):
-                dataList = []
-                if not values[n]:
-                    return
-                for subValue in values[n]:
-                    dataList.append(subValue)
-                dataDict[fields[n]] = pd.Series(dataList, index = dates)
-            return pd.DataFrame(dataDict)
-        elif len(stocks) > 1 and len(dates) == 1:   #index = stocks col = fields
-            dataDict = OrderedDict()
-            for n in range(len(values)):
-                dataList = []
-                if not values[n]:
-                    return
-                for subValue in values[n]:
-                    dataList.append(subValue)
-                dataDict[fields[n]] = pd.Series(dataList, index = stocks)
-            return pd.DataFrame(dataDict)
-        else:                                       #Key = stocks value = df(index = dates, col = fields)
-            panels = OrderedDict()
-            for i in range(len(stocks)):
-                dataDict = OrderedDict()
-                for j in range(len(values)):
-                    dataList = []
-                    value = values[j]
-                    if not value:
-                        return
-                    for k in range(i * len(dates), (i + 1) * len(dates)):
-                        dataList.append(value[k])
-                    dataDict[fields[j]] = pd.Series(dataList, index = dates)
-                panels[stocks[i]] = pd.DataFrame(dataDict)
-            return panels
+        #Key = stocks value = df(index = dates, col = fields)
+        return _build_field_values(pandasData['field'], stocks, pandasData['date'], pandasData['value'], 'dict')
     
-    def subscribe_quote(self, stock_code, period = 'follow', dividend_type = 'follow', result_type = '', callback = None):
+    def subscribe_quote(self, stock_code, period = 'follow', dividend_type = 'follow', result_type = '', callback = None, ring_size = 1000):
         if callback:
             callback1 = callback
-            if result_type.lower() == 'dict':
+            if result_type.lower() == 'ring':
+                # last ring_size bars as a read-only structured array, updated in place per push
+                ring = _QuoteRing(ring_size)
+                def on_quote_wrapper(datas):
+                    callback1({stock_code : ring.push(datas)})
+                    return
+                callback = on_quote_wrapper
+            elif result_type.lower() == 'dict':
                 def on_quote_wrapper(datas):
                     if datas.get('time', None):
                         callback1({stock_code : {k: v[-1] for k, v in datas.items()}})
@@ -963,23 +998,47 @@ class __PyContext(object):
             self.subMap[subID] = subInfo
         return subID
         
-    def subscribe_whole_quote(self, code_list, callback = None):
+    def subscribe_whole_quote(self, code_list, callback = None, window = 0, maxsize = 0):
+        # window > 0 (ms): pushes inside the window are merged per code, latest snapshot wins,
+        # and delivered as one dict on the first push after the window, or by the next
+        # handlebar if no push comes; maxsize bounds the codes held back, dropping the least
+        # recently updated
+        dispatcher = None
         if callback:
             callback1 = callback
-            def on_quote_wrapper(datas):
-                callback1(datas)
-                return
-            callback = on_quote_wrapper
+            if window > 0:
+                dispatcher = _WholeQuoteDispatcher(callback1, window, maxsize)
+                callback = dispatcher.push
+            else:
+                def on_quote_wrapper(datas):
+                    callback1(datas)
+                    return
+                callback = on_quote_wrapper
         subID = self.context.subscribe_whole_quote(code_list, callback)
         if subID > 0:
             subInfo = {}
             subInfo['func'] = 'subscribe_whole_quote'
             subInfo['code_list'] = code_list
             self.subMap[subID] = subInfo
+            if dispatcher:
+                self.z8sglma_whole_quote[subID] = dispatcher
         return subID
-        
+
+    def flush_whole_quote(self, subID = None):
+        # deliver what the coalescing window still holds, e.g. from handlebar after a burst
+        for key, dispatcher in list(self.z8sglma_whole_quote.items()):
+            if subID is None or key == subID:
+                dispatcher.flush()
+
+    def get_whole_quote_stats(self, subID):
+        dispatcher = self.z8sglma_whole_quote.get(subID)
+        return dispatcher.stats() if dispatcher else {}
+
     def unsubscribe_quote(self, subID):
         self.subMap.pop(subID, {})
+        dispatcher = self.z8sglma_whole_quote.pop(subID, None)
+        if dispatcher:
+            dispatcher.close()
         return self.context.unsubscribe_quote(subID)
         
     def get_all_subscription(self):
@@ -1010,20 +1069,2209 @@ class __PyContext(object):
 
 
 
+class MarketDataPanel(object):
+    # get_market_data_ex(..., result_type='panel')
+    # data: float64 block shaped (stocks, time, fields), codes/stime/fields label the axes
+    def __init__(self, data, codes, stime, fields):
+        self.data = data
+        self.codes = codes
+        self.stime = stime
+        self.fields = list(fields)
+        self.code_index = {c: i for i, c in enumerate(codes)}
+        self.field_index = {f: i for i, f in enumerate(self.fields)}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.code_index
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __getitem__(self, code):
+        # (time, fields) view of one stock
+        return self.data[self.code_index[code]]
+
+    def field(self, name):
+        # (stocks, time) view of one field, for cross-sectional work
+        return self.data[:, :, self.field_index[name]]
+
+    def get(self, code, field):
+        return self.data[self.code_index[code], :, self.field_index[field]]
+
+    def to_frame(self, code):
+        import pandas as pd
+        return pd.DataFrame(self[code], index=self.stime, columns=self.fields, copy=False)
+
+    def to_dict(self):
+        return {code: self.to_frame(code) for code in self.codes}
+
+
+def _build_market_panel(ori_data, fields, stock_code):
+    import numpy as np
+    ifield = 'stime'
+    if not ori_data:
+        codes = list(stock_code)
+        fields = [f for f in fields if f != ifield]
+        return MarketDataPanel(np.empty((len(codes), 0, len(fields))), np.array(codes, dtype=object), np.array([], dtype=str), fields)
+
+    codes = [s for s in stock_code if s in ori_data]
+    requested = set(codes)
+    codes += [s for s in ori_data if s not in requested]
+    if not fields:
+        first = ori_data[codes[0]]
+        fields = [f for f in first if np.asarray(first[f]).dtype.kind in 'biuf']
+    fields = [f for f in fields if f != ifield]
+
+    # one shared time axis; stocks with gaps are scattered onto the union
+    stimes = [np.asarray(ori_data[s][ifield]) for s in codes]
+    stime = stimes[0]
+    aligned = all(len(t) == len(stime) and np.array_equal(t, stime) for t in stimes)
+    if not aligned:
+        stime = np.unique(np.concatenate(stimes))
+
+    data = np.full((len(codes), len(stime), len(fields)), np.nan)
+    for i, s in enumerate(codes):
+        sdata = ori_data[s]
+        pos = slice(None) if aligned else np.searchsorted(stime, stimes[i])
+        for j, f in enumerate(fields):
+            if f in sdata:
+                data[i, pos, j] = sdata[f]
+    return MarketDataPanel(data, np.array(codes, dtype=object), stime, fields)
+
+
+class _WholeQuoteDispatcher(object):
+    # coalesces subscribe_whole_quote pushes: everything pending goes out as one
+    # {code: snapshot} dict on the first push `window` ms after the last delivery, or from
+    # resume_context_info once the window has passed, so a burst followed by quiet goes out
+    # with the next handlebar. No timer thread: callbacks run on the terminal's threads.
+    # The lock only guards pending; the callback is invoked after releasing it
+    def __init__(self, callback, window, maxsize):
+        self.callback = callback
+        self.window = window / 1000.0
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushed = 0
+        self.pushes = 0
+        self.updates = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def push(self, datas):
+        with self.lock:
+            pending = self.pending
+            size = len(pending)
+            if self.maxsize:
+                # re-inserted codes move to the back, so the front is always the stalest snapshot
+                pop = pending.pop
+                for code in datas:
+                    pop(code, None)
+                self.coalesced += size - len(pending)
+                pending.update(datas)
+            else:
+                pending.update(datas)
+                self.coalesced += size + len(datas) - len(pending)
+            self.pushes += 1
+            self.updates += len(datas)
+            if self.maxsize and len(pending) > self.maxsize:
+                excess = len(pending) - self.maxsize
+                for code in list(itertools.islice(pending, excess)):
+                    del pending[code]
+                self.dropped += excess
+            due = time.time() - self.flushed >= self.window
+        if due:
+            self.flush()
+
+    def poll(self):
+        # from resume_context_info: deliver a batch whose window has passed without a push
+        if self.pending and time.time() - self.flushed >= self.window:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.flushed = time.time()
+            batch = self.pending
+            if not batch:
+                return
+            self.pending = {}
+            self.batches += 1
+        self.callback(batch)
+
+    def close(self):
+        # unsubscribed: nothing more is delivered
+        with self.lock:
+            self.pending = {}
+
+    def stats(self):
+        return {'pushes': self.pushes, 'updates': self.updates, 'coalesced': self.coalesced,
+                'dropped': self.dropped, 'batches': self.batches, 'pending': len(self.pending)}
+
+
+class _QuoteRing(object):
+    # ring buffer of the newest `size` bars of one subscribe_quote stream. Bar i is written
+    # at slot i % size and again at i % size + size, so the window is always one slice.
+    # A push only writes rows newer than the last stored time; a repeated time overwrites
+    # the bar still forming.
+    def __init__(self, size):
+        self.size = int(size)
+        self.buffer = None
+        self.count = 0
+        self.last = None
+
+    def _allocate(self, datas):
+        import numpy as np
+        dtype = []
+        for k, v in datas.items():
+            if k == 'time':
+                dtype.append((k, np.int64))
+            elif np.asarray(v).dtype.kind in 'biuf':
+                dtype.append((k, np.float64))
+            else:
+                dtype.append((k, object))
+        self.buffer = np.zeros(2 * self.size, dtype=dtype)
+
+    def push(self, datas):
+        import numpy as np
+        if self.buffer is None:
+            self._allocate(datas)
+        names = self.buffer.dtype.names
+        rows = len(datas[names[0]]) if names else 0
+        start = 0
+        overlap = False
+        times = datas.get('time')
+        if times is not None and self.last is not None:
+            start = int(np.searchsorted(np.asarray(times), self.last, 'left'))
+            overlap = start < rows and times[start] == self.last
+        if start < rows - self.size:
+            start = rows - self.size
+            overlap = False
+        if overlap:
+            self.count -= 1
+        if start < rows:
+            slots = (self.count + np.arange(rows - start)) % self.size
+            for name in names:
+                column = self.buffer[name]
+                values = np.asarray(datas[name])[start:]
+                column[slots] = values
+                column[slots + self.size] = values
+            self.count += rows - start
+            if times is not None:
+                self.last = times[-1]
+        return self.view()
+
+    def view(self):
+        if self.buffer is None:
+            return None
+        size = min(self.count, self.size)
+        first = (self.count - size) % self.size
+        window = self.buffer[first:first + size]
+        window.flags.writeable = False
+        return window
+
+
+def _build_field_values(fields, stocks, dates, values, multi_type):
+    # values[field] is a flat list laid out stock by stock, len(stocks) * len(dates) long
+    import numpy as np
+    import pandas as pd
+    from collections import OrderedDict
+    for value in values:
+        if value is None or len(value) == 0:
+            return
+    block = np.array(values)
+    # (fields, stocks, dates); a stock's (dates, fields) frame is block[:, i, :].T
+    block = block.reshape(len(fields), len(stocks), len(dates))
+
+    def frame(data, index):
+        result = pd.DataFrame(data, index=index, columns=fields, copy=False)
+        return result.infer_objects() if data.dtype == object else result
+
+    if len(stocks) == 1 and len(dates) == 1:    #series
+        result = pd.Series(block.reshape(-1), index=fields)
+        return result.infer_objects() if block.dtype == object else result
+    elif len(stocks) == 1 and len(dates) > 1:   #index = dates, col = fields
+        return frame(block[:, 0, :].T, dates)
+    elif len(stocks) > 1 and len(dates) == 1:   #index = stocks col = fields
+        return frame(block[:, :, 0].T, stocks)
+    elif multi_type == 'dict':
+        return OrderedDict((stocks[i], frame(block[:, i, :].T, dates)) for i in range(len(stocks)))
+    index = pd.MultiIndex.from_product([stocks, dates], names=['stock', 'date'])
+    return frame(block.reshape(len(fields), -1).T, index)
+
+
+def _option_market(undlCode, undlMarket):
+    if(undlMarket == "SH"):
+        if undlCode == "000016" or undlCode == "000300" or undlCode == "000852" or undlCode == "000905":
+            return 'IF'
+        return "SHO"
+    elif(undlMarket == "SZ"):
+        return "SZO"
+    return ""
+
+
+def _trading_date(timetag):
+    # trading date of a bar timetag (ms): night sessions, from 20:00, trade for the next date
+    return int(time.strftime('%Y%m%d', time.localtime(timetag / 1000 + 4 * 3600)))
+
+
+class _InstrumentCache(object):
+    # get_instrumentdetail results for the terminal's current trading date, taken from the
+    # current bar's timetag. PriceTick, VolumeMultiple, UpStopPrice and the like change at
+    # most once a trading day, futures limits when the night session opens, so every code
+    # costs one native call per day; the universe is fetched in bulk at set_universe and
+    # again each new trading date, minus contracts that have expired since. The native call
+    # has no date, so a back test keeps the details of its first date throughout.
+    def __init__(self):
+        self.barpos = None
+        self.back_test = None
+        self.date = 0
+        self.details = {}
+        self.universe = []
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.barpos = None
+        self.date = 0
+
+    def _roll(self, context):
+        barpos = context.barpos
+        if barpos == self.barpos:
+            return
+        self.barpos = barpos
+        if self.back_test is None:
+            self.back_test = bool(getattr(context, 'do_back_test', False))
+        if self.date and self.back_test:
+            return
+        date = _trading_date(context.get_bar_timetag(barpos))
+        if date != self.date:
+            self.date = date
+            details = self.details
+            self.details = {}
+            self.universe = [code for code in self.universe if not _instrument_expired(details.get(code), date)]
+            self._fetch(context, self.universe)
+
+    def _fetch(self, context, codes):
+        details = self.details
+        for code in codes:
+            if code not in details:
+                self.misses += 1
+                details[code] = context.get_instrumentdetail(code)
+
+    def get(self, context, code):
+        self._roll(context)
+        inst = self.details.get(code, _MISSING)
+        if inst is _MISSING:
+            self.misses += 1
+            inst = self.details[code] = context.get_instrumentdetail(code)
+        else:
+            self.hits += 1
+        return inst
+
+    def prefetch(self, context, codes):
+        self._roll(context)
+        known = set(self.universe)
+        self.universe += [code for code in codes if code not in known]
+        self._fetch(context, codes)
+
+    def info(self):
+        return {'date': self.date, 'size': len(self.details), 'universe': len(self.universe),
+                'hits': self.hits, 'misses': self.misses}
+
+
+def _instrument_expired(inst, date):
+    # ExpireDate is 0 / 99999999 for instruments without an expiry
+    expire = inst.get('ExpireDate') if inst else None
+    return isinstance(expire, numbers.Number) and 19000101 <= expire < date
+
+
+_OPTION_SECTORS = {
+    'SHO': ('上证期权', '过期上证期权'),
+    'SZO': ('深证期权', '过期深证期权'),
+    'IF': ('中金所', '过期中金所'),
+}
+
+
+class _OptionIndex(object):
+    # option master for get_option_list / get_option_undl_data: sector lists are read
+    # once per trading date of the current bar, as in _InstrumentCache, instrument details
+    # once per contract, chains once per underlying
+    def __init__(self):
+        self.barpos = None
+        self.back_test = None
+        self.date = 0
+        self.sectors = {}
+        self.details = {}
+        self.stale = {}
+        self.chains = {}
+        self.undls = {}
+
+    def invalidate(self):
+        self.barpos = None
+        self.date = 0
+
+    def _roll(self, context):
+        native = context.context
+        barpos = native.barpos
+        if barpos == self.barpos:
+            return
+        self.barpos = barpos
+        if self.back_test is None:
+            self.back_test = bool(getattr(native, 'do_back_test', False))
+        if self.date and self.back_test:
+            return
+        date = _trading_date(native.get_bar_timetag(barpos))
+        if date != self.date:
+            # contracts seen the day before are reused when they show up again, the rest drop out
+            self.date = date
+            self.stale = self.details
+            self.details = {}
+            self.sectors = {}
+            self.chains = {}
+            self.undls = {}
+
+    def _sector(self, context, name):
+        self._roll(context)
+        codes = self.sectors.get(name)
+        if codes is None:
+            codes = self.sectors[name] = list(get_stock_list_in_sector(name))
+            self._fetch(context, codes)
+        return codes
+
+    def _fetch(self, context, codes):
+        details = self.details
+        for opt in codes:
+            if opt not in details:
+                record = self.stale.get(opt, _MISSING)
+                if record is _MISSING:
+                    record = _option_record(context.z8sglma_instruments.get(context.context, opt))
+                details[opt] = record
+
+    def _market(self, context, market):
+        listed, expired = _OPTION_SECTORS[market]
+        self._roll(context)
+        key = (market, )
+        codes = self.sectors.get(key)
+        if codes is None:
+            codes = list(self._sector(context, listed))
+            hisList = self._sector(context, expired)
+            if len(hisList) <= 0:
+                hisList = context.get_his_contract_list(market)
+                self._fetch(context, hisList)
+            codes += hisList
+            codes = self.sectors[key] = [opt for opt in codes if opt.find(market) >= 0]
+        return codes
+
+    def chain(self, context, market, undlCode):
+        codes = self._market(context, market)
+        key = (market, undlCode)
+        chain = self.chains.get(key)
+        if chain is None:
+            records = []
+            for opt in codes:
+                record = self.details[opt]
+                if record is None:
+                    continue
+                if record[3].find(undlCode) > 0 or record[4] == undlCode:
+                    records.append((opt,) + record)
+            chain = self.chains[key] = _OptionChain(records)
+        return chain
+
+    def underlyings(self, context, name):
+        # undl_code_ref -> option codes of one listed sector, in sector order
+        codes = self._sector(context, name)
+        undls = self.undls.get(name)
+        if undls is None:
+            undls = self.undls[name] = OrderedDict()
+            for opt in codes:
+                undl_code = _option_undl_ref(opt, self.details[opt])
+                if undl_code:
+                    undls.setdefault(undl_code, []).append(opt)
+        return undls
+
+    def prefetch(self, context):
+        for market in _OPTION_SECTORS:
+            self._market(context, market)
+
+
+def _option_record(inst):
+    # (optType, ExpireDate, effective open date, ProductID, OptUndlCode, OptUndlMarket)
+    if not inst or 'ExtendInfo' not in inst:
+        return None
+    createDate = inst['CreateDate']
+    openDate = inst['OpenDate']
+    if(createDate >= 1):
+        openDate = min(openDate, createDate)
+    ext_info = inst['ExtendInfo']
+    return (ext_info.get("optType"), inst['ExpireDate'], openDate, inst['ProductID'], ext_info.get('OptUndlCode'), ext_info.get('OptUndlMarket'))
+
+
+def _option_undl_ref(opt_code, record):
+    if record is None:
+        return
+    undl_code_ref = str(record[4]) + '.' + str(record[5])
+    if opt_code.find(".IF") != -1:
+        if undl_code_ref == "000016.SH" or undl_code_ref == "000300.SH" or undl_code_ref == "000852.SH" or undl_code_ref == "000905.SH":
+            return undl_code_ref
+    else:
+        return undl_code_ref
+    return
+
+
+class _OptionChain(object):
+    def __init__(self, records):
+        import numpy as np
+        self.codes = np.array([r[0] for r in records], dtype=object)
+        self.types = np.array([r[1] for r in records], dtype=object)
+        self.expire = np.array([str(r[2]) for r in records], dtype=str)
+        self.open = np.array([r[3] for r in records], dtype=np.int64)
+        self.open_str = np.array([str(r[3]) for r in records], dtype=str)
+        self.queries = {}
+        self._tree = None
+
+    def select(self, opttype, dedate, isavailavle):
+        key = (opttype, dedate, bool(isavailavle) and len(dedate) == 8)
+        codes = self.queries.get(key)
+        if codes is None:
+            import numpy as np
+            mask = np.ones(len(self.codes), dtype=bool)
+            if opttype != "":
+                mask &= self.types == opttype
+            if len(dedate) == 6:
+                mask &= np.char.find(self.expire, dedate) >= 0
+            if len(dedate) == 8: #option is trade,guosen demand
+                mask &= (self.open >= 20150101) & (self.open_str <= dedate)
+                if isavailavle:
+                    mask &= self.expire >= dedate
+            codes = self.queries[key] = self.codes[mask].tolist()
+        return list(codes)
+
+    def tree(self):
+        if self._tree is None:
+            tree = OrderedDict()
+            for opt, opttype, expire in zip(self.codes, self.types, self.expire):
+                tree.setdefault(expire[:6], OrderedDict()).setdefault(opttype, []).append(opt)
+            self._tree = OrderedDict(sorted(tree.items()))
+        return copy.deepcopy(self._tree)
+
+
+def _norm_cdf(x):
+    # Hart (1968) double precision cumulative normal, as laid out by West (2005)
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    xabs = np.abs(x)
+    with np.errstate(over='ignore', under='ignore', divide='ignore', invalid='ignore'):
+        e = np.exp(-xabs * xabs / 2)
+        num = ((((((3.52624965998911e-02 * xabs + 0.700383064443688) * xabs + 6.37396220353165) * xabs
+                  + 33.912866078383) * xabs + 112.079291497871) * xabs + 221.213596169931) * xabs + 220.206867912376)
+        den = (((((((8.83883476483184e-02 * xabs + 1.75566716318264) * xabs + 16.064177579207) * xabs
+                   + 86.7807322029461) * xabs + 296.564248779674) * xabs + 637.333633378831) * xabs
+                + 793.826512519948) * xabs + 440.413735824752)
+        tail = xabs + 1 / (xabs + 2 / (xabs + 3 / (xabs + 4 / (xabs + 0.65))))
+        cum = np.where(xabs < 7.07106781186547, e * num / den, e / tail / 2.506628274631)
+    cum = np.where(xabs > 37, 0.0, cum)
+    return np.where(x > 0, 1 - cum, cum)
+
+
+def _norm_pdf(x):
+    import numpy as np
+    return np.exp(-0.5 * x * x) / 2.5066282746310002
+
+
+def _bsm_is_call(optType):
+    import numpy as np
+    if isinstance(optType, str):
+        optType = optType.upper()
+        if optType not in ('C', 'CALL', 'P', 'PUT'):
+            return np.nan
+        return optType in ('C', 'CALL')
+    optType = np.char.upper(np.asarray(optType, dtype=str))
+    return np.where((optType == 'C') | (optType == 'CALL'), 1.0, np.where((optType == 'P') | (optType == 'PUT'), 0.0, np.nan))
+
+
+def _bsm_price_scalar(optType, S, K, r, v, days, q):
+    # same conventions as bsm_greeks, for one contract without the array overhead
+    import math
+    optType = optType.upper()
+    if optType not in ('C', 'CALL', 'P', 'PUT'):
+        return float('nan')
+    sign = 1.0 if optType in ('C', 'CALL') else -1.0
+    T = days / 365.0
+    dq = math.exp(-q * max(T, 0))
+    dr = math.exp(-r * max(T, 0))
+    if T <= 0 or v <= 0:
+        return max(sign * (S * dq - K * dr), 0.0)
+    if S < 0 or K < 0:
+        return float('nan')
+    if S == 0 or K == 0:
+        # a missing quote: the limit bsm_greeks reaches through log(0) / log(inf)
+        return max(sign * (S * dq - K * dr), 0.0)
+    vol = v * math.sqrt(T)
+    d1 = (math.log(S / K) + (r - q) * T) / vol + vol / 2
+    d2 = d1 - vol
+    return sign * (S * dq * 0.5 * math.erfc(-sign * d1 / math.sqrt(2)) - K * dr * 0.5 * math.erfc(-sign * d2 / math.sqrt(2)))
+
+
+def bsm_greeks(optType, targetPrice, strikePrice, riskFree, sigma, days, dividend = 0):
+    # Black-Scholes-Merton on broadcast arrays; optType 'C'/'P' (or arrays of them),
+    # riskFree / sigma / dividend annualised decimals, days calendar days to expiry.
+    # vega and rho are per 1.00 of sigma / riskFree, theta per year.
+    import numpy as np
+    call = _bsm_is_call(optType)
+    S, K, r, v, days, q, call = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in
+                                                      (targetPrice, strikePrice, riskFree, sigma, days, dividend, call)])
+    T = days / 365.0
+    live = (T > 0) & (v > 0)
+    sqrtT = np.sqrt(np.where(live, T, 1.0))
+    vol = np.where(live, v, 1.0) * sqrtT
+    dq = np.exp(-q * np.maximum(T, 0))
+    dr = np.exp(-r * np.maximum(T, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = (np.log(S / K) + (r - q) * T) / vol + vol / 2
+    d2 = d1 - vol
+    sign = np.where(call == 1, 1.0, -1.0)
+    Nd1, Nd2 = _norm_cdf(np.stack([sign * d1, sign * d2]))
+    pdf = _norm_pdf(d1)
+
+    result = {}
+    result['price'] = sign * (S * dq * Nd1 - K * dr * Nd2)
+    result['delta'] = sign * dq * Nd1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['gamma'] = dq * pdf / (S * vol)
+    result['vega'] = S * dq * pdf * sqrtT
+    result['theta'] = -S * dq * pdf * v / (2 * sqrtT) - sign * (r * K * dr * Nd2 - q * S * dq * Nd1)
+    result['rho'] = sign * K * T * dr * Nd2
+
+    if not live.all():
+        # expired or zero vol: discounted intrinsic value, step delta, no curvature
+        forward = sign * (S * dq - K * dr)
+        itm = forward > 0
+        result['price'] = np.where(live, result['price'], np.maximum(forward, 0.0))
+        result['delta'] = np.where(live, result['delta'], np.where(itm, sign * dq, 0.0))
+        result['gamma'] = np.where(live, result['gamma'], 0.0)
+        result['vega'] = np.where(live, result['vega'], 0.0)
+        result['theta'] = np.where(live, result['theta'], np.where(itm & (T > 0), sign * (q * S * dq - r * K * dr), 0.0))
+        result['rho'] = np.where(live, result['rho'], np.where(itm, sign * K * np.maximum(T, 0) * dr, 0.0))
+    nan = np.isnan(call)
+    for name, value in result.items():
+        if nan.any():
+            value = np.where(nan, np.nan, value)
+        result[name] = value if value.ndim else value[()]
+    return result
+
+
+def bsm_iv_batch(optType, targetPrice, strikePrice, optionPrice, riskFree, days, dividend = 0, tol = 1e-10, maxIter = 100):
+    # implied volatility for broadcast arrays of contracts, same conventions as bsm_greeks.
+    # Newton steps on the contracts still open, falling back to bisection inside the
+    # [lo, hi] bracket whenever a step leaves it; prices outside the no-arbitrage
+    # bounds (or expired / bad type) come back as nan.
+    import numpy as np
+    call = _bsm_is_call(optType)
+    arrays = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in
+                                   (targetPrice, strikePrice, optionPrice, riskFree, days, dividend, call)])
+    shape = arrays[0].shape
+    S, K, P, r, days, q, call = [a.ravel() for a in arrays]
+    T = days / 365.0
+    sign = np.where(call == 1, 1.0, -1.0)
+    with np.errstate(invalid='ignore'):
+        dq = np.exp(-q * np.maximum(T, 0))
+        dr = np.exp(-r * np.maximum(T, 0))
+        lower = np.maximum(sign * (S * dq - K * dr), 0.0)
+        upper = np.where(sign > 0, S * dq, K * dr)
+        valid = ~np.isnan(call) & (T > 0) & (S > 0) & (K > 0) & (P > lower) & (P < upper)
+
+    iv = np.full(S.shape, np.nan)
+    idx = np.flatnonzero(valid)
+    S, K, P, r, q, T, sign, dq, dr = [a[idx] for a in (S, K, P, r, q, T, sign, dq, dr)]
+    sqrtT = np.sqrt(T)
+    logSK = np.log(S / K) + (r - q) * T
+    # Manaster-Koehler start, kept inside the initial bracket
+    lo = np.full(idx.shape, 1e-6)
+    hi = np.full(idx.shape, 10.0)
+    sigma = np.clip(np.sqrt(2 * np.abs(logSK) / T), 0.05, 3.0)
+    done = np.zeros(idx.shape, dtype=bool)
+    active = np.arange(idx.size)
+    for i in range(maxIter):
+        if active.size == 0:
+            break
+        s = sigma[active]
+        vol = s * sqrtT[active]
+        d1 = logSK[active] / vol + vol / 2
+        sg = sign[active]
+        Nd1, Nd2 = _norm_cdf(np.stack([sg * d1, sg * (d1 - vol)]))
+        diff = sg * (S[active] * dq[active] * Nd1 - K[active] * dr[active] * Nd2) - P[active]
+        vega = S[active] * dq[active] * _norm_pdf(d1) * sqrtT[active]
+
+        above = diff > 0
+        hi[active] = np.where(above, s, hi[active])
+        lo[active] = np.where(above, lo[active], s)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = s - diff / vega
+        bisect = ~((step > lo[active]) & (step < hi[active]))
+        step = np.where(bisect, (lo[active] + hi[active]) / 2, step)
+        converged = (np.abs(diff) <= tol) | (hi[active] - lo[active] <= tol * s)
+        sigma[active] = np.where(converged, s, step)
+        done[active] = converged
+        active = active[~converged]
+    iv[idx] = np.where(done, sigma, np.nan)
+    iv = iv.reshape(shape)
+    return iv if iv.ndim else iv[()]
+
+
+class IVSurface(object):
+    # implied vol quotes indexed by moneyness (strike / targetPrice) and tenor (days).
+    # Each tenor is a smile interpolated linearly in moneyness with flat wings; between
+    # tenors total variance iv^2 * T is interpolated linearly, flat outside the range.
+    def __init__(self, moneyness, days, iv):
+        import numpy as np
+        moneyness, days, iv = [a.ravel() for a in np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (moneyness, days, iv)])]
+        keep = ~(np.isnan(moneyness) | np.isnan(days) | np.isnan(iv)) & (days > 0)
+        moneyness, days, iv = moneyness[keep], days[keep], iv[keep]
+        self.tenors = np.unique(days)
+        self.smiles = []
+        for tenor in self.tenors:
+            sel = days == tenor
+            # a call and a put on the same strike both quote; average them
+            m, inverse = np.unique(moneyness[sel], return_inverse=True)
+            vols = np.bincount(inverse, weights=iv[sel]) / np.bincount(inverse)
+            self.smiles.append((m, vols))
+
+    def smile(self, days):
+        # (moneyness, iv) of a quoted tenor
+        import numpy as np
+        i = int(np.searchsorted(self.tenors, days))
+        if i >= len(self.tenors) or self.tenors[i] != days:
+            raise KeyError(days)
+        m, vols = self.smiles[i]
+        return m.copy(), vols.copy()
+
+    def __call__(self, moneyness, days):
+        import numpy as np
+        moneyness, days = np.broadcast_arrays(np.asarray(moneyness, dtype=float), np.asarray(days, dtype=float))
+        if len(self.tenors) == 0:
+            result = np.full(moneyness.shape, np.nan)
+            return result if result.ndim else result[()]
+        variance = np.array([np.interp(moneyness, m, vols) ** 2 * tenor
+                             for tenor, (m, vols) in zip(self.tenors, self.smiles)])
+        t = np.clip(days, self.tenors[0], self.tenors[-1])
+        j = np.clip(np.searchsorted(self.tenors, t), 1, max(len(self.tenors) - 1, 1))
+        if len(self.tenors) == 1:
+            w = variance[0]
+        else:
+            t0, t1 = self.tenors[j - 1], self.tenors[j]
+            w0 = np.take_along_axis(variance, (j - 1)[None], 0)[0]
+            w1 = np.take_along_axis(variance, j[None], 0)[0]
+            w = w0 + (w1 - w0) * (t - t0) / (t1 - t0)
+        result = np.sqrt(w / t)
+        return result if result.ndim else result[()]
+
+    def to_frame(self):
+        import pandas as pd
+        rows = [(tenor, mm, vv) for tenor, (m, vols) in zip(self.tenors, self.smiles) for mm, vv in zip(m, vols)]
+        return pd.DataFrame(rows, columns=['days', 'moneyness', 'iv'])
+
+
 def timetag_to_datetime(timetag, format):
+    if isinstance(timetag, (list, tuple)) or hasattr(timetag, 'dtype'):
+        return _timetags_to_datetime(timetag, format)
     import time
     timetag = timetag / 1000
     time_local = time.localtime(timetag)
     return time.strftime(format, time_local)
 
 
+_TIME_DIRECTIVES = ('%H', '%I', '%M', '%S', '%p', '%f', '%X', '%c', '%T', '%R', '%r', '%s')
+
+
+def _timetags_to_datetime(timetags, format):
+    # array form of timetag_to_datetime: strftime runs once per distinct value. Formats
+    # without time-of-day fields only need one call per 15 minutes, the finest step any
+    # UTC offset moves in, so a day of minute bars costs ~16 calls instead of 240.
+    import numpy as np
+    seconds = np.floor_divide(np.asarray(timetags, dtype=np.int64), 1000)
+    step = 1 if any(d in format for d in _TIME_DIRECTIVES) else 900
+    keys, inverse = np.unique(np.floor_divide(seconds, step), return_inverse=True)
+    formatted = np.array([time.strftime(format, time.localtime(int(k) * step)) for k in keys], dtype=str)
+    return formatted[inverse.reshape(seconds.shape)]
+
+
+class _HistoryCache(object):
+    # sliding windows behind get_history_data, one per (period, field, dividend_type, skip_paused)
+    # holding {stock: values} for the whole universe, as the native call returns it.
+    # Moving on k bars fetches k + OVERLAP rows and lines them up with the cached tail, so
+    # a stock paused under skip_paused (no new row) and a realtime bar whose value moved
+    # since the last tick both land correctly; anything that does not line up is refetched.
+    # Shorter requests are sliced from the widest window held. Each window carries an epoch,
+    # bumped on every full fetch, and per-stock counts of rows appended since, so readers
+    # that follow a series bar by bar know exactly what is new.
+    OVERLAP = 5
+
+    def __init__(self):
+        self.series = {}
+        self.epochs = 0
+        self.runs = 0
+        self.calls = 0
+        self.hits = 0
+
+    def clear(self, field = None, dividend_type = None):
+        for key in list(self.series):
+            if (field is None or key[1] == field) and (dividend_type is None or key[2] == dividend_type):
+                del self.series[key]
+
+    def info(self):
+        return {'series': len(self.series), 'native_calls': self.calls, 'hits': self.hits}
+
+    def _fetch(self, context, count, key):
+        # the native lists are fresh per call and only ever replaced here, never mutated
+        self.calls += 1
+        data = context.get_history_data(count, key[0], key[1], key[2], key[3])
+        return {stock: values if type(values) is list else list(values) for stock, values in data.items()}
+
+    def get(self, context, count, period, field, dividend_type, skip_paused):
+        entry = self.window(context, count, period, field, dividend_type, skip_paused)
+        if count <= 0:
+            return dict((stock, []) for stock in entry['data'])
+        return {stock: values[-count:] for stock, values in entry['data'].items()}
+
+    def window(self, context, count, period, field, dividend_type, skip_paused):
+        key = (period, field, dividend_type, skip_paused)
+        barpos = context.barpos
+        entry = self.series.get(key)
+        if entry is None or count > entry['count'] or barpos < entry['barpos'] or barpos - entry['barpos'] > entry['count']:
+            entry = None
+        elif barpos > entry['barpos'] or (entry['run'] != self.runs and context.is_last_bar()):
+            entry = self._advance(context, entry, key, barpos - entry['barpos'])
+        else:
+            self.hits += 1
+        if entry is None:
+            # keep enough rows to line the next bar up against
+            size = max(count, self.OVERLAP + 1)
+            data = self._fetch(context, size, key)
+            appended = dict((stock, len(values)) for stock, values in data.items())
+            entry = {'count': size, 'data': data, 'epoch': self.epochs, 'appended': appended}
+            self.epochs += 1
+        entry['barpos'] = barpos
+        entry['run'] = self.runs
+        self.series[key] = entry
+        return entry
+
+    def _advance(self, context, entry, key, bars):
+        # a stock that does not line up drops the whole entry, so rows are written as they go
+        size = entry['count']
+        width = bars + self.OVERLAP
+        fresh = self._fetch(context, width, key)
+        data = entry['data']
+        if fresh.keys() != data.keys():
+            return None
+        appended = entry['appended']
+        others = tuple(range(bars - 1, -1, -1)) if key[3] else ()
+        room = size - width
+        for stock, new in fresh.items():
+            old = data[stock]
+            held = len(old)
+            # fast path: a full fetch whose overlap matches the cached tail as is; a paused
+            # stock could have added fewer, so then no other count may line up as well
+            if len(new) == width and held >= self.OVERLAP and old[held - self.OVERLAP:held - 1] == new[:self.OVERLAP - 1] \
+                    and not (others and _clashes(old, new, others)):
+                end = held - self.OVERLAP
+                data[stock] = old[end - room if end > room else 0:end] + new if room > 0 else new[-size:]
+                appended[stock] += bars
+                continue
+            match = _line_up(old, new, (bars, ) + others)
+            if match is None:
+                return None
+            end = max(held - len(new) + match, 0)
+            left = size - len(new)
+            data[stock] = (old[max(end - left, 0):end] if left > 0 else []) + new[-size:]
+            appended[stock] += match
+        return entry
+
+
+def _line_up(old, new, candidates):
+    # `added` of the fetched rows are bars this stock has not been seen at; under skip_paused
+    # a stock that did not trade adds fewer, so every count is tried and exactly one has to
+    # line up
+    match = None
+    for added in candidates:
+        if _lines_up(old, new, added):
+            if match is not None:
+                return None
+            match = added
+    return match
+
+
+def _clashes(old, new, others):
+    # whether another count lines up too; the first compared pair (the oldest fetched row
+    # against its cached twin) settles almost every wrong count inline
+    held = len(old)
+    width = len(new)
+    for added in others:
+        kept = width - added
+        if held > kept:
+            x, y = old[held - kept], new[0]
+        else:
+            x, y = old[0], new[kept - held]
+        if (x == y or (x != x and y != y)) and _lines_up(old, new, added):
+            return True
+    return False
+
+
+def _lines_up(old, new, added):
+    # the fetched rows before the `added` new ones repeat the cached tail; the newest cached
+    # row may have been a forming bar and is not compared
+    held = len(old)
+    kept = len(new) - added
+    if kept < 0:
+        return False
+    start = held - kept if held > kept else 0
+    shift = kept - held + start
+    if start < held - 1:
+        # the first pair rejects most wrong counts without slicing
+        x, y = old[start], new[shift]
+        if x != y and (x == x or y == y):
+            return False
+    a = old[start:held - 1]
+    b = new[shift:kept - 1] if kept > shift else []
+    return a == b or _same_values(a, b)
+
+
+def _same_values(a, b):
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x != y and (x == x or y == y):
+            return False
+    return True
+
+
+class _ValueWindow(object):
+    # the newest `size` values of a series; value i is written at slot i % size and again at
+    # i % size + size so the window is one contiguous slice. A value pushed with closed=False
+    # is the bar still forming and the next push overwrites it.
+    def __init__(self, size):
+        import numpy as np
+        self.size = int(size)
+        self.buffer = np.zeros(2 * self.size)
+        self.count = 0
+        self.pending = False
+
+    def push(self, value, closed = True):
+        if self.pending:
+            self.count -= 1
+        slot = self.count % self.size
+        self.buffer[slot] = self.buffer[slot + self.size] = value
+        self.count += 1
+        self.pending = not closed
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def last(self, n):
+        end = (self.count - 1) % self.size + self.size + 1
+        return self.buffer[end - min(n, self.count, self.size):end]
+
+
+class RollingMean(object):
+    # mean of the last `window` values, None until that many are seen. The update is O(1);
+    # the value is np.mean over the contiguous window rather than a running sum, whose
+    # rounding drifts from the pairwise sum scripts compute over the same closes.
+    def __init__(self, window):
+        self.window = self.need = int(window)
+        self.reset()
+
+    def reset(self):
+        self.values = _ValueWindow(self.window)
+
+    def update(self, value, closed = True):
+        self.values.push(value, closed)
+
+    @property
+    def value(self):
+        import numpy as np
+        if len(self.values) < self.window:
+            return None
+        return np.mean(self.values.last(self.window))
+
+
+class ExpWeightedMean(object):
+    # weighted mean of the last `window` values with weights exp(linspace(-1, 0, window)),
+    # normalised, newest heaviest
+    def __init__(self, window):
+        import numpy as np
+        self.window = self.need = int(window)
+        weights = np.exp(np.linspace(-1, 0, self.window))
+        self.weights = weights / weights.sum()
+        self.reset()
+
+    def reset(self):
+        self.values = _ValueWindow(self.window)
+
+    def update(self, value, closed = True):
+        self.values.push(value, closed)
+
+    @property
+    def value(self):
+        import numpy as np
+        if len(self.values) < self.window:
+            return None
+        return np.dot(self.values.last(self.window), self.weights)
+
+
+class MASlope(object):
+    # (MA(window) - MA(window + 1)) / MA(window), None until window + 1 values are seen
+    def __init__(self, window):
+        self.window = int(window)
+        self.need = self.window + 1
+        self.reset()
+
+    def reset(self):
+        self.values = _ValueWindow(self.need)
+
+    def update(self, value, closed = True):
+        self.values.push(value, closed)
+
+    @property
+    def value(self):
+        import numpy as np
+        if len(self.values) <= self.window:
+            return None
+        values = self.values.last(self.window + 1)
+        ma = np.mean(values[1:])
+        return (ma - np.mean(values)) / ma
+
+
+class ClippedATR(object):
+    # mean true range of the last `period` bars over a `window`-bar lookback, each true range
+    # clipped at the `quantile` order statistic of the lookback's true ranges once there are
+    # more than 5 of them. The lookback's true ranges are also kept sorted, so the clip level
+    # is one index away and a bar moves in and out of the order statistic by bisection.
+    def __init__(self, period, window = None, quantile = 0.9):
+        self.period = int(period)
+        self.window = self.need = int(window) if window else 2 * self.period
+        self.quantile = quantile
+        self.reset()
+
+    def reset(self):
+        self.ranges = _ValueWindow(max(self.window - 1, 1))
+        self.sorted = []
+        self.close = None
+        self.pending = False
+
+    def update(self, high, low, close, closed = True):
+        import bisect
+        ranges = self.ranges
+        if self.pending:
+            self.pending = False
+            if ranges.pending:
+                # the forming bar's true range leaves the lookback, its slot is reused below
+                del self.sorted[bisect.bisect_left(self.sorted, ranges.last(1)[0])]
+        elif ranges.count >= ranges.size:
+            del self.sorted[bisect.bisect_left(self.sorted, ranges.last(ranges.size)[0])]
+        if self.close is not None:
+            tr = max(high - low, abs(high - self.close), abs(low - self.close))
+            ranges.push(tr, closed)
+            bisect.insort(self.sorted, ranges.last(1)[0])
+        if closed:
+            self.close = close
+        else:
+            self.pending = True
+
+    @property
+    def cutoff(self):
+        n = len(self.sorted)
+        if n <= 5:
+            return None
+        return self.sorted[int(n * self.quantile)]
+
+    @property
+    def value(self):
+        import numpy as np
+        if not self.sorted:
+            return None
+        values = self.ranges.last(self.period)
+        cutoff = self.cutoff
+        if cutoff is not None:
+            values = np.minimum(values, cutoff)
+        return np.mean(values)
+
+
+class _IndicatorEngine(object):
+    # streaming indicators per (stock, indicator, window), fed from the history cache. Each
+    # read pushes only the rows the cache appended since the previous one, the newest as a
+    # forming bar; a refetched window (new epoch) or a gap wider than the rows held rebuilds
+    # the feed from those rows.
+    KINDS = {
+        'sma': (RollingMean, ('close', )),
+        'ema': (ExpWeightedMean, ('close', )),
+        'slope': (MASlope, ('close', )),
+        'atr': (ClippedATR, ('high', 'low', 'close')),
+    }
+
+    def __init__(self):
+        self.feeds = {}
+
+    def clear(self):
+        self.feeds.clear()
+
+    def info(self):
+        return {'feeds': len(self.feeds), 'indicators': sum(len(feed['indicators']) for feed in self.feeds.values())}
+
+    def get(self, context, cache, kind, stock, window, period, dividend_type):
+        if kind not in self.KINDS:
+            raise ValueError("indicator must be one of " + ", ".join(sorted(self.KINDS)))
+        cls, fields = self.KINDS[kind]
+        key = (stock, fields, period, dividend_type)
+        feed = self.feeds.get(key)
+        if feed is None:
+            feed = {'indicators': {}, 'need': 0, 'epochs': None, 'appended': None, 'last': None, 'barpos': None, 'run': None}
+            self.feeds[key] = feed
+        indicator = feed['indicators'].get((kind, window))
+        if indicator is None:
+            indicator = cls(window)
+            feed['indicators'][(kind, window)] = indicator
+            feed['need'] = max(feed['need'], indicator.need)
+            feed['epochs'] = feed['barpos'] = None
+        # like the history cache, a bar is read once per run
+        if feed['barpos'] != context.barpos or feed['run'] != cache.runs:
+            self._sync(context, cache, feed, fields, stock, period, dividend_type)
+            feed['barpos'] = context.barpos
+            feed['run'] = cache.runs
+        return indicator.value
+
+    def _sync(self, context, cache, feed, fields, stock, period, dividend_type):
+        entries = [cache.window(context, feed['need'], period, field, dividend_type, True) for field in fields]
+        columns = [entry['data'].get(stock, []) for entry in entries]
+        epochs = tuple(entry['epoch'] for entry in entries)
+        appended = tuple(entry['appended'].get(stock, 0) for entry in entries)
+        held = min(len(column) for column in columns)
+        last = tuple(column[-1] for column in columns) if held else None
+        start = 0
+        rebuild = True
+        if feed['epochs'] == epochs:
+            added = set(now - before for now, before in zip(appended, feed['appended']))
+            if len(added) == 1:
+                added = added.pop()
+                if added == 0 and last == feed['last']:
+                    return
+                if 0 <= added < held:
+                    # the row that was forming at the previous read comes again, now closed
+                    start = held - added - 1
+                    rebuild = False
+        feed['epochs'] = epochs
+        feed['appended'] = appended
+        feed['last'] = last
+        rows = list(zip(*[column[len(column) - held + start:] for column in columns]))
+        for indicator in feed['indicators'].values():
+            if rebuild:
+                indicator.reset()
+            for row in rows[:-1]:
+                indicator.update(*row)
+            if rows:
+                indicator.update(*rows[-1], closed=False)
+
+
+class BarTimeline(object):
+    # per-bar calendar of the main chart, indexed by barpos:
+    #   timetags    int64 ms
+    #   dates       'YYYYMMDD'
+    #   date_ints   YYYYMMDD as int64, months YYYYMM as int64
+    #   days        trading-day ordinal, 0 for the first day on the chart
+    #   month_first barpos of the first bar of the same month
+    def __init__(self, timetags):
+        import numpy as np
+        self.timetags = np.zeros(0, dtype=np.int64)
+        self.dates = np.zeros(0, dtype='<U8')
+        self.date_ints = np.zeros(0, dtype=np.int64)
+        self.months = np.zeros(0, dtype=np.int64)
+        self.days = np.zeros(0, dtype=np.int64)
+        self.month_first = np.zeros(0, dtype=np.int64)
+        self._lists = {}
+        self.extend(timetags)
+
+    def __len__(self):
+        return len(self.timetags)
+
+    def extend(self, timetags):
+        import numpy as np
+        timetags = np.asarray(timetags, dtype=np.int64)
+        if timetags.size == 0:
+            return
+        base = len(self.timetags)
+        dates = _timetags_to_datetime(timetags, '%Y%m%d')
+        date_ints = dates.astype(np.int64)
+        months = date_ints // 100
+        prev_date = self.date_ints[-1] if base else None
+        prev_month = self.months[-1] if base else None
+        new_day = np.empty(len(date_ints), dtype=bool)
+        new_day[0] = prev_date is None or date_ints[0] != prev_date
+        new_day[1:] = date_ints[1:] != date_ints[:-1]
+        days = np.cumsum(new_day) - 1 + (self.days[-1] + 1 if base else 0)
+        new_month = np.empty(len(months), dtype=bool)
+        new_month[0] = prev_month is None or months[0] != prev_month
+        new_month[1:] = months[1:] != months[:-1]
+        first = np.where(new_month, np.arange(base, base + len(months)), -1)
+        if not new_month[0]:
+            first[0] = self.month_first[-1]
+        month_first = np.maximum.accumulate(first)
+        self.timetags = np.concatenate([self.timetags, timetags])
+        self.dates = np.concatenate([self.dates, dates])
+        self.date_ints = np.concatenate([self.date_ints, date_ints])
+        self.months = np.concatenate([self.months, months])
+        self.days = np.concatenate([self.days, days])
+        self.month_first = np.concatenate([self.month_first, month_first])
+        self._lists = {}
+
+    def _lookup(self, name, barpos):
+        # scalar lookups go through plain lists, numpy scalars cost ~1us each;
+        # no wrap-around either, bars before the first one do not exist
+        if barpos < 0:
+            raise IndexError('barpos %d out of range' % barpos)
+        values = self._lists.get(name)
+        if values is None:
+            values = self._lists[name] = getattr(self, name).tolist()
+        return values[barpos]
+
+    def timetag(self, barpos):
+        return self._lookup('timetags', barpos)
+
+    def date(self, barpos):
+        return self._lookup('dates', barpos)
+
+    def month(self, barpos):
+        return self._lookup('dates', barpos)[:6]
+
+    def day(self, barpos):
+        return self._lookup('days', barpos)
+
+    def month_start(self, barpos):
+        return self._lookup('month_first', barpos)
+
+    def locate(self, date):
+        # barpos of the first bar on or after date ('YYYYMMDD' or int)
+        import numpy as np
+        return int(np.searchsorted(self.date_ints, int(date), 'left'))
+
+
+
+# Barra-style factors of the CMRA / DASTD / HSIGMA / STOM / STOQ / STOA scripts over a whole
+# universe. Inputs are float arrays with one column per stock, days (or months) as rows on one
+# trading calendar; a row without enough history is nan where the scripts would skip the bar.
+_STYLE_FACTORS = ('CMRA', 'DASTD', 'HSIGMA', 'STOM', 'STOQ', 'STOA')
+
+
+def _turnover_sums(volume, float_shares):
+    # sum of volume / circulating_capital over the 21 days up to each day, days without
+    # float shares counted as 0 as the scripts skip them
+    import numpy as np
+    days, stocks = volume.shape
+    result = np.full((days, stocks), np.nan)
+    rows = days - 20
+    if rows <= 0:
+        return result
+    with np.errstate(divide='ignore', invalid='ignore'):
+        turnover = np.where(float_shares != 0, volume / float_shares, 0.0)
+    total = np.zeros((rows, stocks))
+    for i in range(21):
+        total += turnover[i:i + rows]
+    result[20:] = total
+    return result
+
+
+def _factor_sto(sums, months):
+    # STOM.py for months=None: log of the 21-day turnover sum. STOQ.py (3) and STOA.py (12):
+    # log of the mean of exp(sum) over the sums ending 0, 21, 42... days back; the scripts
+    # exponentiate the raw sum, not its log, and so does this
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if months is None:
+            result = np.log(sums)
+        else:
+            result = np.full(sums.shape, np.nan)
+            span = 21 * (months - 1)
+            if len(sums) > span:
+                total = np.zeros((len(sums) - span, sums.shape[1]))
+                for i in range(months):
+                    total += np.exp(sums[span - 21 * i:len(sums) - 21 * i])
+                result[span:] = np.log(total / months)
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+
+def _cmra_value(excess):
+    # CMRA from the last 12 monthly excess log returns, oldest first: Z(m) sums the first m,
+    # CMRA = log((1 + max Z) / (1 + min Z))
+    import numpy as np
+    z = np.cumsum(excess, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.log((1 + z.max(axis=0)) / (1 + z.min(axis=0)))
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+
+class _DecayedWindow(object):
+    # running sums over the last `window` steps of per-step terms (_terms of the inputs), the
+    # newest step's term k weighted decays[k], the one before decays[k] ** 2 and so on. A step
+    # decays the sums, rids them of the step leaving the window and adds the new one, O(1) per
+    # series. Raw inputs sit in a ring written twice like _ValueWindow, which gives the leaving
+    # step and lets the sums be re-anchored every `window` steps so rounding cannot build up;
+    # `missing` counts the steps in the window with a non-finite input. An update with
+    # closed=False is a forming bar, undone by the next update (or discard).
+    def __init__(self, size, window, decays, channels):
+        import numpy as np
+        self.size = int(size)
+        self.window = self.need = int(window)
+        self.channels = channels
+        self.decays = np.asarray(decays, dtype=np.float64)[:, None]
+        self.oldest = self.decays ** self.window
+        self.term_weights = self.decays ** np.arange(self.window, 0, -1)
+        self.reset()
+
+    def reset(self):
+        import numpy as np
+        self.inputs = np.zeros((2 * self.window, self.channels, self.size))
+        self.count = 0
+        self.sums = np.zeros((len(self.decays), self.size))
+        self.missing = np.zeros(self.size, dtype=np.int64)
+        self.saved = None
+
+    def _terms(self, inputs):
+        raise NotImplementedError
+
+    @property
+    def ready(self):
+        return self.count >= self.window
+
+    def discard(self):
+        if self.saved is not None:
+            self.count, self.sums, self.missing, slot, row = self.saved
+            self.inputs[slot] = self.inputs[slot + self.window] = row
+            self.saved = None
+
+    def update(self, *inputs, **kwargs):
+        import numpy as np
+        closed = kwargs.get('closed', True)
+        self.discard()
+        slot = self.count % self.window
+        if not closed:
+            self.saved = (self.count, self.sums.copy(), self.missing.copy(), slot, self.inputs[slot].copy())
+        row = np.empty((self.channels, self.size))
+        row[:] = [np.broadcast_to(np.asarray(x, dtype=np.float64), (self.size, )) for x in inputs]
+        valid = np.isfinite(row).all(axis=0)
+        new = self._terms(np.where(valid, row, 0.0))
+        self.missing = self.missing + ~valid
+        if self.count >= self.window:
+            old_row = self.inputs[slot]
+            gone = np.isfinite(old_row).all(axis=0)
+            self.missing -= ~gone
+            self.sums = self.decays * (self.sums - self.oldest * self._terms(np.where(gone, old_row, 0.0)) + new)
+        else:
+            self.sums = self.decays * (self.sums + new)
+        self.inputs[slot] = self.inputs[slot + self.window] = row
+        self.count += 1
+        if closed and self.count % self.window == 0:
+            self._anchor()
+
+    def _window(self):
+        # (window, channels, size), oldest step first
+        end = (self.count - 1) % self.window + self.window + 1
+        return self.inputs[end - self.window:end]
+
+    def _anchor(self):
+        import numpy as np
+        window = self._window()
+        valid = np.isfinite(window).all(axis=1)
+        terms = self._terms(np.where(valid[:, None, :], window, 0.0).transpose(1, 0, 2))
+        self.sums = np.einsum('kw,kws->ks', self.term_weights, terms)
+        self.missing = (~valid).sum(axis=0)
+
+
+class EWMAVolatility(_DecayedWindow):
+    # DASTD's dispersion for a vector of series at once: over the last `window` values r_i,
+    # sqrt(sum(w_i * (r_i - mean)^2)) with w_i = h ** (window - i), h = 0.5 ** (1 / half_life)
+    # and an unweighted mean. Expanded, that is the sums of r, w * r and w * r^2. A series
+    # with a non-finite value in its window is nan; check=True also recomputes every read in
+    # full and keeps the largest gap in max_error.
+    def __init__(self, size, window = 250, half_life = 252, check = False):
+        decay = 0.5 ** (1.0 / half_life)
+        _DecayedWindow.__init__(self, size, window, (1.0, decay, decay), 1)
+        self.weights = self.term_weights[1]
+        self.weight_sum = self.weights.sum()
+        self.check = check
+        self.max_error = 0.0
+
+    def _terms(self, inputs):
+        import numpy as np
+        r = inputs[0]
+        return np.array([r, r, r * r])
+
+    def recompute(self):
+        # the same value from the window itself, the full recompute `check` compares against
+        import numpy as np
+        if not self.ready:
+            return np.full(self.size, np.nan)
+        window = self._window()[:, 0, :]
+        with np.errstate(invalid='ignore'):
+            return np.sqrt(self.weights.dot((window - window.mean(axis=0)) ** 2))
+
+    @property
+    def value(self):
+        import numpy as np
+        if not self.ready:
+            return np.full(self.size, np.nan)
+        total, weighted, squared = self.sums
+        mean = total / self.window
+        var = squared - 2 * mean * weighted + mean * mean * self.weight_sum
+        result = np.sqrt(np.maximum(var, 0.0))
+        result[self.missing > 0] = np.nan
+        if self.check:
+            gap = np.abs(result - self.recompute())
+            if np.isfinite(gap).any():
+                self.max_error = max(self.max_error, float(np.nanmax(gap)))
+        return result
+
+
+class RollingWLS(_DecayedWindow):
+    # weighted least squares of y on x with an intercept over the last `window` steps, weights
+    # h ** age with h = 0.5 ** (1 / half_life) and the newest step at age 1, for a vector of y
+    # series against one shared x series (or one x per series). From the sums of w, w x, w y,
+    # w x^2, w x y and w y^2 beta, alpha and the residual volatility sqrt(sum w e^2 / sum w)
+    # are O(1) per step; a series with a non-finite x or y in its window is nan.
+    def __init__(self, size, window = 252, half_life = 252):
+        decay = 0.5 ** (1.0 / half_life)
+        _DecayedWindow.__init__(self, size, window, (decay, ) * 6, 2)
+
+    def _terms(self, inputs):
+        import numpy as np
+        x, y = inputs[0], inputs[1]
+        return np.array([np.ones_like(x), x, y, x * x, x * y, y * y])
+
+    def _moments(self):
+        # weighted means of x and y, var x, cov xy, var y; nan rows where not defined
+        import numpy as np
+        w, wx, wy, wxx, wxy, wyy = self.sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mx = wx / w
+            my = wy / w
+            moments = [mx, my, wxx / w - mx * mx, wxy / w - mx * my, wyy / w - my * my]
+        undefined = (self.missing > 0) | (not self.ready)
+        for m in moments:
+            m[undefined] = np.nan
+        return moments
+
+    @property
+    def beta(self):
+        import numpy as np
+        mx, my, vx, cxy, vy = self._moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return cxy / vx
+
+    @property
+    def alpha(self):
+        import numpy as np
+        mx, my, vx, cxy, vy = self._moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return my - cxy / vx * mx
+
+    @property
+    def value(self):
+        import numpy as np
+        mx, my, vx, cxy, vy = self._moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(np.maximum(vy - cxy * cxy / vx, 0.0))
+
+    def recompute(self):
+        # residual volatility refitted from the window, two-pass
+        import numpy as np
+        if not self.ready:
+            return np.full(self.size, np.nan)
+        window = self._window()
+        w = self.term_weights[0][:, None]
+        x, y = window[:, 0, :], window[:, 1, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total = w.sum()
+            mx = (w * x).sum(axis=0) / total
+            my = (w * y).sum(axis=0) / total
+            beta = (w * (x - mx) * (y - my)).sum(axis=0) / (w * (x - mx) ** 2).sum(axis=0)
+            e = y - my - beta * (x - mx)
+            return np.sqrt((w * e * e).sum(axis=0) / total)
+
+
+def _report_changes(record, field):
+    # one field of a raw financial record ({field: {report time: value}}, report times as
+    # timetags or 'YYYYMMDD') as (YYYYMMDD int64, float64) arrays in date order
+    import numpy as np
+    series = None
+    if record:
+        series = record.get(field)
+        if series is None:
+            series = record.get(field.split('.')[-1])
+    if not series:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    keys = list(series.keys())
+    values = np.array([series[k] for k in keys], dtype=np.float64)
+    if isinstance(keys[0], str):
+        dates = np.array([int(k[:8]) for k in keys], dtype=np.int64)
+    else:
+        dates = _timetags_to_datetime(np.array(keys, dtype=np.int64), '%Y%m%d').astype(np.int64)
+    order = np.argsort(dates, kind='stable')
+    return dates[order], values[order]
+
+
+class _FloatShareStore(object):
+    # circulating_capital per stock as a step function of the report date: the change history
+    # comes in one get_raw_financial_data call for every stock not held yet, and once the
+    # calendar moves past what was asked for, one more call brings the reports since. A day's
+    # value is the newest report dated on or before it, nan before the first.
+    FIELD = 'CAPITALSTRUCTURE.circulating_capital'
+
+    def __init__(self):
+        self.history = {}
+        self.through = {}
+        self.fetches = 0
+
+    def clear(self):
+        self.history.clear()
+        self.through.clear()
+
+    def _load(self, context, stocks, start, end):
+        import numpy as np
+        raw = context.context.get_financial_data([self.FIELD], list(stocks), start, str(end), 'report_time', 'dict', True) or {}
+        self.fetches += 1
+        for stock in stocks:
+            dates, values = _report_changes(raw.get(stock), self.FIELD)
+            held = self.history.get(stock)
+            if held is not None and len(held[0]):
+                # reports dated within what is held already are replaced by the new call's
+                keep = held[0] < dates[0] if len(dates) else slice(None)
+                dates = np.concatenate([held[0][keep], dates])
+                values = np.concatenate([held[1][keep], values])
+            self.history[stock] = (dates, values)
+            self.through[stock] = end
+
+    def align(self, context, stocks, date_ints):
+        # (days, stocks) circulating_capital in force on each of date_ints
+        import numpy as np
+        result = np.full((len(date_ints), len(stocks)), np.nan)
+        if not len(date_ints):
+            return result
+        end = int(date_ints[-1])
+        missing = [s for s in stocks if s not in self.history]
+        if missing:
+            self._load(context, missing, '', end)
+        stale = [s for s in stocks if self.through[s] < end]
+        if stale:
+            since = min(self.through[s] for s in stale)
+            self._load(context, stale, (dt.datetime.strptime(str(since), '%Y%m%d') + dt.timedelta(days=1)).strftime('%Y%m%d'), end)
+        for j, stock in enumerate(stocks):
+            dates, values = self.history[stock]
+            if len(dates):
+                pos = np.searchsorted(dates, date_ints, 'right') - 1
+                result[:, j] = np.where(pos >= 0, values[np.maximum(pos, 0)], np.nan)
+        return result
+
+
+class _FactorStream(object):
+    # one universe's daily inputs and factor rows, from `start` on. Each call appends the days
+    # since the previous one; the newest day may still be forming, so it is fetched again and
+    # its rows replaced, the streaming operators dropping their update for it first.
+    def __init__(self, stocks, factors, start):
+        import numpy as np
+        size = len(stocks)
+        self.stocks = list(stocks)
+        self.factors = list(factors)
+        self.start = start
+        self.date_ints = np.zeros(0, dtype=np.int64)
+        self.close = np.zeros((0, size))
+        self.volume = np.zeros((0, size))
+        self.shares = np.zeros((0, size))
+        self.bench = np.zeros(0)
+        self.rates = np.zeros(0)
+        self.values = dict((f, np.zeros((0, size))) for f in factors)
+        self.dastd = EWMAVolatility(size, check=_StyleFactorEngine.CHECK) if 'DASTD' in factors else None
+        self.hsigma = RollingWLS(size) if 'HSIGMA' in factors else None
+        if 'CMRA' in factors:
+            # month-end closes by YYYYMM, one per stock, and the 12 excess log returns
+            # CMRA is made of; `month` is the month the current value belongs to
+            self.month_ends = OrderedDict()
+            self.excess = np.full((12, size), np.nan)
+            self.month = 0
+            self.cmra = np.full(size, np.nan)
+
+
+class _StyleFactorEngine(object):
+    # per universe, a _FactorStream fed from one daily close/volume panel (plus the HSIGMA
+    # benchmark) per call, the first reaching LOOKBACK_DAYS calendar days before the first date
+    # asked for and later ones only the days added since; float shares come from the
+    # _FloatShareStore. DASTD and HSIGMA advance by one EWMAVolatility / RollingWLS step per day
+    # for all stocks, CMRA by one monthly return per month and the turnover factors are array
+    # operations over the last 251 days. Risk-free rates come from the chart bar of the same
+    # date, kept per barpos, and for CMRA per month.
+    BENCHMARK = '000300.SH'
+    LOOKBACK_DAYS = 420
+    CHECK = False
+
+    def __init__(self):
+        self.risk_free = {}
+        self.streams = {}
+        self.float_shares = _FloatShareStore()
+        self.monthly_risk_free = {}
+
+    def clear(self):
+        self.risk_free.clear()
+        self.monthly_risk_free.clear()
+        self.streams.clear()
+        self.float_shares.clear()
+
+    def _days_before(self, date, days):
+        return int((dt.datetime.strptime(str(date), '%Y%m%d') - dt.timedelta(days=days)).strftime('%Y%m%d'))
+
+    def compute(self, context, stocks, start_time, end_time, factors, risk_free, dividend_type):
+        import pandas as pd
+        if isinstance(stocks, str):
+            stocks = [stocks]
+        factors = [f.upper() for f in ([factors] if isinstance(factors, str) else factors or _STYLE_FACTORS)]
+        unknown = [f for f in factors if f not in _STYLE_FACTORS]
+        if unknown:
+            raise ValueError("factors must be among " + ", ".join(_STYLE_FACTORS))
+        end = int(str(end_time or context.get_bar_timeline().date(context.barpos))[:8])
+        start = int(str(start_time or end)[:8])
+        first = self._days_before(start, self.LOOKBACK_DAYS)
+        key = (tuple(stocks), dividend_type, risk_free)
+        stream = self.streams.get(key)
+        if stream is None or first < stream.start or not set(factors).issubset(stream.factors):
+            if stream is not None:
+                first = min(first, stream.start)
+                factors_held = [f for f in _STYLE_FACTORS if f in factors or f in stream.factors]
+            else:
+                factors_held = factors
+            stream = self.streams[key] = _FactorStream(stocks, factors_held, first)
+        if not len(stream.date_ints) or end >= stream.date_ints[-1]:
+            self._extend(context, stream, end, risk_free, dividend_type)
+        rows = (stream.date_ints >= start) & (stream.date_ints <= end)
+        dates = [str(d) for d in stream.date_ints[rows].tolist()]
+        return OrderedDict((f, pd.DataFrame(stream.values[f][rows], index=dates, columns=list(stocks))) for f in factors)
+
+    def _extend(self, context, stream, end, risk_free, dividend_type):
+        import numpy as np
+        held = len(stream.date_ints)
+        since = int(stream.date_ints[-1]) if held else stream.start
+        codes = list(stream.stocks)
+        if 'HSIGMA' in stream.factors and self.BENCHMARK not in codes:
+            codes.append(self.BENCHMARK)
+        fields = ['close', 'volume']
+        panel = _build_market_panel(
+            context.context.get_market_data2(fields, codes, '1d', str(since), str(end), -1, dividend_type, True, True),
+            fields, codes)
+        date_ints = np.array([int(str(t)[:8]) for t in panel.stime], dtype=np.int64)
+        if not len(date_ints):
+            return
+
+        def matrix(field, names):
+            block = np.full((len(date_ints), len(names)), np.nan)
+            for j, code in enumerate(names):
+                if code in panel:
+                    block[:, j] = panel.get(code, field)
+            return block
+
+        # the newest day held is fetched again, everything from it on is replaced
+        keep = held - 1 if held and date_ints[0] == stream.date_ints[-1] else held
+        if keep < held:
+            for operator in (stream.dastd, stream.hsigma):
+                if operator is not None:
+                    operator.discard()
+        stream.date_ints = np.concatenate([stream.date_ints[:keep], date_ints])
+        stream.close = np.concatenate([stream.close[:keep], matrix('close', stream.stocks)])
+        stream.rates = np.concatenate([stream.rates[:keep], self._risk_free(context, date_ints, risk_free)])
+        if 'HSIGMA' in stream.factors:
+            stream.bench = np.concatenate([stream.bench[:keep], matrix('close', [self.BENCHMARK])[:, 0]])
+        turnover = [f for f in stream.factors if f in ('STOM', 'STOQ', 'STOA')]
+        if turnover:
+            shares = self.float_shares.align(context, stream.stocks, date_ints)
+            stream.volume = np.concatenate([stream.volume[:keep], matrix('volume', stream.stocks)])
+            stream.shares = np.concatenate([stream.shares[:keep], shares])
+        total = len(stream.date_ints)
+        for f in stream.factors:
+            values = stream.values[f]
+            stream.values[f] = np.concatenate([values[:keep], np.full((total - keep, values.shape[1]), np.nan)])
+
+        if stream.dastd is not None:
+            # DASTD of a day covers the returns up to the day before, so it is read before
+            # that day's return goes in
+            close = stream.close
+            out = stream.values['DASTD']
+            for t in range(keep, total):
+                out[t] = stream.dastd.value
+                if t:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        ret = close[t] / close[t - 1] - 1.0
+                    stream.dastd.update(ret, closed=t < total - 1)
+        if stream.hsigma is not None:
+            # HSIGMA of a day regresses the excess returns up to and including that day
+            close, bench = stream.close, stream.bench
+            out = stream.values['HSIGMA']
+            excess = np.nan_to_num(stream.rates) / 36500.0
+            for t in range(max(keep, 1), total):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    x = bench[t] / bench[t - 1] - 1.0
+                    y = close[t] / close[t - 1] - 1.0 - excess[t]
+                stream.hsigma.update(x, y, closed=t < total - 1)
+                out[t] = stream.hsigma.value
+        if 'CMRA' in stream.factors:
+            self._step_cmra(stream, keep, risk_free)
+        if turnover:
+            # the newest STOA reaches 11 * 21 + 20 days back
+            tail = max(keep - 251, 0)
+            sums = _turnover_sums(stream.volume[tail:], stream.shares[tail:])
+            for name in turnover:
+                stream.values[name][keep:] = _factor_sto(sums, {'STOM': None, 'STOQ': 3, 'STOA': 12}[name])[keep - tail:]
+
+    def _step_cmra(self, stream, keep, risk_free):
+        # on the first day of a calendar month the month before is complete: its month-end
+        # close over the previous one, less log(1 + rf / 1200) with rf from the month's first
+        # day (3.5 when not positive), goes into the last 12 and CMRA is recomputed from them;
+        # the value holds until the next month. A day fetched again re-enters its month
+        # without rolling it a second time.
+        import numpy as np
+        months = stream.date_ints // 100
+        close = stream.close
+        out = stream.values['CMRA']
+        for t in range(keep, len(months)):
+            month = int(months[t])
+            if month > stream.month:
+                if stream.month:
+                    done = stream.month
+                    end = close[t - 1]
+                    previous = next(reversed(stream.month_ends.values())) if stream.month_ends else np.nan
+                    rate = self.monthly_risk_free.get(done, np.nan) if risk_free is None else float(risk_free)
+                    rate = rate if rate > 0 else 3.5
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        excess = np.log(end / previous) - np.log(1 + rate / 1200.0)
+                    stream.month_ends[done] = end
+                    while len(stream.month_ends) > 12:
+                        stream.month_ends.popitem(last=False)
+                    stream.excess = np.concatenate([stream.excess[1:], excess[None, :]])
+                    stream.cmra = _cmra_value(stream.excess)
+                if risk_free is None and month not in self.monthly_risk_free:
+                    self.monthly_risk_free[month] = stream.rates[t]
+                stream.month = month
+            out[t] = stream.cmra
+
+    def _risk_free(self, context, date_ints, risk_free):
+        # annual % per panel day: `risk_free` when given, otherwise the terminal's rate at the
+        # chart bar of that date; nan for dates not on the chart
+        import numpy as np
+        if risk_free is not None:
+            return np.full(len(date_ints), float(risk_free))
+        timeline = context.get_bar_timeline()
+        rates = np.full(len(date_ints), np.nan)
+        if not len(timeline):
+            return rates
+        pos = np.minimum(np.searchsorted(timeline.date_ints, date_ints, 'left'), len(timeline) - 1)
+        for k in np.flatnonzero(timeline.date_ints[pos] == date_ints).tolist():
+            barpos = int(pos[k])
+            rate = self.risk_free.get(barpos)
+            if rate is None:
+                rate = self.risk_free[barpos] = context.get_risk_free_rate(barpos)
+            rates[k] = rate
+        return rates
+
+_PROFILED_GLOBALS = ('passorder', 'order_volume', 'order_shares', 'order_lots', 'order_value', 'order_percent',
+                     'order_target_value', 'order_target_percent', 'get_trade_detail_data', 'cancel',
+                     'smart_algo_passorder', 'algo_passorder')
+
+
+def _payload_bytes(value, depth = 2):
+    # rough size of a returned payload: buffers for arrays and frames; a container counts
+    # as `len` times its first element, sized `depth` levels down, so a dict of thousands
+    # of frames costs one element walk per level rather than one per item
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None and not callable(nbytes):
+        return int(nbytes)
+    columns = getattr(value, 'columns', None)
+    if columns is not None and hasattr(value, 'index'):
+        # 8 bytes a cell (float64 quotes); memory_usage builds a Series, ~0.5 ms a frame
+        return int(value.index.nbytes) + len(value.index) * len(columns) * 8
+    size = sys.getsizeof(value)
+    if depth > 0 and isinstance(value, (dict, list, tuple)) and value:
+        sample = next(iter(value.values())) if isinstance(value, dict) else value[0]
+        size += len(value) * _payload_bytes(sample, depth - 1)
+    return size
+
+
+class _MethodStats(object):
+    __slots__ = ('calls', 'seconds', 'bytes', 'samples', 'bar_calls', 'bar_seconds', 'bar_bytes', 'bars')
+
+    def __init__(self, samples, window):
+        import collections
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.samples = collections.deque(maxlen=samples)
+        self.bar_calls = 0
+        self.bar_seconds = 0.0
+        self.bar_bytes = 0
+        self.bars = collections.deque(maxlen=window)
+
+
+_CALL_SITE_LINES = {}
+_PROFILER_CODES = set()
+
+def _call_site_line(depth = 2):
+    # line number of the strategy code calling a draw_* helper; a call site is fixed by its
+    # code object and bytecode offset, so f_lineno (a line table walk) is read once per site.
+    # A profiler's timing wrapper in between is not the caller
+    frame = sys._getframe(depth)
+    while frame.f_code in _PROFILER_CODES:
+        frame = frame.f_back
+    key = (frame.f_code, frame.f_lasti)
+    line = _CALL_SITE_LINES.get(key)
+    if line is None:
+        line = _CALL_SITE_LINES[key] = frame.f_lineno
+    return line
+
+
+class _MethodProfiler(object):
+    # opt-in per-method accounting for one ContextInfo and the terminal's trading functions.
+    # Enabling swaps timing wrappers onto the class (and the given namespace), which time
+    # only the profiled context; disabling puts the originals back, so a process without a
+    # profiler runs the plain methods. Counters roll into a window of per-bar totals at
+    # every resume_context_info.
+    SAMPLES = 4096
+
+    def __init__(self, path = '', paint = False, every = 0, window = 250, top = 5):
+        self.path = path
+        self.paint = paint
+        self.every = every or window
+        self.window = window
+        self.top = top
+        self.stats = OrderedDict()
+        self.patched = []
+        self.bars = 0
+        self.barpos = None
+
+    def _wrap(self, name, func, owner = None):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = _MethodStats(self.SAMPLES, self.window)
+        clock = time.perf_counter
+
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            if owner is not None and args[0] is not owner:
+                return func(*args, **kwargs)
+            start = clock()
+            result = func(*args, **kwargs)
+            cost = clock() - start
+            size = _payload_bytes(result) if result is not None else 0
+            stats.calls += 1
+            stats.seconds += cost
+            stats.bytes += size
+            stats.samples.append(cost)
+            stats.bar_calls += 1
+            stats.bar_seconds += cost
+            stats.bar_bytes += size
+            return result
+        _PROFILER_CODES.add(profiled.__code__)
+        return profiled
+
+    def install(self, cls, context, namespace = None):
+        if any(getattr(func, '__code__', None) in _PROFILER_CODES for func in vars(cls).values()):
+            raise RuntimeError('another ContextInfo is being profiled; disable_profiling it first')
+        for name, func in list(vars(cls).items()):
+            if name.startswith('_') or not callable(func) or isinstance(func, (type, staticmethod, classmethod)):
+                continue
+            if name in ('enable_profiling', 'disable_profiling', 'get_profile_summary'):
+                continue
+            self.patched.append((cls, name, func))
+            setattr(cls, name, self._wrap(name, func, context))
+        if namespace is not None:
+            for name in _PROFILED_GLOBALS:
+                func = namespace.get(name)
+                if callable(func):
+                    self.patched.append((namespace, name, func))
+                    namespace[name] = self._wrap(name, func)
+
+    def uninstall(self):
+        for owner, name, func in reversed(self.patched):
+            if isinstance(owner, dict):
+                owner[name] = func
+            else:
+                setattr(owner, name, func)
+        self.patched = []
+
+    def on_bar(self, context):
+        # close the bar that just ran
+        if self.barpos is not None:
+            self.bars += 1
+            for stats in self.stats.values():
+                stats.bars.append((stats.bar_calls, stats.bar_seconds, stats.bar_bytes))
+                stats.bar_calls = stats.bar_seconds = stats.bar_bytes = 0
+            if self.paint:
+                self._paint(context, self.barpos)
+            if self.path and self.bars % self.every == 0:
+                self.export()
+        self.barpos = context.barpos
+
+    def _paint(self, context, barpos):
+        # the heaviest methods of the window, as ms spent in the bar that just ran
+        paint = getattr(_PyContextBase.paint, '__wrapped__', _PyContextBase.paint)
+        ranked = sorted(self.stats.items(), key=lambda item: -sum(b[1] for b in item[1].bars))
+        for name, stats in ranked[:self.top]:
+            if stats.bars:
+                paint(context, 'prof:' + name, stats.bars[-1][1] * 1e3, barpos, 0, 'noaxis')
+
+    def summary(self):
+        # per method, heaviest first: totals, latency percentiles over the last SAMPLES calls
+        # and per-bar means over the window
+        result = []
+        for name, stats in self.stats.items():
+            if not stats.calls:
+                continue
+            samples = sorted(stats.samples)
+            bars = len(stats.bars) or 1
+            result.append(OrderedDict([
+                ('method', name),
+                ('calls', stats.calls),
+                ('total_ms', stats.seconds * 1e3),
+                ('p50_us', samples[len(samples) // 2] * 1e6),
+                ('p99_us', samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1e6),
+                ('calls_per_bar', sum(b[0] for b in stats.bars) / float(bars)),
+                ('ms_per_bar', sum(b[1] for b in stats.bars) * 1e3 / bars),
+                ('bytes_per_bar', sum(b[2] for b in stats.bars) / float(bars)),
+            ]))
+        result.sort(key=lambda row: -row['total_ms'])
+        return result
+
+    def export(self):
+        import json
+        line = OrderedDict([('time', time.strftime('%Y-%m-%d %H:%M:%S')), ('barpos', self.barpos),
+                            ('bars', self.bars), ('methods', self.summary())])
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+
+def _is_internal_attr(name):
+    return name == "context" or name.startswith("z8sglma_")
+
+
+_PyContextBase = __PyContext
+
+
+class _CowPyContext(__PyContext):
+    # installed by set_snapshot_mode('cow'); tracks containers as they are assigned
+    def __setattr__(self, name, value):
+        if not _is_internal_attr(name):
+            value = _cow_wrap(value, self.z8sglma_cow)
+        object.__setattr__(self, name, value)
+
+
+_MISSING = object()
+_COW_ATOMIC_TYPES = (type(None), bool, str, bytes, numbers.Number, dt.date, dt.time, dt.timedelta)
+
+
+def _cow_atomic(value):
+    if isinstance(value, _COW_ATOMIC_TYPES):
+        return True
+    if type(value) is tuple or type(value) is frozenset:
+        return all(_cow_atomic(v) for v in value)
+    return False
+
+
+class _CowMapping(object):
+    # first write to a key after a checkpoint records its old value in _cow_log;
+    # deleting or reordering checkpointed keys falls back to one flat copy in _cow_base
+    _cow_owner = None
+    _cow_flat = True
+    _cow_log = None
+    _cow_base = None
+
+    def _cow_touch(self, key):
+        if self._cow_owner is None or self._cow_base is not None:
+            return
+        log = self._cow_log
+        if log is None:
+            self._cow_owner.dirty.append(self)
+            log = self._cow_log = {}
+        if key not in log:
+            log[key] = self.get(key, _MISSING)
+
+    def _cow_fresh(self, key):
+        return self._cow_log is not None and self._cow_log.get(key) is _MISSING
+
+    def _cow_save(self):
+        if self._cow_owner is None or self._cow_base is not None:
+            return
+        log = self._cow_log
+        if log is None:
+            self._cow_owner.dirty.append(self)
+            self._cow_base = list(self.items())
+        else:
+            self._cow_base = [(k, log.get(k, v)) for k, v in self.items() if log.get(k) is not _MISSING]
+            self._cow_log = None
+
+    def _cow_commit(self):
+        self._cow_log = None
+        self._cow_base = None
+
+    def _cow_rollback(self):
+        plain = self._cow_plain
+        if self._cow_base is not None:
+            plain.clear(self)
+            for k, v in self._cow_base:
+                plain.__setitem__(self, k, v)
+        elif self._cow_log:
+            for k, v in self._cow_log.items():
+                if v is not _MISSING:
+                    plain.__setitem__(self, k, v)
+                elif k in self:
+                    plain.__delitem__(self, k)
+        self._cow_log = None
+        self._cow_base = None
+
+    def __setitem__(self, key, value):
+        self._cow_touch(key)
+        if self._cow_flat and not _cow_atomic(value):
+            self._cow_flat = False
+        self._cow_plain.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if not self._cow_fresh(key):
+            self._cow_save()
+        self._cow_plain.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self._cow_plain.__getitem__(self, key)
+            self.__delitem__(key)
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self, *args):
+        self._cow_save()
+        return self._cow_plain.popitem(self, *args)
+
+    def clear(self):
+        self._cow_save()
+        self._cow_plain.clear(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self._cow_plain.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def copy(self):
+        return self._cow_plain(self)
+
+    def __reduce_ex__(self, protocol):
+        return (self._cow_plain, (self._cow_plain(self),))
+
+
+class _CowDict(_CowMapping, dict):
+    _cow_plain = dict
+
+
+class _CowOrderedDict(_CowMapping, OrderedDict):
+    _cow_plain = OrderedDict
+
+    def move_to_end(self, key, last=True):
+        self._cow_save()
+        OrderedDict.move_to_end(self, key, last)
+
+
+class _CowList(list):
+    # appends only remember the checkpoint length; any other edit saves one flat copy
+    _cow_plain = list
+    _cow_owner = None
+    _cow_flat = True
+    _cow_len = None
+    _cow_base = None
+
+    def _cow_grow(self, items):
+        if self._cow_owner is None:
+            return
+        if self._cow_base is None and self._cow_len is None:
+            self._cow_owner.dirty.append(self)
+            self._cow_len = len(self)
+        if self._cow_flat and not all(_cow_atomic(v) for v in items):
+            self._cow_flat = False
+
+    def _cow_save(self, items=()):
+        if self._cow_owner is None:
+            return
+        if self._cow_base is None:
+            if self._cow_len is None:
+                self._cow_owner.dirty.append(self)
+                self._cow_base = list(self)
+            else:
+                self._cow_base = list.__getitem__(self, slice(0, self._cow_len))
+                self._cow_len = None
+        if self._cow_flat and not all(_cow_atomic(v) for v in items):
+            self._cow_flat = False
+
+    def _cow_commit(self):
+        self._cow_len = None
+        self._cow_base = None
+
+    def _cow_rollback(self):
+        if self._cow_base is not None:
+            list.__setitem__(self, slice(None), self._cow_base)
+        elif self._cow_len is not None:
+            list.__delitem__(self, slice(self._cow_len, None))
+        self._cow_len = None
+        self._cow_base = None
+
+    def append(self, value):
+        self._cow_grow((value,))
+        list.append(self, value)
+
+    def extend(self, values):
+        values = list(values)
+        self._cow_grow(values)
+        list.extend(self, values)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self._cow_save(value)
+        else:
+            self._cow_save((value,))
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self._cow_save()
+        list.__delitem__(self, index)
+
+    def insert(self, index, value):
+        self._cow_save((value,))
+        list.insert(self, index, value)
+
+    def pop(self, *args):
+        self._cow_save()
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self._cow_save()
+        list.remove(self, value)
+
+    def clear(self):
+        self._cow_save()
+        list.clear(self)
+
+    def sort(self, *args, **kwargs):
+        self._cow_save()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._cow_save()
+        list.reverse(self)
+
+    def __imul__(self, n):
+        self._cow_save()
+        return list.__imul__(self, n)
+
+    def copy(self):
+        return list(self)
+
+    def __reduce_ex__(self, protocol):
+        return (list, (list(self),))
+
+
+_COW_TYPES = (_CowDict, _CowOrderedDict, _CowList)
+
+
+def _cow_wrap(value, owner):
+    if owner is None:
+        return value
+    t = type(value)
+    if t is dict:
+        tracked = _CowDict(value)
+    elif t is OrderedDict:
+        tracked = _CowOrderedDict(value)
+    elif t is list:
+        tracked = _CowList(value)
+    else:
+        return value
+    tracked._cow_owner = owner
+    tracked._cow_flat = all(_cow_atomic(v) for v in (tracked if t is list else tracked.values()))
+    return tracked
+
+
+class _CowSnapshot(object):
+    # the live attributes are the snapshot: flat tracked containers and atomic values
+    # are shared by reference, everything else is deep copied as before
+    def __init__(self):
+        self.dirty = []
+        self.refs = None
+        self.copies = {}
+
+    def _shared(self, value):
+        if isinstance(value, _COW_TYPES):
+            return value._cow_owner is self and value._cow_flat
+        return _cow_atomic(value)
+
+    def checkpoint(self, context_info):
+        for tracked in self.dirty:
+            tracked._cow_commit()
+        self.dirty = []
+        refs = {}
+        copies = {}
+        memo = {}
+        for k, v in list(context_info.__dict__.items()):
+            if _is_internal_attr(k):
+                continue
+            if self._shared(v):
+                refs[k] = v
+            else:
+                copies[k] = copy.deepcopy(v, memo)
+        self.refs = refs
+        self.copies = copies
+
+    def restore(self, context_info):
+        if self.refs is None:
+            return
+        for tracked in self.dirty:
+            tracked._cow_rollback()
+        self.dirty = []
+        attrs = context_info.__dict__
+        for k, v in self.refs.items():
+            if attrs.get(k, _MISSING) is not v:
+                attrs[k] = v
+        if self.copies:
+            memo = {}
+            for k, v in self.copies.items():
+                setattr(context_info, k, copy.deepcopy(v, memo))
+
+
 def resume_context_info(context_info):
+    context_info.z8sglma_history.runs += 1
+    for dispatcher in list(context_info.z8sglma_whole_quote.values()):
+        dispatcher.poll()
+    if context_info.z8sglma_profiler is not None:
+        context_info.z8sglma_profiler.on_bar(context_info)
     last_barpos = context_info.z8sglma_last_barpos
+    cow = context_info.z8sglma_cow
     if context_info.barpos == last_barpos:
+        if cow is not None:
+            cow.restore(context_info)
+            return
         for k, v in list(context_info.z8sglma_last_version.__dict__.items()):
-            if k == "context":
-                continue
-            elif k == "z8sglma_last_version":
+            if _is_internal_attr(k):
                 continue
             else:
                 setattr(context_info, k, copy.deepcopy(v))
@@ -1031,6 +3279,9 @@ def resume_context_info(context_info):
         # print "not repeat, barpos:", args[0].barpos
         # print "curr bar: %i last bar: %i" % (args[0].barpos, context_info.last_barpos)
         context_info.z8sglma_last_barpos = context_info.barpos
+        if cow is not None:
+            cow.checkpoint(context_info)
+            return
         context_info.z8sglma_last_version = copy.deepcopy(context_info)
 
 def request_general_file(strReq, callback):
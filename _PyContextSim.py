@@ -0,0 +1,863 @@
+#coding:utf-8
+# Offline stand-in for the terminal's native ContextInfo, replaying bars from local files,
+# so strategy files can be run, profiled and benchmarked outside the terminal.
+#
+#   python _PyContextSim.py DATA_DIR STRATEGY.py 600900.SH            replay the whole chart
+#   python _PyContextSim.py DATA_DIR STRATEGY.py 600900.SH --period 5m --start 20230101 --quiet
+#   python _PyContextSim.py DATA_DIR STRATEGY.py 600900.SH --profile 25
+#
+# DATA_DIR layout, each table as .npy (structured array), .csv or .parquet:
+#   <period>/<code>.<ext>     bars: a time column (ms timetag, YYYYMMDD[HHMMSS] or datetime)
+#                             plus open / high / low / close / volume / amount / ...
+#   tick/<code>.<ext>         optional ticks for get_full_tick: time, lastPrice, ... ;
+#                             without them the tick is made from the current bar
+#   financial/<code>.<ext>    optional reports: m_timetag (report date), m_anntime (announce
+#                             date) and one column per field, 'TABLE.field' or just 'field'
+#   instrument.<ext>          optional, one row per code with a 'code' column and
+#                             get_instrumentdetail fields
+#   sectors.json              optional, {sector name: [codes]}
+#
+# Data is used as stored: dividend_type is not applied. Orders fill at once, at the given
+# price for fixed-price orders and at the current close otherwise.
+import contextlib
+import json
+import numbers
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import _PyContextInfo as pci
+
+PyContext = getattr(pci, '__PyContext')
+
+_TIME_COLUMNS = ('time', 'timetag', 'stime', 'date', 'datetime', 'trade_date')
+_TABLE_EXTS = ('.npy', '.parquet', '.csv')
+
+
+def _read_table(path):
+    # {column: ndarray}
+    if path.endswith('.npy'):
+        array = np.load(path, allow_pickle=False)
+        return OrderedDict((name, array[name]) for name in array.dtype.names)
+    import pandas as pd
+    frame = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+    return OrderedDict((str(name), frame[name].to_numpy()) for name in frame.columns)
+
+
+def _find_table(root, *parts):
+    base = os.path.join(root, *parts)
+    for ext in _TABLE_EXTS:
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+
+def _midnights(dates):
+    # local midnight, in ms, of YYYYMMDD ints; timetag_to_datetime reads timetags as local time
+    unique, inverse = np.unique(dates, return_inverse=True)
+    midnight = np.array([time.mktime((int(d) // 10000, int(d) // 100 % 100, int(d) % 100, 0, 0, 0, 0, 0, -1))
+                         for d in unique]) * 1000
+    return midnight.astype(np.int64)[inverse]
+
+
+def _to_timetags(column):
+    # ms timetags from ms ints, YYYYMMDD / YYYYMMDDHHMMSS digits or strings, or datetime64
+    column = np.asarray(column)
+    if column.dtype.kind == 'M':
+        column = np.array([int(str(t)[:19].replace('-', '').replace('T', '').replace(':', '').ljust(14, '0'))
+                           for t in column.astype('datetime64[s]')], dtype=np.int64)
+    elif column.dtype.kind not in 'iuf':
+        unique, inverse = np.unique(column.astype(str), return_inverse=True)
+        digits = [''.join(c for c in s if c.isdigit())[:14] for s in unique]
+        column = np.array([int(d.ljust(14, '0')) if len(d) > 8 else int(d) for d in digits], dtype=np.int64)[inverse]
+    column = column.astype(np.int64)
+    if column.size == 0 or 10 ** 11 <= column.max() < 10 ** 13:
+        return column
+    long = column >= 10 ** 13
+    dates = np.where(long, column // 1000000, column)
+    clock = np.where(long, column % 1000000, 0)
+    seconds = clock // 10000 * 3600 + clock // 100 % 100 * 60 + clock % 100
+    return _midnights(dates) + seconds * 1000
+
+
+def _date_int(timetag):
+    return int(pci.timetag_to_datetime(timetag, '%Y%m%d'))
+
+
+def _parse_time(value, end = False):
+    # '' / YYYYMMDD / YYYYMMDDHHMMSS (any separators) to a ms timetag; a bare end date
+    # covers the whole day
+    if value in ('', None):
+        return None
+    digits = ''.join(c for c in str(value) if c.isdigit())
+    if end and len(digits) <= 8:
+        digits = digits[:8] + '235959'
+    return int(_to_timetags(np.array([int(digits.ljust(8, '0')[:14])]))[0])
+
+
+def _is_daily(period):
+    return period.endswith('d') or period.endswith('w') or period in ('1mon', '1q', '1hy', '1y')
+
+
+class _Series(object):
+    # one table on a ms time axis; numeric columns as float64, the rest kept as they are
+    def __init__(self, table):
+        name = next((c for c in _TIME_COLUMNS if c in table), None)
+        if name is None:
+            raise ValueError('no time column, expected one of ' + ', '.join(_TIME_COLUMNS))
+        times = _to_timetags(table[name])
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.fields = OrderedDict()
+        for key, values in table.items():
+            if key in _TIME_COLUMNS:
+                continue
+            values = np.asarray(values)[order]
+            self.fields[key] = values.astype(np.float64) if values.dtype.kind in 'biuf' else values
+        self._stime = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def stime(self, period):
+        key = _is_daily(period)
+        if key not in self._stime:
+            self._stime[key] = pci.timetag_to_datetime(self.times, '%Y%m%d' if key else '%Y%m%d%H%M%S')
+        return self._stime[key]
+
+    def end(self, timetag):
+        # rows at or before timetag
+        return int(np.searchsorted(self.times, timetag, 'right'))
+
+    def window(self, start, end, count):
+        stop = self.end(end)
+        begin = int(np.searchsorted(self.times, start, 'left')) if start is not None else 0
+        if count is not None and count >= 0:
+            begin = max(begin, stop - count)
+        return begin, stop
+
+    def column(self, field):
+        values = self.fields.get(field)
+        if values is None:
+            return np.full(len(self.times), np.nan)
+        return values
+
+
+class BarStore(object):
+    # lazily loaded tables under DATA_DIR, see the layout at the top of this file
+    def __init__(self, root):
+        self.root = root
+        self.series = {}
+        self.instruments = None
+        self.sectors = None
+
+    def bars(self, code, period):
+        key = (period, code)
+        if key not in self.series:
+            path = _find_table(self.root, period, code)
+            self.series[key] = _Series(_read_table(path)) if path else None
+        return self.series[key]
+
+    def financial(self, code):
+        key = ('financial', code)
+        if key not in self.series:
+            path = _find_table(self.root, 'financial', code)
+            series = None
+            if path:
+                table = _read_table(path)
+                # reports are looked up by either date; the table's time axis is the report date
+                table['time'] = table.get('m_timetag', table.get('time'))
+                series = _Series(table)
+                announced = series.fields.get('m_anntime')
+                series.fields['m_anntime'] = _to_timetags(announced) if announced is not None else series.times
+            self.series[key] = series
+        return self.series[key]
+
+    def daily(self, code, period):
+        # daily bars when there are any, else the given period
+        series = self.bars(code, '1d')
+        return series if series is not None else self.bars(code, period)
+
+    def instrument(self, code):
+        if self.instruments is None:
+            self.instruments = {}
+            path = _find_table(self.root, 'instrument')
+            if path:
+                table = _read_table(path)
+                codes = table.pop('code')
+                for i, c in enumerate(codes):
+                    self.instruments[str(c)] = dict((k, v[i].item() if hasattr(v[i], 'item') else v[i]) for k, v in table.items())
+        return self.instruments.get(code)
+
+    def sector(self, name):
+        if self.sectors is None:
+            path = os.path.join(self.root, 'sectors.json')
+            self.sectors = {}
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    self.sectors = json.load(f)
+        return list(self.sectors.get(name, []))
+
+
+class _Record(object):
+    # attribute bag shaped like the terminal's trade detail objects
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % kv for kv in sorted(self.__dict__.items())))
+
+
+class SimBroker(object):
+    # immediate fills against the replayed bars; T+1 for stock sells, commission and
+    # slippage as set through set_commission / set_slippage
+    LOT = 100
+
+    def __init__(self, context, capital):
+        self.context = context
+        self.cash = float(capital)
+        self.positions = OrderedDict()      # code -> [volume, can_use, cost]
+        self.orders = []
+        self.net_values = []
+        self.commission = [0.0, 0.001, 0.0003, 0.0003, 0.0003, 5.0]
+        self.slippage = (2, 0.0)
+        self.date = None
+
+    def on_bar(self):
+        date = _date_int(self.context.now())
+        if date != self.date:
+            self.date = date
+            for position in self.positions.values():
+                position[1] = position[0]
+
+    def mark(self):
+        value = self.cash + sum(p[0] * self.price(code) for code, p in self.positions.items() if p[0])
+        barpos = self.context.barpos
+        del self.net_values[barpos:]
+        self.net_values.extend([value] * (barpos + 1 - len(self.net_values)))
+        return value
+
+    def price(self, code):
+        series = self.context.store.bars(code, self.context.period)
+        if series is None:
+            return np.nan
+        stop = series.end(self.context.now())
+        return float(series.column('close')[stop - 1]) if stop else np.nan
+
+    def total_asset(self):
+        return self.cash + sum(p[0] * self.price(code) for code, p in self.positions.items() if p[0])
+
+    def holding(self, code):
+        position = self.positions.get(code)
+        return position[0] if position else 0
+
+    def _slipped(self, price, side):
+        kind, value = self.slippage
+        if kind == 1:
+            return price + side * value
+        if kind == 2:
+            return price * (1 + side * value)
+        return price + side * value * 0.01
+
+    def _fee(self, amount, side):
+        open_tax, close_tax, open_rate, close_rate, close_today_rate, minimum = self.commission
+        rate = open_rate if side > 0 else close_rate
+        tax = open_tax if side > 0 else close_tax
+        return max(amount * rate, minimum) + amount * tax
+
+    def order(self, code, volume, price = None, remark = ''):
+        # signed volume; returns the order record, status 'filled' or 'rejected'
+        side = 1 if volume > 0 else -1
+        volume = abs(int(volume))
+        market = price is None or not price > 0
+        price = self.price(code) if market else float(price)
+        status = 'rejected'
+        fee = 0.0
+        fill = self._slipped(price, side) if price == price else price
+        position = self.positions.setdefault(code, [0, 0, 0.0])
+        if volume and fill == fill:
+            if side < 0:
+                volume = min(volume, position[1])
+            else:
+                while volume and fill * volume + self._fee(fill * volume, side) > self.cash:
+                    volume -= self.LOT if volume > self.LOT else volume
+            if volume:
+                amount = fill * volume
+                fee = self._fee(amount, side)
+                if side > 0:
+                    position[2] = (position[2] * position[0] + amount) / (position[0] + volume)
+                    position[0] += volume
+                    self.cash -= amount + fee
+                else:
+                    position[0] -= volume
+                    position[1] -= volume
+                    self.cash += amount - fee
+                status = 'filled'
+        instrument, _, exchange = code.partition('.')
+        now = self.context.now()
+        record = _Record(
+            m_strOrderSysID=str(len(self.orders) + 1), m_strInstrumentID=instrument, m_strExchangeID=exchange,
+            m_nOffsetFlag=48 if side > 0 else 49, m_strOptName='买入' if side > 0 else '卖出',
+            m_dLimitPrice=price, m_dTradedPrice=fill if status == 'filled' else 0.0,
+            m_nVolumeTotalOriginal=volume, m_nVolumeTraded=volume if status == 'filled' else 0,
+            m_dTradeAmount=fill * volume if status == 'filled' else 0.0, m_dComssion=fee,
+            m_nOrderStatus=56 if status == 'filled' else 57, status=status, m_strRemark=remark,
+            m_strTradeDate=pci.timetag_to_datetime(now, '%Y%m%d'), m_strTradeTime=pci.timetag_to_datetime(now, '%H%M%S'),
+            barpos=self.context.barpos)
+        self.orders.append(record)
+        return record
+
+    def order_value(self, code, value, price = None):
+        quote = self.price(code) if price is None else price
+        if not quote > 0:
+            return self.order(code, 0, price)
+        lots = int(abs(value) / quote // self.LOT) * self.LOT
+        return self.order(code, lots if value > 0 else -lots, price)
+
+    def detail(self, datatype, accountid = ''):
+        datatype = datatype.upper()
+        if datatype == 'POSITION':
+            result = []
+            for code, (volume, can_use, cost) in self.positions.items():
+                if not volume:
+                    continue
+                instrument, _, exchange = code.partition('.')
+                last = self.price(code)
+                result.append(_Record(
+                    m_strAccountID=accountid, m_strInstrumentID=instrument, m_strExchangeID=exchange,
+                    m_strInstrumentName=instrument, m_nVolume=volume, m_nCanUseVolume=can_use,
+                    m_dOpenPrice=cost, m_dLastPrice=last, m_dMarketValue=volume * last,
+                    m_dPositionProfit=(last - cost) * volume, m_dFloatProfit=(last - cost) * volume))
+            return result
+        if datatype == 'ACCOUNT':
+            value = sum(p[0] * self.price(code) for code, p in self.positions.items() if p[0])
+            return [_Record(m_strAccountID=accountid, m_dBalance=self.cash + value, m_dAvailable=self.cash,
+                            m_dInstrumentValue=value, m_dStockValue=value, m_dAssetBalance=self.cash + value,
+                            m_dCommission=sum(o.m_dComssion for o in self.orders))]
+        if datatype == 'ORDER':
+            return list(self.orders)
+        if datatype == 'DEAL':
+            return [o for o in self.orders if o.status == 'filled']
+        return []
+
+
+class SimContext(object):
+    # the native ContextInfo as __PyContext sees it, for one main chart
+    def __init__(self, store, stockcode, period = '1d', start = '', end = '', capital = 1000000,
+                 benchmark = '000300.SH', dividend_type = 'none'):
+        if not isinstance(store, BarStore):
+            store = BarStore(store)
+        self.store = store
+        self.main_code = stockcode
+        self.stockcode, _, self.market = stockcode.partition('.')
+        self.stockcode_in_rzrk = self.stockcode
+        self.period = period
+        main = store.bars(stockcode, period)
+        if main is None:
+            raise IOError('no %s bars for %s under %s' % (period, stockcode, store.root))
+        first, last = main.window(_parse_time(start), _parse_time(end, True) or int(main.times[-1]), None)
+        self.times = main.times[first:last]
+        self.time_tick_size = len(self.times)
+        self.barpos = 0
+        self.start = start
+        self.end = end
+        self.capital = capital
+        self.benchmark = benchmark
+        self.dividend_type = dividend_type
+        self.refresh_rate = 0
+        self.do_back_test = True
+        self.request_id = 'sim'
+        self.in_pythonworker = False
+        self.data_info_level = 0
+        self.accounts = []
+        self.universe = []
+        self.lines = OrderedDict()          # paint name -> {barpos: value}
+        self.drawings = []
+        self.broker = SimBroker(self, capital)
+
+    @property
+    def current_bar(self):
+        return self.barpos
+
+    def now(self):
+        return int(self.times[self.barpos]) if self.time_tick_size else 0
+
+    def _period(self, period):
+        return self.period if period in ('', 'follow', None) else period
+
+    def _until(self, period):
+        # newest time visible in a period; on an intraday chart a daily bar shows up once its
+        # day is over, not with the day's close at the first minute
+        now = self.now()
+        if _is_daily(period) and not _is_daily(self.period):
+            return int(_midnights(np.array([_date_int(now)]))[0]) - 1
+        return now
+
+    def set_account(self, acct):
+        self.accounts.append(acct)
+
+    def get_universe(self):
+        return list(self.universe)
+
+    def set_universe(self, universe):
+        self.universe += [code for code in universe if code not in self.universe]
+
+    def is_last_bar(self):
+        return self.barpos == self.time_tick_size - 1
+
+    def is_new_bar(self):
+        return True
+
+    def get_bar_timetag(self, index):
+        return int(self.times[index]) if 0 <= index < self.time_tick_size else 0
+
+    def get_tick_timetag(self):
+        return self.now()
+
+    def get_history_data(self, count, period, field, dividend_type = 'none', skip_paused = True):
+        # {stock: [values]} for the universe, the last `count` bars up to the current one;
+        # without skip_paused each stock is laid onto the main chart, carrying values forward
+        period = self._period(period)
+        fields = [field] if isinstance(field, str) else list(field)
+        result = {}
+        for code in self.universe:
+            series = self.store.bars(code, period)
+            if series is None:
+                continue
+            if skip_paused or period != self.period:
+                begin, stop = series.window(None, self._until(period), count)
+                rows = slice(begin, stop)
+            else:
+                stop = self.barpos + 1
+                rows = np.searchsorted(series.times, self.times[max(stop - count, 0):stop], 'right') - 1
+                rows = rows[rows >= 0]
+            values = dict((f, series.column(f)[rows].tolist()) for f in fields)
+            result[code] = values[field] if isinstance(field, str) else values
+        return result
+
+    def get_market_data2(self, fields, stock_code, period, start_time, end_time, count, dividend_type, fill_data, subscribe):
+        # {stock: {'stime': [...], field: array}}, up to the current bar at the latest
+        period = self._period(period)
+        until = self._until(period)
+        end = min(_parse_time(end_time, True) or until, until)
+        start = _parse_time(start_time)
+        result = {}
+        for code in stock_code:
+            series = self.store.bars(code, period)
+            if series is None:
+                continue
+            begin, stop = series.window(start, end, count)
+            sdata = {'stime': series.stime(period)[begin:stop]}
+            for f in (fields or list(series.fields)):
+                sdata[f] = series.column(f)[begin:stop]
+            result[code] = sdata
+        return result
+
+    def get_market_data(self, fields, stock_code, start_time, end_time, skip_paused, period, dividend_type, count):
+        # {stock: {stime: {field: value}}}; with no range and no count, the current bar only
+        if start_time == '' and end_time == '' and count == -1:
+            count = 1
+        data = self.get_market_data2(fields, stock_code or [self.main_code], period, start_time, end_time, count,
+                                     dividend_type, True, False)
+        result = {}
+        for code, sdata in data.items():
+            columns = [(f, sdata[f].tolist()) for f in fields]
+            result[code] = OrderedDict((t, dict((f, v[i]) for f, v in columns)) for i, t in enumerate(sdata['stime']))
+        return result
+
+    def get_close_price(self, market, stockCode, realTimetag, period = 86400000, dividType = 0):
+        code = stockCode + '.' + market if market else stockCode
+        series = self.store.bars(code, '1d' if period >= 86400000 else self.period)
+        if series is None:
+            return -1
+        stop = series.end(realTimetag)
+        return float(series.column('close')[stop - 1]) if stop else -1
+
+    def get_last_close(self, stock):
+        series = self.store.bars(stock, self.period)
+        stop = series.end(self.now()) if series is not None else 0
+        return float(series.column('close')[stop - 2]) if stop > 1 else -1
+
+    def get_last_volume(self, stock):
+        series = self.store.bars(stock, self.period)
+        stop = series.end(self.now()) if series is not None else 0
+        return float(series.column('volume')[stop - 1]) if stop else -1
+
+    def get_full_tick(self, stock_code = []):
+        # the newest tick at or before the current bar, or one made from the bar itself
+        result = {}
+        now = self.now()
+        for code in stock_code or [self.main_code]:
+            ticks = self.store.bars(code, 'tick')
+            if ticks is not None and ticks.end(now):
+                i = ticks.end(now) - 1
+                tick = dict((f, v[i].item() if hasattr(v[i], 'item') else v[i]) for f, v in ticks.fields.items())
+                tick['timetag'] = pci.timetag_to_datetime(int(ticks.times[i]), '%Y%m%d %H:%M:%S')
+                result[code] = tick
+                continue
+            series = self.store.bars(code, self.period)
+            stop = series.end(now) if series is not None else 0
+            if not stop:
+                continue
+            row = dict((f, float(series.column(f)[stop - 1])) for f in ('open', 'high', 'low', 'close', 'volume', 'amount'))
+            last = float(series.column('close')[stop - 2]) if stop > 1 else row['open']
+            result[code] = {
+                'timetag': pci.timetag_to_datetime(int(series.times[stop - 1]), '%Y%m%d %H:%M:%S'),
+                'lastPrice': row['close'], 'open': row['open'], 'high': row['high'], 'low': row['low'],
+                'lastClose': last, 'amount': row['amount'], 'volume': row['volume'], 'pvolume': row['volume'],
+                'askPrice': [row['close']] * 5, 'bidPrice': [row['close']] * 5,
+                'askVol': [0] * 5, 'bidVol': [0] * 5, 'stockStatus': 0}
+        return result
+
+    def get_financial_data(self, fieldList, stockList, startDate, endDate, report_type = 'report_time', data_type = -1, single = None):
+        # list form: {'field', 'stock', 'date', 'value'} with one row per trading day of
+        # [startDate, endDate], each carrying the newest report known by that day, or with
+        # `single` (get_raw_financial_data) {stock: {field: {timetag: value}}} per report;
+        # str form (table, column, market, code): the value as of bar `data_type` (pos), the
+        # current bar for -1
+        if isinstance(fieldList, str) and isinstance(stockList, str):
+            pos = data_type if isinstance(data_type, int) and data_type >= 0 else self.barpos
+            code = endDate + '.' + startDate
+            return self._report_values(code, [fieldList + '.' + stockList], [self.get_bar_timetag(pos)], report_type)[0][0]
+        fields = list(fieldList)
+        stocks = list(stockList)
+        start = _parse_time(startDate) or 0
+        end = min(_parse_time(endDate, True) or self.now(), self.now())
+        if single:
+            return dict((code, self._report_changes(code, fields, start, end, report_type)) for code in stocks)
+        main = self.store.daily(self.main_code, self.period)
+        begin, stop = main.window(start, end, None)
+        days = main.times[begin:stop]
+        dates = pci.timetag_to_datetime(days, '%Y%m%d').tolist() if len(days) else []
+        values = [[] for f in fields]
+        for code in stocks:
+            block = self._report_values(code, fields, days, report_type)
+            for j in range(len(fields)):
+                values[j].extend(block[j])
+        return {'field': [f.split('.')[-1] for f in fields], 'stock': stocks, 'date': dates, 'value': values}
+
+    def _report_changes(self, code, fields, start, end, report_type):
+        # raw form: {field: {timetag: value}} of the reports known within [start, end]
+        reports = self.store.financial(code)
+        if reports is None:
+            return {}
+        known = reports.fields['m_anntime'] if report_type == 'announce_time' else reports.times
+        rows = np.flatnonzero((known >= start) & (known <= end + 86399999))
+        result = {}
+        for f in fields:
+            column = reports.fields.get(f, reports.fields.get(f.split('.')[-1]))
+            if column is not None:
+                result[f] = OrderedDict((int(known[r]), np.asarray(column)[r].item()) for r in rows)
+        return result
+
+    def _report_values(self, code, fields, days, report_type):
+        reports = self.store.financial(code)
+        if reports is None:
+            return [[np.nan] * len(days) for f in fields]
+        known = reports.fields['m_anntime'] if report_type == 'announce_time' else reports.times
+        # the newest report known at the end of each day
+        order = np.argsort(known, kind='stable')
+        rows = np.searchsorted(known[order], np.asarray(days, dtype=np.int64) + 86399999, 'right') - 1
+        block = []
+        for f in fields:
+            column = reports.fields.get(f, reports.fields.get(f.split('.')[-1]))
+            if column is None:
+                block.append([np.nan] * len(days))
+                continue
+            column = np.asarray(column)[order]
+            block.append([column[r].item() if r >= 0 else np.nan for r in rows])
+        return block
+
+    def get_instrumentdetail(self, code):
+        inst = self.store.instrument(code)
+        if inst is not None:
+            return dict(inst)
+        instrument, _, exchange = code.partition('.')
+        series = self.store.daily(code, self.period)
+        pre_close = max(self.get_last_close(code), 0.0) if series is not None else 0.0
+        return {'ExchangeID': exchange, 'InstrumentID': instrument, 'InstrumentName': instrument,
+                'OpenDate': _date_int(int(series.times[0])) if series is not None and len(series) else 0,
+                'ExpireDate': 99999999, 'PreClose': pre_close,
+                'UpStopPrice': round(pre_close * 1.1, 2), 'DownStopPrice': round(pre_close * 0.9, 2),
+                'PriceTick': 0.01, 'VolumeMultiple': 1, 'InstrumentStatus': 0, 'IsTrading': True}
+
+    def get_stock_name(self, stock):
+        return self.get_instrumentdetail(stock).get('InstrumentName', '')
+
+    def get_open_date(self, stock):
+        return self.get_instrumentdetail(stock).get('OpenDate', 0)
+
+    def get_trading_dates(self, stockcode, start_date, end_date, count, period = '1d'):
+        series = self.store.bars(stockcode, period)
+        if series is None:
+            series = self.store.bars(self.main_code, self.period)
+        begin, stop = series.window(_parse_time(start_date), _parse_time(end_date, True) or self.now(), count if count > 0 else None)
+        return series.stime(period)[begin:stop].tolist()
+
+    def get_stock_list_in_sector(self, sectorname, real_timetag = -1):
+        return self.store.sector(sectorname)
+
+    def get_sector(self, sectorname, real_timetag = -1):
+        return self.store.sector(sectorname)
+
+    def get_risk_free_rate(self, index):
+        return 0.0
+
+    def get_net_value(self, barpos):
+        values = self.broker.net_values
+        return values[barpos] / self.broker.net_values[0] if 0 <= barpos < len(values) and values[0] else 1.0
+
+    def is_suspended_stock(self, stock, type = 0):
+        series = self.store.bars(stock, self.period)
+        stop = series.end(self.now()) if series is not None else 0
+        return not stop or series.times[stop - 1] != self.now()
+
+    def get_divid_factors(self, marketAndStock, date = ''):
+        return {}
+
+    def set_slippage(self, b_flag, slippage = None):
+        self.broker.slippage = (2, float(b_flag)) if slippage is None else (int(b_flag), float(slippage))
+
+    def get_slippage(self):
+        return {'slippage_type': self.broker.slippage[0], 'slippage': self.broker.slippage[1]}
+
+    def set_commission(self, comtype, com):
+        # comtype 0: [open tax, close tax, open, close, close today, minimum] or one rate
+        if isinstance(com, (list, tuple)):
+            self.broker.commission = [float(c) for c in com]
+        else:
+            self.broker.commission[2:5] = [float(com)] * 3
+
+    def get_commission(self):
+        keys = ('open_tax', 'close_tax', 'open_commission', 'close_commission', 'close_today_commission', 'min_commission')
+        return dict(zip(keys, self.broker.commission))
+
+    def run_time(self, funcname, intervalday, time, exchange = 'SH'):
+        pass
+
+    def paint(self, name, data, index, drawStyle, selectcolor = '', limit = 1):
+        self.lines.setdefault(name, {})[self.barpos if index == -1 else index] = data
+
+    def _draw(self, kind, args):
+        self.drawings.append((self.barpos, kind) + tuple(args))
+
+    def draw_text(self, *args):
+        self._draw('text', args)
+
+    def draw_vertline(self, *args):
+        self._draw('vertline', args)
+
+    def draw_icon(self, *args):
+        self._draw('icon', args)
+
+    def draw_number(self, *args):
+        self._draw('number', args)
+
+
+def _order_args(args):
+    # (amount, price or None, rest) from the [style, price], ContextInfo[, accId] tail
+    amount, rest = args[0], list(args[1:])
+    price = None
+    if rest and isinstance(rest[0], str):
+        style = rest.pop(0).upper()
+        if rest and isinstance(rest[0], numbers.Number):
+            value = rest.pop(0)
+            price = value if style in ('FIX', 'LIMIT') else None
+    return amount, price, rest
+
+
+def order_api(broker):
+    # the terminal's module-level order and account functions, bound to one SimBroker
+    def order_shares(stockcode, *args):
+        shares, price, rest = _order_args(args)
+        return broker.order(stockcode, shares, price)
+
+    def order_lots(stockcode, *args):
+        lots, price, rest = _order_args(args)
+        return broker.order(stockcode, lots * broker.LOT, price)
+
+    def order_value(stockcode, *args):
+        value, price, rest = _order_args(args)
+        return broker.order_value(stockcode, value, price)
+
+    def order_percent(stockcode, *args):
+        percent, price, rest = _order_args(args)
+        return broker.order_value(stockcode, percent * broker.total_asset(), price)
+
+    def order_target_value(stockcode, *args):
+        target, price, rest = _order_args(args)
+        quote = broker.price(stockcode) if price is None else price
+        return broker.order_value(stockcode, target - broker.holding(stockcode) * quote, price)
+
+    def order_target_percent(stockcode, *args):
+        percent, price, rest = _order_args(args)
+        return order_target_value(stockcode, percent * broker.total_asset(), *rest)
+
+    def passorder(opType, orderType, accountid, orderCode, prType, modelprice, volume, *rest):
+        # stock buy (23) / sell (24), by shares (1101) or by amount (1102)
+        side = 1 if opType == 23 else -1 if opType == 24 else 0
+        price = modelprice if prType == 11 else None
+        if not side or orderType not in (1101, 1102):
+            return broker.order(orderCode, 0, price, 'unsupported passorder %s/%s' % (opType, orderType))
+        if orderType == 1102:
+            return broker.order_value(orderCode, side * volume, price)
+        return broker.order(orderCode, side * volume, price)
+
+    def get_trade_detail_data(accountid, accounttype, datatype, strategyname = ''):
+        return broker.detail(datatype, accountid)
+
+    def get_last_order_id(accountid, accounttype, datatype, strategyname = ''):
+        return broker.orders[-1].m_strOrderSysID if broker.orders else '-1'
+
+    def cancel(orderId, accountId, accountType, ContextInfo):
+        return False
+
+    def download_history_data(*args):
+        pass
+
+    def get_stock_list_in_sector(sectorname, real_timetag = -1):
+        return broker.context.store.sector(sectorname)
+
+    return {
+        'order_shares': order_shares, 'order_lots': order_lots, 'order_value': order_value,
+        'order_percent': order_percent, 'order_target_value': order_target_value,
+        'order_target_percent': order_target_percent, 'passorder': passorder,
+        'get_trade_detail_data': get_trade_detail_data, 'get_last_order_id': get_last_order_id,
+        'cancel': cancel, 'download_history_data': download_history_data,
+        'get_stock_list_in_sector': get_stock_list_in_sector, 'timetag_to_datetime': pci.timetag_to_datetime,
+    }
+
+
+def load_strategy(path, api):
+    # strategy files declare gbk but are often saved as utf-8; try both
+    with open(path, 'rb') as f:
+        source = f.read()
+    for encoding in ('utf-8', 'gbk'):
+        try:
+            text = source.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise UnicodeDecodeError('utf-8/gbk', source, 0, 1, 'cannot decode ' + path)
+    namespace = {'__name__': os.path.splitext(os.path.basename(path))[0], '__file__': path}
+    namespace.update(api)
+    exec(compile(text, path, 'exec'), namespace)
+    return namespace
+
+
+_MISSING = object()
+
+
+@contextlib.contextmanager
+def patched(module, **values):
+    # module globals replaced for the duration of a run; names the terminal normally injects
+    # may be missing outside it, and are removed again
+    saved = dict((name, getattr(module, name, _MISSING)) for name in values)
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is _MISSING:
+                delattr(module, name)
+            else:
+                setattr(module, name, value)
+
+
+def run_strategy(path, data_dir, stockcode, period = '1d', start = '', end = '', capital = 1000000, bars = None,
+                 snapshot_mode = 'deepcopy', profile_methods = False):
+    # init, then handlebar on every bar as the terminal does in a back test; returns the
+    # ContextInfo the strategy saw, its native context is ContextInfo.context. With
+    # profile_methods the per-method summary is left in ContextInfo.context.method_profile
+    native = SimContext(data_dir, stockcode, period, start, end, capital)
+    api = order_api(native.broker)
+    with patched(pci, get_stock_list_in_sector=api['get_stock_list_in_sector'],
+                 hint_get_history_data=False, hint_get_market_data=False):
+        strategy = load_strategy(path, api)
+        context = PyContext(native)
+        context.set_snapshot_mode(snapshot_mode)
+        if profile_methods:
+            context.enable_profiling(namespace=strategy)
+        try:
+            if 'init' in strategy:
+                strategy['init'](context)
+            if 'after_init' in strategy:
+                strategy['after_init'](context)
+            handlebar = strategy.get('handlebar')
+            total = native.time_tick_size if bars is None else min(bars, native.time_tick_size)
+            for barpos in range(total):
+                native.barpos = barpos
+                native.broker.on_bar()
+                pci.resume_context_info(context)
+                if handlebar is not None:
+                    handlebar(context)
+                native.broker.mark()
+            if profile_methods:
+                pci.resume_context_info(context)
+                native.method_profile = context.get_profile_summary()
+        finally:
+            context.disable_profiling()
+    return context
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='replay a strategy file over local bar files')
+    parser.add_argument('data_dir')
+    parser.add_argument('strategy')
+    parser.add_argument('stockcode')
+    parser.add_argument('--period', default='1d')
+    parser.add_argument('--start', default='')
+    parser.add_argument('--end', default='')
+    parser.add_argument('--capital', type=float, default=1000000)
+    parser.add_argument('--bars', type=int, default=None)
+    parser.add_argument('--quiet', action='store_true', help='drop the strategy\'s prints')
+    parser.add_argument('--profile', type=int, default=0, metavar='N', help='print the N most expensive functions')
+    parser.add_argument('--methods', type=int, default=0, metavar='N',
+                        help='print the N heaviest ContextInfo methods and trading functions')
+    args = parser.parse_args(argv)
+
+    def run():
+        return run_strategy(args.strategy, args.data_dir, args.stockcode, args.period, args.start, args.end,
+                            args.capital, args.bars, profile_methods=bool(args.methods))
+
+    stdout = sys.stdout
+    if args.quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        t0 = time.perf_counter()
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            context = profiler.runcall(run)
+        else:
+            context = run()
+        cost = time.perf_counter() - t0
+    finally:
+        if args.quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    native = context.context
+    fills = sum(1 for o in native.broker.orders if o.status == 'filled')
+    bars = native.time_tick_size if args.bars is None else min(args.bars, native.time_tick_size)
+    print('%d bars in %.3f s (%.0f bars/s), %d orders, %d filled, net value %.2f' % (
+        bars, cost, bars / cost if cost else 0, len(native.broker.orders), fills,
+        native.broker.net_values[-1] if native.broker.net_values else native.broker.cash))
+    if args.methods:
+        header = ['calls', 'total ms', 'p50 us', 'p99 us', 'calls/bar', 'ms/bar', 'bytes/bar']
+        print(''.join('%12s' % h for h in header) + '  method')
+        for row in native.method_profile[:args.methods]:
+            values = list(row.values())
+            print(''.join(('%12.1f' if isinstance(v, float) else '%12s') % v for v in values[1:]) + '  ' + values[0])
+    if args.profile:
+        import pstats
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.profile)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -19,6 +19,8 @@ def init(ContextInfo):
         ContextInfo.atr_period = 14  # ATR计算周期
         ContextInfo.grid_scale = 0.5  # ATR调整系数
         ContextInfo.expand_buffer = 2  # 网格扩展缓冲步长
+        ContextInfo.use_trend_filter = False  # MA/EMA趋势过滤，确认后再开启；关闭时不过滤
+        ContextInfo.use_atr_grid = False  # 按ATR生成网格，确认后再开启；关闭时使用默认网格
         
         # 高级风险控制
         ContextInfo.max_drawdown = -0.05  # 最大允许回撤
@@ -52,14 +54,18 @@ def init_dynamic_grid(ContextInfo):
     """动态初始化网格参数"""
     try:
         # 获取波动率数据
-        hist = get_enhanced_history(ContextInfo, days=ContextInfo.atr_period*2)
+        if getattr(ContextInfo, 'use_atr_grid', False):
+            hist = get_enhanced_history(ContextInfo, days=ContextInfo.atr_period*2)
+        else:
+            hist = {'high':[], 'low':[], 'close':[], 'volume':[]}
         
         # 确保有足够的数据
         if (not hist['high'] or not hist['low'] or not hist['close'] or
             len(hist['high']) < ContextInfo.atr_period or
             len(hist['low']) < ContextInfo.atr_period or
             len(hist['close']) < ContextInfo.atr_period):
-            print("警告：历史数据不足，使用默认网格参数")
+            if getattr(ContextInfo, 'use_atr_grid', False):
+                print("警告：历史数据不足，使用默认网格参数")
             # 使用默认值初始化网格
             ContextInfo.grid_upper = 27.0
             ContextInfo.grid_lower = 25.0
@@ -159,6 +165,8 @@ def handlebar(ContextInfo):
 
 def enhanced_trend_filter(ContextInfo):
     """增强趋势过滤器"""
+    if not getattr(ContextInfo, 'use_trend_filter', False):
+        return True
     try:
         # 每4小时更新一次趋势数据
         if hasattr(ContextInfo.trend_cache, 'last_update') and time.time() - ContextInfo.trend_cache["last_update"] < 14400:
@@ -388,12 +396,13 @@ def smart_status_report(ContextInfo, price):
 def get_enhanced_history(ContextInfo, days=30):
     """获取多维度历史数据"""
     try:
-        return {
-            'high': ContextInfo.get_history_data(days, '1d', 'high').get(ContextInfo.tradestock, {}).get('high', []),
-            'low': ContextInfo.get_history_data(days, '1d', 'low').get(ContextInfo.tradestock, {}).get('low', []),
-            'close': ContextInfo.get_history_data(days, '1d', 'close').get(ContextInfo.tradestock, {}).get('close', []),
-            'volume': ContextInfo.get_history_data(days, '1d', 'volume').get(ContextInfo.tradestock, {}).get('volume', [])
-        }
+        fields = ['high', 'low', 'close', 'volume']
+        code = ContextInfo.tradestock
+        # 不复权，与下单价格一致；一次多取若干根，去掉空行后取最近days根
+        count = days + max(5, days // 2)
+        bundle = ContextInfo.get_history_bundle([code], fields, count, '1d', dividend_type='none')[code]
+        valid = bundle[~np.isnan(bundle['close'])][-days:]
+        return dict((field, valid[field].tolist()) for field in fields)
     except:
         return {'high':[], 'low':[], 'close':[], 'volume':[]}
 
@@ -416,14 +425,8 @@ def calculate_real_atr(highs, lows, closes, period):
     return np.mean(true_ranges[-period:]) if true_ranges else 0.3
 
 def get_exponential_ma(ContextInfo, window):
-    """计算指数移动平均"""
-    closes = ContextInfo.get_history_data(window*2, '1d', 'close').get(ContextInfo.tradestock, {}).get('close', [])
-    closes = closes[-window*2:]
-    if len(closes) < window:
-        return None
-    weights = np.exp(np.linspace(-1., 0., window))
-    weights /= weights.sum()
-    return np.dot(closes[-window:], weights)
+    """计算指数移动平均（增量更新）"""
+    return ContextInfo.get_indicator('ema', ContextInfo.tradestock, window)
 
 def calculate_net_profit(qty, cost, price, ContextInfo):
     """计算净收益（扣除所有费用）"""
@@ -483,20 +486,13 @@ def get_available_cash(ContextInfo):
         return 50000
 
 def get_moving_average(ContextInfo, window):
-    """计算简单移动平均"""
-    closes = ContextInfo.get_history_data(window*2, '1d', 'close').get(ContextInfo.tradestock, {}).get('close', [])
-    closes = closes[-window*2:]
-    if len(closes) < window:
-        return None
-    return np.mean(closes[-window:])
+    """计算简单移动平均（增量更新）"""
+    return ContextInfo.get_indicator('sma', ContextInfo.tradestock, window)
 
 def get_ma_slope(ContextInfo, window):
     """计算移动平均斜率"""
-    ma1 = get_moving_average(ContextInfo, window)
-    ma2 = get_moving_average(ContextInfo, window+1)
-    if ma1 is None or ma2 is None:
-        return 0
-    return (ma1 - ma2) / ma1
+    slope = ContextInfo.get_indicator('slope', ContextInfo.tradestock, window)
+    return 0 if slope is None else slope
 
 def cross_up(current, previous, level):
     """检查价格是否上穿某一水平"""